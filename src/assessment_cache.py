@@ -0,0 +1,96 @@
+import threading
+from cachetools import TTLCache
+from openai import AsyncOpenAI, OpenAI
+from openai.types.beta.assistant import Assistant
+
+from cache_store import content_hash
+
+ASSESSMENT_CACHE_SIZE: int = 512
+ASSESSMENT_CACHE_TTL_SECONDS: float = 24 * 3600
+FINGERPRINT_TTL_SECONDS: float = 300
+
+# Shared by all the sessions of the Streamlit server process and their worker threads
+_assessments: TTLCache = TTLCache(
+    maxsize=ASSESSMENT_CACHE_SIZE, ttl=ASSESSMENT_CACHE_TTL_SECONDS
+)
+_assistants: TTLCache = TTLCache(maxsize=64, ttl=FINGERPRINT_TTL_SECONDS)
+_lock = threading.Lock()
+
+
+def assistant_fingerprint(assistant: Assistant) -> str:
+    """Returns a hash of the assistant settings that affect its assessments."""
+    return content_hash(
+        assistant.model,
+        assistant.instructions,
+        assistant.temperature,
+        assistant.top_p,
+        [tool.model_dump() for tool in assistant.tools],
+        (
+            assistant.tool_resources.model_dump()
+            if assistant.tool_resources is not None
+            else None
+        ),
+    )
+
+
+def get_assistant(client: OpenAI, assistant_id: str) -> Assistant:
+    """
+    Returns an assistant, retrieving it at most every few minutes.
+
+    Editing an assistant's instructions or model in the OpenAI dashboard therefore invalidates
+    its cached assessments within FINGERPRINT_TTL_SECONDS.
+    """
+    with _lock:
+        assistant: Assistant | None = _assistants.get(assistant_id)
+    if assistant is None:
+        assistant = client.beta.assistants.retrieve(assistant_id)
+        with _lock:
+            _assistants[assistant_id] = assistant
+    return assistant
+
+
+async def get_assistant_async(client: AsyncOpenAI, assistant_id: str) -> Assistant:
+    """Asynchronous counterpart of get_assistant."""
+    with _lock:
+        assistant: Assistant | None = _assistants.get(assistant_id)
+    if assistant is None:
+        assistant = await client.beta.assistants.retrieve(assistant_id)
+        with _lock:
+            _assistants[assistant_id] = assistant
+    return assistant
+
+
+def get_assistant_fingerprint(client: OpenAI, assistant_id: str) -> str:
+    """Returns the fingerprint of an assistant, see get_assistant."""
+    return assistant_fingerprint(get_assistant(client, assistant_id))
+
+
+async def get_assistant_fingerprint_async(
+    client: AsyncOpenAI, assistant_id: str
+) -> str:
+    """Asynchronous counterpart of get_assistant_fingerprint."""
+    return assistant_fingerprint(await get_assistant_async(client, assistant_id))
+
+
+def assessment_cache_key(assistant_id: str, fingerprint: str, text: str) -> str:
+    """Returns the cache key of the assessment of a text by a given assistant version."""
+    return content_hash(assistant_id, fingerprint, text)
+
+
+def get_cached_assessment(key: str) -> str | None:
+    """Returns a cached assessment, or None if the text was not graded recently."""
+    with _lock:
+        return _assessments.get(key)
+
+
+def put_cached_assessment(key: str, assessment: str) -> None:
+    """Stores an assessment, evicting the least recently used or expired ones."""
+    with _lock:
+        _assessments[key] = assessment
+
+
+def clear_assessment_cache() -> None:
+    """Forgets all cached assessments and assistants."""
+    with _lock:
+        _assessments.clear()
+        _assistants.clear()
@@ -0,0 +1,178 @@
+import re
+from openai import AsyncOpenAI, OpenAI
+from pydantic import BaseModel, Field
+
+from exam_splitter import completion_usage
+from gaclasses import Assessment
+from prompt_usage import usage_tally
+from rate_limiter import estimate_extract_tokens, scheduler, without_retries
+
+EXTRACT_MODEL: str = "gpt-4o-mini"
+EXTRACT_PROMPT: str = """
+You extract data from the assessment of a student's paper written by a teacher.
+Return the final score out of 20 given in the assessment, rounded to the nearest integer, and
+the number of errors of each error type listed in the assessment.  Use the error type names as
+written in the assessment, and do not count errors the assessment does not mention.
+"""
+# "14/20", "14 / 20", "14,5/20"
+SCORE_PATTERN = re.compile(r"(\d{1,2}(?:[.,]\d+)?)\s*/\s*20\b")
+SCORE_KEYWORDS = re.compile(r"note|grade|score|total", re.IGNORECASE)
+ERROR_TABLE_KEYWORDS = re.compile(r"erreur|error|faute|mistake", re.IGNORECASE)
+TABLE_SEPARATOR = re.compile(r"^\|?\s*:?-{2,}")
+
+
+class ErrorCount(BaseModel):
+    """Number of errors of one type in an assessment."""
+
+    error_type: str = Field(..., description="Name of the error type")
+    count: int = Field(..., description="Number of errors of this type")
+
+
+class AssessmentData(BaseModel):
+    """Data extracted by the model from an assessment, in a schema accepted by structured outputs."""
+
+    final_score: int = Field(..., description="Final score out of 20")
+    errors: list[ErrorCount] = Field(..., description="Number of errors of each type")
+
+
+def extract_final_score(assessment_text: str) -> int | None:
+    """Returns the last score out of 20 given on a line mentioning a grade, or None if there is none."""
+    score: int | None = None
+    for line in assessment_text.splitlines():
+        if not SCORE_KEYWORDS.search(line):
+            continue
+        for match in SCORE_PATTERN.finditer(line):
+            value: float = float(match.group(1).replace(",", "."))
+            if 0 <= value <= 20:
+                score = round(value)
+    return score
+
+
+def markdown_table_rows(lines: list[str]) -> list[list[str]]:
+    """Splits the lines of a Markdown table into cells, dropping the header separator."""
+    return [
+        [cell.strip() for cell in line.strip().strip("|").split("|")]
+        for line in lines
+        if not TABLE_SEPARATOR.match(line.strip())
+    ]
+
+
+def extract_error_distribution(assessment_text: str) -> dict[str, int] | None:
+    """
+    Returns the error counts of the first Markdown table whose header mentions errors.
+
+    Each row gives an error type in its first cell and a count in the first cell holding an
+    integer.  Total rows are skipped.  Returns None if there is no such table.
+    """
+    tables: list[list[str]] = []
+    current: list[str] = []
+    for line in assessment_text.splitlines():
+        if line.strip().startswith("|"):
+            current.append(line)
+        elif current:
+            tables.append(current)
+            current = []
+    if current:
+        tables.append(current)
+    for table in tables:
+        rows: list[list[str]] = markdown_table_rows(table)
+        if len(rows) < 2 or not ERROR_TABLE_KEYWORDS.search(" ".join(rows[0])):
+            continue
+        distribution: dict[str, int] = {}
+        for row in rows[1:]:
+            error_type: str = row[0].strip("* ")
+            if not error_type or error_type.lower() == "total":
+                continue
+            counts: list[int] = [
+                int(cell.strip("* ")) for cell in row[1:] if cell.strip("* ").isdigit()
+            ]
+            if counts:
+                distribution[error_type] = counts[0]
+        if distribution:
+            return distribution
+    return None
+
+
+def parse_assessment(assessment_text: str) -> Assessment | None:
+    """Extracts the score and error counts of an assessment locally, or returns None if either is missing."""
+    final_score: int | None = extract_final_score(assessment_text)
+    error_distribution: dict[str, int] | None = extract_error_distribution(
+        assessment_text
+    )
+    if final_score is None or error_distribution is None:
+        return None
+    return Assessment(
+        assessment_text=assessment_text,
+        error_distribution=error_distribution,
+        final_score=final_score,
+    )
+
+
+def make_extract_messages(assessment_text: str) -> list[dict[str, str]]:
+    return [
+        {"role": "system", "content": EXTRACT_PROMPT},
+        {"role": "user", "content": assessment_text},
+    ]
+
+
+def to_assessment(assessment_text: str, data: AssessmentData) -> Assessment:
+    return Assessment(
+        assessment_text=assessment_text,
+        error_distribution={error.error_type: error.count for error in data.errors},
+        final_score=max(0, min(20, data.final_score)),
+    )
+
+
+def extract_assessment(client: OpenAI, assessment_text: str) -> Assessment:
+    """
+    Returns the structured Assessment of an assessment text.
+
+    The score and error table are parsed locally when the assessment follows the usual layout,
+    and extracted by a small model with structured outputs otherwise, paced by the rate limit
+    scheduler like the other calls to that model.  Safe to call from worker threads.
+
+    Args:
+        client: OpenAI client used if the local parsing fails.
+        assessment_text (str): The assessment written by a grading assistant.
+
+    Returns:
+        Assessment: The assessment with its final score and error distribution.
+    """
+    assessment: Assessment | None = parse_assessment(assessment_text)
+    if assessment is not None:
+        return assessment
+    print("Extracting the score and errors of an assessment with the model...")
+    completion = scheduler.call(
+        EXTRACT_MODEL,
+        estimate_extract_tokens(len(assessment_text.split())),
+        lambda: without_retries(client).beta.chat.completions.parse(
+            model=EXTRACT_MODEL,
+            messages=make_extract_messages(assessment_text),
+            response_format=AssessmentData,
+        ),
+        usage=completion_usage,
+    )
+    usage_tally.record(EXTRACT_MODEL, completion.usage)
+    return to_assessment(assessment_text, completion.choices[0].message.parsed)
+
+
+async def extract_assessment_async(
+    client: AsyncOpenAI, assessment_text: str
+) -> Assessment:
+    """Asynchronous counterpart of extract_assessment."""
+    assessment: Assessment | None = parse_assessment(assessment_text)
+    if assessment is not None:
+        return assessment
+    print("Extracting the score and errors of an assessment with the model...")
+    completion = await scheduler.call_async(
+        EXTRACT_MODEL,
+        estimate_extract_tokens(len(assessment_text.split())),
+        lambda: without_retries(client).beta.chat.completions.parse(
+            model=EXTRACT_MODEL,
+            messages=make_extract_messages(assessment_text),
+            response_format=AssessmentData,
+        ),
+        usage=completion_usage,
+    )
+    usage_tally.record(EXTRACT_MODEL, completion.usage)
+    return to_assessment(assessment_text, completion.choices[0].message.parsed)
@@ -0,0 +1,490 @@
+import asyncio
+from typing import Any, Callable
+from openai import AsyncOpenAI, OpenAI
+from openai.types.beta.threads.run import Run
+from pydantic import BaseModel, Field
+
+from assessment_cache import (
+    assessment_cache_key,
+    get_assistant_async,
+    get_assistant_fingerprint_async,
+    get_cached_assessment,
+    put_cached_assessment,
+)
+from assessment_extractor import extract_assessment_async
+from cache_store import CacheStore
+from exam_splitter import (
+    SPLIT_MODEL,
+    SPLIT_RESPONSE_FORMATS,
+    completion_usage,
+    get_cached_split,
+    make_split_messages,
+    parsed_split,
+    put_cached_split,
+    split_cache_key,
+)
+from gaclasses import Assessment, Configuration, MockExam, Submission
+from grading_engine import (
+    GRADE_PROMPT,
+    RUN_DEADLINE_SECONDS,
+    TERMINAL_RUN_STATUSES,
+    AssistantRunError,
+    SectionGrade,
+    exam_sections,
+    grading_thread,
+    run_error_message,
+    run_usage,
+)
+from prompt_usage import usage_tally
+from rate_limiter import (
+    estimate_grading_tokens,
+    estimate_split_tokens,
+    scheduler,
+    without_retries,
+)
+from section_splitter import split_mock_exam_locally
+
+DEFAULT_MAX_IN_FLIGHT: int = 64
+
+
+class SplitInput(BaseModel):
+    """A markdown paper to split and grade in an asynchronous batch."""
+
+    key: str = Field(
+        ..., description="Key of the mock exam, usually the markdown file name"
+    )
+    md_text: str = Field(..., description="Markdown text of the student's paper")
+    file_id: str = Field(..., description="Google Drive file ID of the markdown file")
+    file_name: str = Field(..., description="Name of the markdown file")
+    file_date: str | None = Field(
+        None, description="Creation date of the markdown file, if known"
+    )
+
+
+class ExamResult(BaseModel):
+    """Outcome of splitting and grading one paper in an asynchronous batch."""
+
+    key: str = Field(..., description="Key of the mock exam")
+    mock_exam: MockExam | None = Field(
+        None, description="The split mock exam, None if splitting failed"
+    )
+    sections: list[SectionGrade] = Field(
+        [], description="Graded sections of the mock exam"
+    )
+    error: str | None = Field(
+        None, description="Error message if splitting failed, None otherwise"
+    )
+
+
+SectionCallback = Callable[[SectionGrade], None]
+
+
+def make_async_client(client: OpenAI) -> AsyncOpenAI:
+    """Creates an AsyncOpenAI client with the same credentials as a synchronous client."""
+    return AsyncOpenAI(
+        api_key=client.api_key,
+        organization=client.organization,
+        project=client.project,
+        max_retries=client.max_retries,
+    )
+
+
+async def split_mock_exam_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    split_input: SplitInput,
+    cache: CacheStore | None = None,
+    mode: str = "boundaries",
+) -> MockExam:
+    """Asynchronous counterpart of exam_splitter.split_mock_exam."""
+    local: MockExam | None = split_mock_exam_locally(
+        split_input.md_text,
+        split_input.file_id,
+        split_input.file_name,
+        split_input.file_date,
+    )
+    if local is not None:
+        return local
+    key: str = split_cache_key(split_input.md_text, mode=mode)
+    cached: MockExam | None = get_cached_split(
+        cache, key, split_input.file_id, split_input.file_name
+    )
+    if cached is not None:
+        return cached
+    mock_exam: MockExam | None = await request_split_async(
+        client, limiter, split_input, mode
+    )
+    if mock_exam is None:
+        mock_exam = await request_split_async(client, limiter, split_input, "full")
+    if mock_exam is None:
+        raise ValueError(f"The model could not split {split_input.file_name}")
+    put_cached_split(cache, key, mock_exam)
+    return mock_exam
+
+
+async def request_split_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    split_input: SplitInput,
+    mode: str,
+) -> MockExam | None:
+    """Asynchronous counterpart of exam_splitter.request_split."""
+
+    async def parse() -> Any:
+        async with limiter:
+            return await without_retries(client).beta.chat.completions.parse(
+                model=SPLIT_MODEL,
+                messages=make_split_messages(
+                    split_input.md_text,
+                    split_input.file_id,
+                    split_input.file_name,
+                    split_input.file_date,
+                    mode,
+                ),
+                response_format=SPLIT_RESPONSE_FORMATS[mode],
+            )
+
+    response: Any = await scheduler.call_async(
+        SPLIT_MODEL,
+        estimate_split_tokens(
+            len(split_input.md_text.split()), rewrites_text=mode == "full"
+        ),
+        parse,
+        usage=completion_usage,
+    )
+    usage_tally.record(SPLIT_MODEL, response.usage)
+    return parsed_split(
+        response.choices[0].message.parsed,
+        mode,
+        split_input.md_text,
+        split_input.file_id,
+        split_input.file_name,
+    )
+
+
+async def wait_for_run_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    run: Run,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+    initial_interval: float = 0.5,
+    max_interval: float = 5.0,
+) -> Run:
+    """Asynchronous counterpart of grading_engine.wait_for_run.
+
+    The limiter is only held while a status request is in flight, so waiting runs do not
+    use up request slots.
+    """
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    deadline: float = loop.time() + deadline_seconds
+    interval: float = initial_interval
+    while run.status not in TERMINAL_RUN_STATUSES:
+        remaining: float = deadline - loop.time()
+        if remaining <= 0:
+            await cancel_run_async(client, run)
+            raise AssistantRunError(
+                run, f"Run {run.id} did not complete within {deadline_seconds}s"
+            )
+        await asyncio.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+        async with limiter:
+            response = await client.beta.threads.runs.with_raw_response.retrieve(
+                thread_id=run.thread_id, run_id=run.id
+            )
+        poll_interval_ms: str | None = response.headers.get("openai-poll-after-ms")
+        if poll_interval_ms is not None:
+            interval = min(int(poll_interval_ms) / 1000, max_interval)
+        run = response.parse()
+
+    if run.status == "completed":
+        return run
+    if run.status == "requires_action":
+        await cancel_run_async(client, run)
+        raise AssistantRunError(
+            run, f"Run {run.id} requires an action, which grading does not support"
+        )
+    raise AssistantRunError(run, run_error_message(run))
+
+
+async def cancel_run_async(client: AsyncOpenAI, run: Run) -> None:
+    """Cancels a run, ignoring errors since it may have ended in the meantime."""
+    try:
+        await client.beta.threads.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+    except Exception as e:
+        print(f"Error cancelling run {run.id}: {e}")
+
+
+async def call_assistant_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    assistant_id: str,
+    msg: str,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+    word_count: int | None = None,
+) -> str:
+    """Asynchronous counterpart of grading_engine.call_assistant."""
+    tokens: int = estimate_grading_tokens(word_count or len(msg.split()))
+    answer, run = await scheduler.call_async(
+        (await get_assistant_async(client, assistant_id)).model,
+        tokens,
+        lambda: run_assistant_async(
+            client, limiter, assistant_id, msg, deadline_seconds
+        ),
+        usage=lambda result: run_usage(result[1]),
+    )
+    usage_tally.record(assistant_id, run.usage)
+    return answer
+
+
+async def run_assistant_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    assistant_id: str,
+    msg: str,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+) -> tuple[str, Run]:
+    """Asynchronous counterpart of grading_engine.run_assistant."""
+    async with limiter:
+        run: Run = await without_retries(client).beta.threads.create_and_run(
+            assistant_id=assistant_id, thread=grading_thread(msg)
+        )
+    try:
+        run = await wait_for_run_async(client, limiter, run, deadline_seconds)
+        async with limiter:
+            msgs = await client.beta.threads.messages.list(
+                thread_id=run.thread_id, run_id=run.id
+            )
+        return msgs.data[0].content[0].text.value, run
+    finally:
+        schedule_thread_deletion(client, limiter, run.thread_id)
+
+
+# Thread deletions still running on the event loop, awaited by drain_thread_deletions
+_thread_deletions: set[asyncio.Task] = set()
+
+
+def schedule_thread_deletion(
+    client: AsyncOpenAI, limiter: asyncio.Semaphore, thread_id: str
+) -> None:
+    """Deletes a thread in a background task, so that grading does not wait for it."""
+
+    async def delete() -> None:
+        try:
+            async with limiter:
+                await client.beta.threads.delete(thread_id)
+        except Exception as e:
+            print(f"Error deleting thread {thread_id}: {e}")
+
+    task: asyncio.Task = asyncio.create_task(delete())
+    _thread_deletions.add(task)
+    task.add_done_callback(_thread_deletions.discard)
+
+
+async def drain_thread_deletions() -> None:
+    """Waits for the background thread deletions, which asyncio.run would otherwise cancel."""
+    while _thread_deletions:
+        await asyncio.gather(*_thread_deletions)
+
+
+async def grade_text_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    assistant_id: str,
+    msg: str,
+    force_regrade: bool = False,
+    word_count: int | None = None,
+) -> tuple[str, bool]:
+    """Asynchronous counterpart of grading_engine.grade_text."""
+    async with limiter:
+        fingerprint: str = await get_assistant_fingerprint_async(client, assistant_id)
+    key: str = assessment_cache_key(assistant_id, fingerprint, msg)
+    if not force_regrade:
+        cached: str | None = get_cached_assessment(key)
+        if cached is not None:
+            return cached, True
+    assessment: str = await call_assistant_async(
+        client, limiter, assistant_id, msg, word_count=word_count
+    )
+    put_cached_assessment(key, assessment)
+    return assessment, False
+
+
+async def grade_section_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    config: Configuration,
+    exam_key: str,
+    section: Submission,
+    on_section: SectionCallback | None = None,
+    force_regrade: bool = False,
+) -> SectionGrade:
+    """Grades a single section, capturing any error in the returned SectionGrade."""
+    try:
+        assessment, cached = await grade_text_async(
+            client,
+            limiter,
+            section.get_assistant_id(config),
+            section.markdown_content,
+            force_regrade,
+            section.word_count,
+        )
+        parsed: Assessment | None = None
+        try:
+            parsed = await extract_assessment_async(client, assessment)
+        except Exception as e:
+            print(
+                f"Error extracting the assessment of {section.submission_type()} of {exam_key}: {e}"
+            )
+        result = SectionGrade(
+            exam_key=exam_key,
+            section=section,
+            assessment=assessment,
+            cached=cached,
+            parsed=parsed,
+        )
+    except Exception as e:
+        print(f"Error grading section {section.submission_type()} of {exam_key}: {e}")
+        result = SectionGrade(
+            exam_key=exam_key,
+            section=section,
+            assessment="Error grading section",
+            error=str(e),
+        )
+    if on_section is not None:
+        on_section(result)
+    return result
+
+
+async def process_exam_async(
+    client: AsyncOpenAI,
+    limiter: asyncio.Semaphore,
+    config: Configuration,
+    split_input: SplitInput,
+    on_section: SectionCallback | None = None,
+    split_cache: CacheStore | None = None,
+) -> ExamResult:
+    """Splits one paper and grades its sections as soon as the split is available."""
+    try:
+        mock_exam: MockExam = await split_mock_exam_async(
+            client, limiter, split_input, split_cache, config.split_mode
+        )
+    except Exception as e:
+        print(f"Error splitting mock exam {split_input.key}: {e}")
+        return ExamResult(key=split_input.key, error=str(e))
+    sections: list[SectionGrade] = await asyncio.gather(
+        *[
+            grade_section_async(
+                client, limiter, config, split_input.key, section, on_section
+            )
+            for section in exam_sections(mock_exam)
+        ]
+    )
+    return ExamResult(key=split_input.key, mock_exam=mock_exam, sections=sections)
+
+
+async def run_batch_async(
+    client: AsyncOpenAI,
+    config: Configuration,
+    split_inputs: list[SplitInput],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    on_section: SectionCallback | None = None,
+    split_cache: CacheStore | None = None,
+) -> list[ExamResult]:
+    """
+    Splits and grades a whole batch of papers on one event loop.
+
+    Args:
+        client: Asynchronous OpenAI client.
+        config: Configuration holding the assistant IDs.
+        split_inputs: The papers to split and grade.
+        max_in_flight (int): Maximum number of OpenAI requests in flight at the same time.
+        on_section: Optional callback invoked on the event loop as each section is graded.
+        split_cache: Optional cache of split results, looked up synchronously on the event loop.
+
+    Returns:
+        list[ExamResult]: One result per paper, in the order of split_inputs.
+    """
+    limiter = asyncio.Semaphore(max(1, max_in_flight))
+    return await asyncio.gather(
+        *[
+            process_exam_async(
+                client, limiter, config, split_input, on_section, split_cache
+            )
+            for split_input in split_inputs
+        ]
+    )
+
+
+async def grade_exams_async(
+    client: AsyncOpenAI,
+    config: Configuration,
+    exams: dict[str, MockExam],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    on_section: SectionCallback | None = None,
+    force_regrade: bool = False,
+) -> list[SectionGrade]:
+    """Grades the sections of already split mock exams on one event loop."""
+    limiter = asyncio.Semaphore(max(1, max_in_flight))
+    return await asyncio.gather(
+        *[
+            grade_section_async(
+                client, limiter, config, exam_key, section, on_section, force_regrade
+            )
+            for exam_key, exam in exams.items()
+            for section in exam_sections(exam)
+        ]
+    )
+
+
+def run_batch(
+    client: OpenAI,
+    config: Configuration,
+    split_inputs: list[SplitInput],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    on_section: SectionCallback | None = None,
+    split_cache: CacheStore | None = None,
+) -> list[ExamResult]:
+    """Synchronous wrapper around run_batch_async for Streamlit pages and scripts."""
+
+    async def run() -> list[ExamResult]:
+        async with make_async_client(client) as async_client:
+            try:
+                return await run_batch_async(
+                    async_client,
+                    config,
+                    split_inputs,
+                    max_in_flight,
+                    on_section,
+                    split_cache,
+                )
+            finally:
+                await drain_thread_deletions()
+
+    return asyncio.run(run())
+
+
+def grade_exams(
+    client: OpenAI,
+    config: Configuration,
+    exams: dict[str, MockExam],
+    max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+    on_section: SectionCallback | None = None,
+    force_regrade: bool = False,
+) -> list[SectionGrade]:
+    """Synchronous wrapper around grade_exams_async for Streamlit pages and scripts."""
+
+    async def run() -> list[SectionGrade]:
+        async with make_async_client(client) as async_client:
+            try:
+                return await grade_exams_async(
+                    async_client,
+                    config,
+                    exams,
+                    max_in_flight,
+                    on_section,
+                    force_regrade,
+                )
+            finally:
+                await drain_thread_deletions()
+
+    return asyncio.run(run())
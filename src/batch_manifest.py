@@ -0,0 +1,232 @@
+from datetime import datetime
+from typing import Any, Optional
+from googleapiclient.discovery import Resource
+from pydantic import BaseModel, Field, PrivateAttr
+
+from gdrive import (
+    get_gdrive_file_id,
+    read_json_from_drive,
+    store_pydantic_to_drive,
+    update_pydantic_on_drive,
+)
+
+# Processing stages of a submission, in order
+STAGES: tuple[str, ...] = ("converted", "split", "graded", "docx", "emailed")
+
+
+def manifest_file_name(batch_name: str) -> str:
+    """Returns the name of the manifest file stored in the batch folder."""
+    return f"{batch_name} - manifest.json"
+
+
+class SubmissionState(BaseModel):
+    """Processing state of one submission of a batch."""
+
+    key: str = Field(
+        ..., description="Name of the submission's Markdown file in the batch folder"
+    )
+    stage: Optional[str] = Field(
+        None, description="Last completed stage, one of STAGES, None if not started"
+    )
+    source_file_id: Optional[str] = Field(
+        None, description="Google Drive file ID of the original submission"
+    )
+    markdown_file_id: Optional[str] = Field(
+        None, description="Google Drive file ID of the converted Markdown file"
+    )
+    section_file_ids: dict[str, str] = Field(
+        {}, description="Google Drive file IDs of the section files, by section type"
+    )
+    exam_metadata: Optional[dict[str, Any]] = Field(
+        None,
+        description="Split mock exam without its Markdown contents, to rebuild it from the section files",
+    )
+    assessment_file_id: Optional[str] = Field(
+        None, description="Google Drive file ID of the full Markdown assessment"
+    )
+    docx_file_id: Optional[str] = Field(
+        None, description="Google Drive file ID of the docx assessment"
+    )
+    error: Optional[str] = Field(
+        None, description="Error raised by the last failed stage, if any"
+    )
+    updated: datetime = Field(
+        default_factory=datetime.now, description="Time of the last update"
+    )
+
+    def has_completed(self, stage: str) -> bool:
+        """Returns True if the submission went through the given stage."""
+        return self.stage is not None and STAGES.index(self.stage) >= STAGES.index(
+            stage
+        )
+
+    def next_stage(self) -> str | None:
+        """Returns the next stage to run, or None if the submission is fully processed."""
+        if self.stage is None:
+            return STAGES[0]
+        index: int = STAGES.index(self.stage) + 1
+        return STAGES[index] if index < len(STAGES) else None
+
+
+class BatchManifest(BaseModel):
+    """
+    Persisted record of which submissions of a batch went through which stages.
+
+    The manifest is saved as JSON in the batch folder after every stage, so that a crashed or
+    redeployed session can resume the batch by re-running only the missing stages.  The page and
+    the grading workers each keep their own copy, so every save first merges the copy saved by
+    the others: the most recently updated state of each submission wins.
+    """
+
+    batch_name: str = Field(..., description="Name of the batch")
+    batch_dir_id: str = Field(..., description="Google Drive folder ID of the batch")
+    manifest_file_id: Optional[str] = Field(
+        None, description="Google Drive file ID of the manifest itself"
+    )
+    submissions: dict[str, SubmissionState] = Field(
+        {}, description="State of each submission, keyed by Markdown file name"
+    )
+    openai_batches: dict[str, str] = Field(
+        {},
+        description="IDs of the OpenAI Batch API jobs not collected yet, by stage",
+    )
+    # OpenAI Batch API jobs as last loaded or saved, to tell the ones changed by this copy
+    _saved_openai_batches: dict[str, str] = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def load_from_drive(
+        cls, drive_service: Resource, batch_dir_id: str, batch_name: str
+    ) -> "BatchManifest":
+        """Loads the manifest of a batch, or starts an empty one if there is none."""
+        # Not from the folder index: an empty manifest would replace one it misses when saved
+        file_id: str | None = get_gdrive_file_id(
+            drive_service, batch_dir_id, manifest_file_name(batch_name), use_index=False
+        )
+        if file_id is not None:
+            data: Any | None = read_json_from_drive(drive_service, file_id)
+            if data is not None:
+                manifest: BatchManifest = cls(**data)
+                manifest.manifest_file_id = file_id
+                manifest._saved_openai_batches = dict(manifest.openai_batches)
+                return manifest
+        print(f"No manifest found for batch {batch_name}, starting a new one.")
+        return cls(batch_name=batch_name, batch_dir_id=batch_dir_id)
+
+    def merge(self, saved: "BatchManifest") -> None:
+        """
+        Merges the manifest saved by another process into this one.
+
+        Submissions take the most recently updated of the two states.  OpenAI Batch API jobs take
+        the saved value, unless this copy submitted or collected the job since it was loaded.
+        """
+        for key, state in saved.submissions.items():
+            mine: SubmissionState | None = self.submissions.get(key)
+            if mine is None or state.updated > mine.updated:
+                self.submissions[key] = state
+        openai_batches: dict[str, str] = dict(saved.openai_batches)
+        for stage in set(self.openai_batches) | set(self._saved_openai_batches):
+            if self.openai_batches.get(stage) == self._saved_openai_batches.get(stage):
+                continue
+            if stage in self.openai_batches:
+                openai_batches[stage] = self.openai_batches[stage]
+            else:
+                openai_batches.pop(stage, None)
+        self.openai_batches = openai_batches
+
+    def save_to_drive(self, drive_service: Resource) -> bool:
+        """Saves the manifest, updating its file in place once it exists."""
+        if self.manifest_file_id is None:
+            # Another process may have saved the first manifest of the batch since it was loaded
+            self.manifest_file_id = get_gdrive_file_id(
+                drive_service,
+                self.batch_dir_id,
+                manifest_file_name(self.batch_name),
+                use_index=False,
+            )
+        if self.manifest_file_id is None:
+            self._saved_openai_batches = dict(self.openai_batches)
+            if not store_pydantic_to_drive(
+                drive_service,
+                self,
+                self.batch_dir_id,
+                manifest_file_name(self.batch_name),
+            ):
+                return False
+            self.manifest_file_id = get_gdrive_file_id(
+                drive_service,
+                self.batch_dir_id,
+                manifest_file_name(self.batch_name),
+                use_index=False,
+            )
+            return True
+        # Read right before writing, so that the updates of the other processes are kept
+        data: Any | None = read_json_from_drive(drive_service, self.manifest_file_id)
+        if data is not None:
+            self.merge(BatchManifest(**data))
+        self._saved_openai_batches = dict(self.openai_batches)
+        if not update_pydantic_on_drive(drive_service, self, self.manifest_file_id):
+            print(f"❌ Error saving manifest of batch {self.batch_name}")
+            return False
+        return True
+
+    def state(self, key: str) -> SubmissionState:
+        """Returns the state of a submission, adding it to the manifest if needed."""
+        if key not in self.submissions:
+            self.submissions[key] = SubmissionState(key=key)
+        return self.submissions[key]
+
+    def record(
+        self,
+        drive_service: Resource | None,
+        key: str,
+        stage: str,
+        **updates: Any,
+    ) -> SubmissionState:
+        """
+        Records that a submission completed a stage and checkpoints the manifest.
+
+        Args:
+            drive_service: Drive service used to save the manifest, or None to defer saving.
+            key (str): The submission's Markdown file name.
+            stage (str): The completed stage, one of STAGES.
+            updates: SubmissionState fields to set, e.g. markdown_file_id.
+
+        Returns:
+            SubmissionState: The updated state.
+        """
+        state: SubmissionState = self.state(key)
+        for name, value in updates.items():
+            setattr(state, name, value)
+        # Re-running an earlier stage, e.g. a new split, invalidates the later ones
+        state.stage = stage
+        state.error = None
+        state.updated = datetime.now()
+        if drive_service is not None:
+            self.save_to_drive(drive_service)
+        return state
+
+    def record_error(
+        self, drive_service: Resource | None, key: str, error: str
+    ) -> SubmissionState:
+        """Records the error of a failed stage without changing the completed stage."""
+        state: SubmissionState = self.state(key)
+        state.error = error
+        state.updated = datetime.now()
+        if drive_service is not None:
+            self.save_to_drive(drive_service)
+        return state
+
+    def pending(self, stage: str) -> list[str]:
+        """Returns the submissions whose next stage is the given stage."""
+        return [
+            key
+            for key, state in self.submissions.items()
+            if state.next_stage() == stage
+        ]
+
+    def summary(self) -> dict[str, int]:
+        """Returns the number of submissions at each completed stage."""
+        counts: dict[str, int] = {"not started": 0} | {stage: 0 for stage in STAGES}
+        for state in self.submissions.values():
+            counts[state.stage or "not started"] += 1
+        return counts
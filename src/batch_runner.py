@@ -0,0 +1,569 @@
+"""
+Runs the mock exam grading pipeline over a whole batch without a browser session.
+
+Every submission goes through convert, split, grade, docx and email, starting from the last stage
+recorded in the batch manifest, so an interrupted run can simply be started again.  The script
+reads the same .streamlit/secrets.toml as the app, e.g. from the src directory:
+
+    python batch_runner.py --batch "Mock exam 3" --convert "*Dupont*" --concurrency 8
+    python batch_runner.py --dry-run
+
+With --offline, the papers are split and graded by OpenAI Batch API jobs, at half the price but
+within 24 hours, and the results are then processed like interactive ones.  The IDs of the jobs
+are kept in the manifest, so an interrupted run collects them instead of submitting them again.
+Sections the Batch API failed to grade are graded interactively.
+
+    python batch_runner.py --batch "Mock exam 3" --offline
+"""
+
+import argparse
+import fnmatch
+from typing import Any, Callable, Iterable
+import streamlit as st
+from googleapiclient.discovery import Resource
+from openai import OpenAI
+from openai.types.beta.assistant import Assistant
+
+from assessment_cache import (
+    assessment_cache_key,
+    assistant_fingerprint,
+    get_cached_assessment,
+)
+from async_pipeline import SplitInput
+from batch_manifest import STAGES, BatchManifest, SubmissionState
+from cache_store import CacheStore, get_cache_store
+from error_aggregate import BatchErrorAggregate
+from excel_writer import BatchWorkbookWriter
+from conversion_service import convert_gdrive_files_to_markdown
+from exam_loader import exam_metadata
+from exam_splitter import (
+    SPLIT_CACHE_NAMESPACE,
+    get_cached_split,
+    put_cached_split,
+    split_cache_key,
+)
+from gaclasses import Assessment, Configuration, MockExam
+from gdrive import (
+    get_gdrive_file_creation_date,
+    get_gdrive_file_id,
+    get_gdrive_markdown_text,
+    iter_gdrive_files,
+    list_gdrive_files,
+    upload_markdowns_to_gdrive,
+)
+from grading_assistant import init
+from grading_engine import exam_sections, grade_sections
+from mock_exam_grading_page import (
+    ensure_batch_directory,
+    filter_md_files,
+    get_mock_exam,
+    grade_section,
+    make_full_assessment,
+    collect_section_assessment,
+    mock_exam_assessment_file_name,
+    save_mock_exam_assessment,
+    upload_exam_assessments,
+    write_mock_exam_sections,
+)
+from section_splitter import split_mock_exam_locally
+from prompt_usage import PromptUsage, usage_report, usage_tally
+from openai_batch import (
+    batch_results,
+    completion_text,
+    grade_custom_id,
+    grade_request,
+    parse_grade_custom_id,
+    parse_split_result,
+    split_custom_id,
+    split_request,
+    submit_batch,
+    wait_for_batch,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Convert, split, grade and email the mock exams of a batch."
+    )
+    parser.add_argument(
+        "--batch",
+        help="Name of the batch folder, defaults to the current batch of the configuration.",
+    )
+    parser.add_argument(
+        "--convert",
+        nargs="*",
+        default=[],
+        metavar="PATTERN",
+        help="Convert the Attachments submissions whose names match these patterns into the batch.",
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of sections graded at the same time, defaults to the configuration's.",
+    )
+    parser.add_argument(
+        "--conversion-workers",
+        type=int,
+        help="Number of pandoc conversions run at the same time, defaults to the configuration's.",
+    )
+    parser.add_argument(
+        "--force-regrade",
+        action="store_true",
+        help="Grade again even the sections with a recent cached assessment.",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Split and grade with OpenAI Batch API jobs, which are cheaper but take up to 24 hours.",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Only print what would be done, without calling OpenAI or writing to Google Drive.",
+    )
+    return parser.parse_args()
+
+
+def convert_submissions(
+    drive_service: Resource,
+    batch_dir_id: str,
+    manifest: BatchManifest,
+    patterns: list[str],
+    max_workers: int,
+    dry_run: bool,
+) -> None:
+    """Converts the Attachments submissions matching the patterns and records them as converted."""
+    submissions: dict[str, str] = {
+        name: file_id
+        for name, file_id in iter_gdrive_files(
+            drive_service, st.session_state.attachments_folder_id
+        )
+        if any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+    }
+    print(f"Converting {len(submissions)} submission(s): {list(submissions)}")
+    if dry_run or not submissions:
+        return
+    for result in convert_gdrive_files_to_markdown(
+        drive_service, submissions, batch_dir_id, max_workers=max_workers
+    ):
+        if result.error is not None:
+            print(f"❌ Error converting {result.file_name}: {result.error}")
+            continue
+        manifest.record(
+            drive_service,
+            f"{result.file_name.rsplit('.', 1)[0]}.md",
+            "converted",
+            source_file_id=result.file_id,
+            markdown_file_id=result.markdown_file_id,
+        )
+
+
+def register_markdown_files(
+    drive_service: Resource, batch_dir_id: str, manifest: BatchManifest, dry_run: bool
+) -> None:
+    """Records the Markdown files added to the batch folder outside of the pipeline as converted."""
+    md_files: dict[str, str] = filter_md_files(
+        list_gdrive_files(drive_service, batch_dir_id, tuple(["md"]))
+    )
+    for md_file, md_file_id in md_files.items():
+        if md_file in manifest.submissions:
+            continue
+        print(f"Found unrecorded Markdown file {md_file}.")
+        if not dry_run:
+            manifest.record(None, md_file, "converted", markdown_file_id=md_file_id)
+    if not dry_run:
+        manifest.save_to_drive(drive_service)
+
+
+def split_submissions(
+    drive_service: Resource,
+    batch_dir_id: str,
+    manifest: BatchManifest,
+    keys: Iterable[str] | None = None,
+    on_progress: Callable[[str], None] = print,
+) -> dict[str, MockExam]:
+    """Splits the submissions that need it and returns the mock exams still to be finished."""
+    usage_before: dict[str, PromptUsage] = usage_tally.snapshot()
+    exams: dict[str, MockExam] = {}
+    selected: set[str] | None = None if keys is None else set(keys)
+    for key, state in manifest.submissions.items():
+        if selected is not None and key not in selected:
+            continue
+        if state.stage is None or state.next_stage() is None:
+            continue
+        on_progress(f"Splitting {key}...")
+        exam: MockExam | None = get_mock_exam(
+            drive_service, batch_dir_id, manifest, key
+        )
+        if exam is None:
+            manifest.record_error(drive_service, key, "Error splitting")
+            continue
+        if not state.has_completed("split"):
+            section_file_ids: dict[str, str] | None = write_mock_exam_sections(
+                drive_service, batch_dir_id, key, exam
+            )
+            if section_file_ids is None:
+                manifest.record_error(drive_service, key, "Error writing sections")
+                continue
+            manifest.record(
+                drive_service,
+                key,
+                "split",
+                section_file_ids=section_file_ids,
+                exam_metadata=exam_metadata(exam),
+            )
+        exams[key] = exam
+    on_progress(
+        f"Split prompt caching: {usage_report(usage_tally.since(usage_before))}"
+    )
+    return exams
+
+
+def run_batch_job(
+    drive_service: Resource,
+    manifest: BatchManifest,
+    stage: str,
+    requests: list[dict[str, Any]],
+    on_progress: Callable[[str], None] = print,
+) -> dict[str, dict[str, Any] | str]:
+    """
+    Runs the Batch API job of a stage and returns its results by custom ID.
+
+    The job ID is recorded in the manifest until its results are collected, so an interrupted run
+    waits for the job it submitted instead of submitting the requests again.
+    """
+    client: OpenAI = st.session_state.openai_client
+    batch_id: str | None = manifest.openai_batches.get(stage)
+    if batch_id is None:
+        if not requests:
+            return {}
+        batch_id = submit_batch(client, requests, f"{manifest.batch_name} - {stage}").id
+        manifest.openai_batches[stage] = batch_id
+        manifest.save_to_drive(drive_service)
+    else:
+        on_progress(f"Collecting the {stage} batch {batch_id} submitted earlier...")
+    results: dict[str, dict[str, Any] | str] = batch_results(
+        client, wait_for_batch(client, batch_id, on_progress=on_progress)
+    )
+    del manifest.openai_batches[stage]
+    manifest.save_to_drive(drive_service)
+    return results
+
+
+def split_submissions_offline(
+    drive_service: Resource,
+    manifest: BatchManifest,
+    config: Configuration,
+    on_progress: Callable[[str], None] = print,
+) -> None:
+    """
+    Splits the submissions that need it with a Batch API job.
+
+    The mock exams are put in the session and the split cache, where split_submissions then
+    picks them up.  Papers the job failed to split are split interactively.
+    """
+    cache: CacheStore | None = get_cache_store(SPLIT_CACHE_NAMESPACE)
+    inputs: dict[str, SplitInput] = {}
+    for key in manifest.pending("split"):
+        state: SubmissionState = manifest.state(key)
+        if state.markdown_file_id is None or key in st.session_state.mock_exams:
+            continue
+        md_text: str | None = get_gdrive_markdown_text(
+            drive_service, state.markdown_file_id
+        )
+        if md_text is None or (
+            get_cached_split(
+                cache,
+                split_cache_key(md_text, mode=config.split_mode),
+                state.markdown_file_id,
+                key,
+            )
+            is not None
+        ):
+            continue
+        file_date: str | None = get_gdrive_file_creation_date(
+            drive_service, state.markdown_file_id
+        )
+        local: MockExam | None = split_mock_exam_locally(
+            md_text, state.markdown_file_id, key, file_date
+        )
+        if local is not None:
+            st.session_state.mock_exams[key] = local
+            continue
+        inputs[key] = SplitInput(
+            key=key,
+            md_text=md_text,
+            file_id=state.markdown_file_id,
+            file_name=key,
+            file_date=file_date,
+        )
+    on_progress(f"Splitting {len(inputs)} paper(s) with the Batch API...")
+    results: dict[str, dict[str, Any] | str] = run_batch_job(
+        drive_service,
+        manifest,
+        "split",
+        [
+            split_request(split_input, config.split_mode)
+            for split_input in inputs.values()
+        ],
+        on_progress,
+    )
+    for key, split_input in inputs.items():
+        result: dict[str, Any] | str | None = results.get(split_custom_id(key))
+        try:
+            if not isinstance(result, dict):
+                raise ValueError(result or "no result")
+            exam: MockExam = parse_split_result(result, split_input, config.split_mode)
+        except Exception as e:
+            on_progress(
+                f"❌ Batch split of {key} failed, splitting it interactively: {e}"
+            )
+            continue
+        put_cached_split(
+            cache, split_cache_key(split_input.md_text, mode=config.split_mode), exam
+        )
+        st.session_state.mock_exams[key] = exam
+
+
+def grade_exams_offline(
+    drive_service: Resource,
+    manifest: BatchManifest,
+    exams: dict[str, MockExam],
+    config: Configuration,
+    force_regrade: bool,
+    on_progress: Callable[[str], None] = print,
+) -> dict[tuple[str, str], str]:
+    """
+    Grades the sections of the split mock exams with a Batch API job.
+
+    The Batch API does not run assistants, so each section is graded by a chat completion with
+    the model and instructions of its assistant.  These assessments are not put in the assessment
+    cache, which holds the assistants' own; they are returned for grade_exams, which grades
+    interactively the sections the job failed to grade.
+
+    Returns:
+        dict[tuple[str, str], str]: The assessments of the job by exam key and section type.
+    """
+    client: OpenAI = st.session_state.openai_client
+    assistants: dict[str, Assistant] = {}
+    custom_ids: list[str] = []
+    requests: list[dict[str, Any]] = []
+    for key, exam in exams.items():
+        if manifest.state(key).has_completed("graded"):
+            continue
+        for section in exam_sections(exam):
+            assistant_id: str = section.get_assistant_id(config)
+            if assistant_id not in assistants:
+                assistants[assistant_id] = client.beta.assistants.retrieve(assistant_id)
+            cache_key: str = assessment_cache_key(
+                assistant_id,
+                assistant_fingerprint(assistants[assistant_id]),
+                section.markdown_content,
+            )
+            if not force_regrade and get_cached_assessment(cache_key) is not None:
+                continue
+            custom_ids.append(grade_custom_id(key, section.submission_type()))
+            requests.append(grade_request(key, section, assistants[assistant_id]))
+    on_progress(f"Grading {len(requests)} section(s) with the Batch API...")
+    results: dict[str, dict[str, Any] | str] = run_batch_job(
+        drive_service, manifest, "grade", requests, on_progress
+    )
+    assessments: dict[tuple[str, str], str] = {}
+    for custom_id in custom_ids:
+        result: dict[str, Any] | str | None = results.get(custom_id)
+        if isinstance(result, dict):
+            assessments[parse_grade_custom_id(custom_id)] = completion_text(result)
+        else:
+            on_progress(
+                f"❌ Batch grading of {custom_id} failed, grading it interactively: {result or 'no result'}"
+            )
+    return assessments
+
+
+def grade_exams(
+    drive_service: Resource,
+    batch_dir_id: str,
+    manifest: BatchManifest,
+    exams: dict[str, MockExam],
+    config: Configuration,
+    force_regrade: bool,
+    on_progress: Callable[[str], None] = print,
+    batch_assessments: dict[tuple[str, str], str] | None = None,
+) -> None:
+    """
+    Grades the sections of the split mock exams and uploads their full assessments.
+
+    The sections with one of the batch_assessments written by grade_exams_offline are not graded
+    again.
+    """
+    to_grade: dict[str, MockExam] = {
+        key: exam
+        for key, exam in exams.items()
+        if not manifest.state(key).has_completed("graded")
+    }
+    if not to_grade:
+        return
+    on_progress(
+        f"Grading {len(to_grade)} mock exam(s), {config.grading_concurrency} sections at a time..."
+    )
+    assessments: dict[str, dict[str, str]] = {key: {} for key in to_grade}
+    parsed: dict[str, dict[str, Assessment]] = {key: {} for key in to_grade}
+    failed_exams: set[str] = set()
+    ndone: int = 0
+    usage_before: dict[str, PromptUsage] = usage_tally.snapshot()
+    workbook = BatchWorkbookWriter(drive_service, batch_dir_id, manifest.batch_name)
+    # Reload the error totals, the page and other workers may have updated them
+    aggregate: BatchErrorAggregate = BatchErrorAggregate.load_from_drive(
+        drive_service, batch_dir_id, manifest.batch_name
+    )
+    for section_grade in grade_sections(
+        st.session_state.openai_client,
+        config,
+        to_grade,
+        max_workers=config.grading_concurrency,
+        force_regrade=force_regrade,
+        batch_assessments=batch_assessments,
+    ):
+        section_type: str = section_grade.section.submission_type()
+        ndone += 1
+        on_progress(
+            f"Graded {ndone}/{3 * len(to_grade)} sections ({section_type} of {section_grade.exam_key}"
+            f"{', by the Batch API' if section_grade.batch_graded else ''})."
+        )
+        if section_grade.error is not None:
+            failed_exams.add(section_grade.exam_key)
+            manifest.record_error(
+                None, section_grade.exam_key, f"{section_type}: {section_grade.error}"
+            )
+        assessments[section_grade.exam_key][section_type] = grade_section(section_grade)
+        collect_section_assessment(
+            workbook,
+            aggregate,
+            manifest.batch_name,
+            to_grade[section_grade.exam_key],
+            section_grade,
+            parsed,
+        )
+    on_progress(
+        f"Grading prompt caching: {usage_report(usage_tally.since(usage_before))}"
+    )
+    workbook.flush()
+    aggregate.save_to_drive(drive_service)
+    upload_exam_assessments(drive_service, batch_dir_id, to_grade)
+    graded: dict[str, MockExam] = {
+        key: exam for key, exam in to_grade.items() if key not in failed_exams
+    }
+    assessment_file_ids: dict[str, str | None] = upload_markdowns_to_gdrive(
+        drive_service,
+        batch_dir_id,
+        {
+            mock_exam_assessment_file_name(exam): make_full_assessment(
+                exam, assessments[key]
+            )
+            for key, exam in graded.items()
+        },
+    )
+    for key, exam in graded.items():
+        assessment_file_id: str | None = assessment_file_ids[
+            mock_exam_assessment_file_name(exam)
+        ]
+        if assessment_file_id is None:
+            manifest.record_error(None, key, "Error uploading assessment")
+        else:
+            manifest.record(None, key, "graded", assessment_file_id=assessment_file_id)
+    manifest.save_to_drive(drive_service)
+
+
+def deliver_assessments(
+    drive_service: Resource,
+    batch_dir_id: str,
+    manifest: BatchManifest,
+    exams: dict[str, MockExam],
+    on_progress: Callable[[str], None] = print,
+) -> None:
+    """Converts the graded assessments to docx and emails them to the professor."""
+    for key, exam in exams.items():
+        state: SubmissionState = manifest.state(key)
+        if not state.has_completed("graded") or state.has_completed("emailed"):
+            continue
+        on_progress(f"Converting and emailing the assessment of {key}...")
+        save_mock_exam_assessment(
+            drive_service,
+            batch_dir_id,
+            exam,
+            mock_exam_assessment_file_name(exam),
+            state.assessment_file_id,
+            manifest,
+            key,
+        )
+
+
+def print_summary(manifest: BatchManifest) -> None:
+    print(f"Batch {manifest.batch_name}:")
+    for stage, count in manifest.summary().items():
+        print(f"  {stage}: {count}")
+    for key, state in manifest.submissions.items():
+        if state.error is not None:
+            print(f"  ❌ {key} (after {state.stage}): {state.error}")
+
+
+def main() -> None:
+    args: argparse.Namespace = parse_args()
+    init()
+    drive_service: Resource = st.session_state.drive_service
+    config: Configuration = st.session_state.config
+    if args.concurrency is not None:
+        config.grading_concurrency = args.concurrency
+    if args.conversion_workers is not None:
+        config.conversion_workers = args.conversion_workers
+    batch_name: str = args.batch or config.current_batch
+    # A dry run must not create the batch folder
+    batch_dir_id: str | None = (
+        get_gdrive_file_id(drive_service, st.session_state.output_folder_id, batch_name)
+        if args.dry_run
+        else ensure_batch_directory(drive_service, batch_name)
+    )
+    if batch_dir_id is None:
+        raise SystemExit(f"Batch directory {batch_name} not found!")
+    manifest: BatchManifest = BatchManifest.load_from_drive(
+        drive_service, batch_dir_id, batch_name
+    )
+    if args.convert:
+        convert_submissions(
+            drive_service,
+            batch_dir_id,
+            manifest,
+            args.convert,
+            config.conversion_workers,
+            args.dry_run,
+        )
+    register_markdown_files(drive_service, batch_dir_id, manifest, args.dry_run)
+    if args.dry_run:
+        for stage in STAGES[1:]:
+            print(f"Pending {stage}: {manifest.pending(stage)}")
+        return
+    if args.offline:
+        split_submissions_offline(drive_service, manifest, config)
+    exams: dict[str, MockExam] = split_submissions(
+        drive_service, batch_dir_id, manifest
+    )
+    batch_assessments: dict[tuple[str, str], str] | None = (
+        grade_exams_offline(drive_service, manifest, exams, config, args.force_regrade)
+        if args.offline
+        else None
+    )
+    grade_exams(
+        drive_service,
+        batch_dir_id,
+        manifest,
+        exams,
+        config,
+        args.force_regrade,
+        batch_assessments=batch_assessments,
+    )
+    deliver_assessments(drive_service, batch_dir_id, manifest, exams)
+    print_summary(manifest)
+
+
+if __name__ == "__main__":
+    main()
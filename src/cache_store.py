@@ -0,0 +1,240 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload
+import streamlit as st
+
+from gdrive import download_gdrive_file, ensure_gdrive_directory
+from gdrive_batch import file_name_query
+
+DEFAULT_CACHE_DIRECTORY: str = os.path.join(
+    os.path.expanduser("~"), ".cache", "grading-assistant"
+)
+CACHE_FOLDER_NAME: str = "cache"
+CACHE_BACKENDS: tuple[str, ...] = ("sqlite", "gdrive", "none")
+
+
+def content_hash(*parts: Any) -> str:
+    """Returns a SHA-256 hex digest of JSON-serializable parts, used as a cache key."""
+    payload: str = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CacheStore:
+    """A persistent key/value store for cached LLM results, with size-based eviction."""
+
+    def __init__(self, namespace: str, max_bytes: int) -> None:
+        self.namespace = namespace
+        self.max_bytes = max_bytes
+
+    def get(self, key: str) -> bytes | None:
+        """Returns the value stored under key, or None if it is not cached."""
+        raise NotImplementedError("Subclasses must implement get method")
+
+    def put(self, key: str, value: bytes) -> None:
+        """Stores value under key, evicting old entries if the store grows too large."""
+        raise NotImplementedError("Subclasses must implement put method")
+
+    def delete(self, key: str) -> None:
+        """Removes key from the store if present."""
+        raise NotImplementedError("Subclasses must implement delete method")
+
+
+class SQLiteCacheStore(CacheStore):
+    """Cache store backed by a local SQLite database, evicting least recently used entries."""
+
+    def __init__(self, namespace: str, max_bytes: int, path: str | None = None) -> None:
+        super().__init__(namespace, max_bytes)
+        if path is None:
+            os.makedirs(DEFAULT_CACHE_DIRECTORY, exist_ok=True)
+            path = os.path.join(DEFAULT_CACHE_DIRECTORY, "cache.sqlite")
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " namespace TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL,"
+                " size INTEGER NOT NULL, accessed REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?",
+                (time.time(), self.namespace, key),
+            )
+            return row[0]
+
+    def put(self, key: str, value: bytes) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (self.namespace, key, value, len(value), time.time()),
+            )
+            self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            )
+
+    def _evict(self) -> None:
+        """Deletes least recently used entries until the namespace fits in max_bytes."""
+        total: int = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM entries WHERE namespace = ?",
+            (self.namespace,),
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._connection.execute(
+            "SELECT key, size FROM entries WHERE namespace = ? ORDER BY accessed",
+            (self.namespace,),
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._connection.execute(
+                "DELETE FROM entries WHERE namespace = ? AND key = ?",
+                (self.namespace, key),
+            )
+            total -= size
+            print(f"🗑️ Evicted cache entry {self.namespace}/{key} ({size} bytes).")
+
+
+class GDriveCacheStore(CacheStore):
+    """
+    Cache store keeping one JSON file per entry in a Google Drive folder.
+
+    Drive does not record reads by the service account, so eviction removes the oldest written entries.
+    The Drive API client is not thread-safe: use this store from the Streamlit script thread only.
+    """
+
+    def __init__(
+        self, namespace: str, max_bytes: int, drive_service: Resource, folder_id: str
+    ) -> None:
+        super().__init__(namespace, max_bytes)
+        self.drive_service = drive_service
+        self.folder_id = folder_id
+
+    def _file_name(self, key: str) -> str:
+        return f"{self.namespace}-{key}.json"
+
+    def _find_file_id(self, key: str) -> str | None:
+        query: str = file_name_query(self.folder_id, self._file_name(key))
+        response = (
+            self.drive_service.files().list(q=query, fields="files(id)").execute()
+        )
+        files: list[dict[str, Any]] = response.get("files", [])
+        return files[0]["id"] if files else None
+
+    def get(self, key: str) -> bytes | None:
+        try:
+            file_id: str | None = self._find_file_id(key)
+            if file_id is None:
+                return None
+            file_data = download_gdrive_file(self.drive_service, file_id)
+            return None if file_data is None else file_data.getvalue()
+        except HttpError as e:
+            print(f"❌ Error reading cache entry {key} from Drive: {e}")
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        try:
+            self.delete(key)
+            file_metadata: dict[str, Any] = {
+                "name": self._file_name(key),
+                "parents": [self.folder_id],
+            }
+            media = MediaIoBaseUpload(io.BytesIO(value), mimetype="application/json")
+            self.drive_service.files().create(
+                body=file_metadata, media_body=media, fields="id"
+            ).execute()
+            self._evict()
+        except HttpError as e:
+            print(f"❌ Error writing cache entry {key} to Drive: {e}")
+
+    def delete(self, key: str) -> None:
+        file_id: str | None = self._find_file_id(key)
+        if file_id is not None:
+            self.drive_service.files().delete(fileId=file_id).execute()
+
+    def _evict(self) -> None:
+        """Deletes the oldest entries until the namespace fits in max_bytes."""
+        query: str = (
+            f"name contains '{self.namespace}-' and '{self.folder_id}' in parents and trashed = false"
+        )
+        entries: list[dict[str, Any]] = []
+        page_token: str | None = None
+        while True:
+            response = (
+                self.drive_service.files()
+                .list(
+                    q=query,
+                    fields="nextPageToken, files(id, name, size, modifiedTime)",
+                    orderBy="modifiedTime",
+                    pageSize=1000,
+                    pageToken=page_token,
+                )
+                .execute()
+            )
+            entries.extend(response.get("files", []))
+            page_token = response.get("nextPageToken")
+            if page_token is None:
+                break
+        total: int = sum(int(entry.get("size", 0)) for entry in entries)
+        for entry in entries:
+            if total <= self.max_bytes:
+                break
+            self.drive_service.files().delete(fileId=entry["id"]).execute()
+            total -= int(entry.get("size", 0))
+            print(f"🗑️ Evicted cache entry {entry['name']} from Drive.")
+
+
+def get_cache_store(namespace: str) -> CacheStore | None:
+    """
+    Returns the cache store configured for the current session, creating it on first use.
+
+    Args:
+        namespace (str): Name separating the kinds of cached results, e.g. "splits".
+
+    Returns:
+        CacheStore | None: The configured store, or None if caching is disabled.
+    """
+    config: Any = st.session_state.config
+    backend: str = config.cache_backend
+    session_key: str = f"cache_store_{backend}_{namespace}"
+    if session_key in st.session_state:
+        return st.session_state[session_key]
+    max_bytes: int = config.cache_max_megabytes * 1024 * 1024
+    store: CacheStore | None = None
+    if backend == "sqlite":
+        store = SQLiteCacheStore(namespace, max_bytes)
+    elif backend == "gdrive":
+        folder_id: str | None = ensure_gdrive_directory(
+            st.session_state.drive_service,
+            st.session_state.config_directory_id,
+            CACHE_FOLDER_NAME,
+        )
+        if folder_id is not None:
+            store = GDriveCacheStore(
+                namespace, max_bytes, st.session_state.drive_service, folder_id
+            )
+    st.session_state[session_key] = store
+    return store
@@ -1,4 +1,6 @@
 import streamlit as st
+from cache_store import CACHE_BACKENDS
+from exam_splitter import SPLIT_MODES
 from gaclasses import Configuration
 import unicodedata
 
@@ -74,6 +76,29 @@ def configuration_page() -> None:
             ),
         )
 
+    st.subheader("Grading")
+    config.grading_concurrency = st.slider(
+        "Sections graded concurrently", 1, 16, config.grading_concurrency
+    )
+
+    config.conversion_workers = st.slider(
+        "Documents converted concurrently", 1, 16, config.conversion_workers
+    )
+    config.cache_backend = st.selectbox(
+        "Cache for LLM results",
+        CACHE_BACKENDS,
+        index=CACHE_BACKENDS.index(config.cache_backend),
+    )
+    config.cache_max_megabytes = st.number_input(
+        "Maximum cache size (MB)", 1, 1000, config.cache_max_megabytes
+    )
+    config.split_mode = st.selectbox(
+        "Split mode",
+        SPLIT_MODES,
+        index=SPLIT_MODES.index(config.split_mode),
+        help="boundaries: the model only finds where the sections start, and they are cut from the paper.  full: the model writes the sections back, slower and costlier.",
+    )
+
     st.subheader("Current Batch")
     config.current_batch = st.text_input("Current Batch", config.current_batch)
     config.config_file_name = st.text_input(
@@ -0,0 +1,119 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from io import BytesIO
+from typing import Iterator
+from googleapiclient.discovery import Resource
+from pydantic import BaseModel, Field
+
+from gdrive import create_gdrive_markdown_file, download_gdrive_file
+from pandoc_convert import convert_to_markdown
+
+DEFAULT_CONVERSION_WORKERS: int = 4
+
+
+class ConversionResult(BaseModel):
+    """Outcome of converting one submission to Markdown in a batch."""
+
+    file_name: str = Field(..., description="Name of the original submission file")
+    file_id: str = Field(
+        ..., description="Google Drive file ID of the original submission"
+    )
+    markdown_file_id: str | None = Field(
+        None, description="Google Drive file ID of the Markdown file, None on error"
+    )
+    error: str | None = Field(
+        None, description="Error message if the conversion failed, None otherwise"
+    )
+
+
+def convert_gdrive_files_to_markdown(
+    drive_service: Resource,
+    files: dict[str, str],
+    output_folder_id: str,
+    max_workers: int = DEFAULT_CONVERSION_WORKERS,
+    header_markdown: str = "",
+) -> Iterator[ConversionResult]:
+    """
+    Converts many Google Drive submissions to Markdown, pipelining download, conversion and upload.
+
+    Each conversion runs in its own pandoc process, and up to max_workers of them run at once on
+    the worker threads, which only wait on pandoc's pipes.  Meanwhile the calling thread downloads
+    the next submissions and uploads the finished conversions, so network and CPU work overlap.
+    All the Drive calls stay on the calling thread because the Drive client is not thread-safe.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        files: Submissions to convert, as {file name: file ID}.
+        output_folder_id (str): The ID of the Google Drive folder to save the Markdown files.
+        max_workers (int): Maximum number of pandoc conversions running at the same time.
+        header_markdown (str): Additional Markdown content to prepend to each converted text.
+
+    Returns:
+        Iterator[ConversionResult]: One result per submission, in completion order.
+    """
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="pandoc"
+    ) as executor:
+        pending: dict[Future[str], tuple[str, str]] = {}
+
+        def finished(block: bool) -> Iterator[ConversionResult]:
+            """Uploads the conversions that are done, waiting for at least one if block is True."""
+            if not pending:
+                return
+            done, _ = wait(
+                pending, timeout=None if block else 0, return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                file_name, file_id = pending.pop(future)
+                yield upload_conversion(
+                    drive_service,
+                    file_name,
+                    file_id,
+                    future,
+                    output_folder_id,
+                    header_markdown,
+                )
+
+        for file_name, file_id in files.items():
+            # Do not download far ahead of the converters
+            while len(pending) >= 2 * max(1, max_workers):
+                yield from finished(block=True)
+            file_type: str = os.path.splitext(file_name)[1].lstrip(".")
+            file_data: BytesIO | None = download_gdrive_file(drive_service, file_id)
+            if file_data is None:
+                yield ConversionResult(
+                    file_name=file_name, file_id=file_id, error="Download failed"
+                )
+                continue
+            future: Future[str] = executor.submit(
+                convert_to_markdown, file_data.getvalue(), file_type
+            )
+            pending[future] = (file_name, file_id)
+            yield from finished(block=False)
+        while pending:
+            yield from finished(block=True)
+
+
+def upload_conversion(
+    drive_service: Resource,
+    file_name: str,
+    file_id: str,
+    future: Future[str],
+    output_folder_id: str,
+    header_markdown: str = "",
+) -> ConversionResult:
+    """Uploads the Markdown produced by a finished conversion."""
+    try:
+        converted_markdown: str = future.result()
+        markdown_file_id: str = create_gdrive_markdown_file(
+            drive_service,
+            f"{os.path.splitext(file_name)[0]}.md",
+            output_folder_id,
+            f"{header_markdown}\n\n{converted_markdown}",
+        )
+        return ConversionResult(
+            file_name=file_name, file_id=file_id, markdown_file_id=markdown_file_id
+        )
+    except Exception as e:
+        print(f"Error converting file {file_id} to Markdown: {e}")
+        return ConversionResult(file_name=file_name, file_id=file_id, error=str(e))
@@ -0,0 +1,176 @@
+from typing import Any, Optional
+import altair as alt
+import pandas as pd
+from googleapiclient.discovery import Resource
+from pydantic import BaseModel, Field, PrivateAttr
+
+from gdrive import (
+    get_gdrive_file_id,
+    read_json_from_drive,
+    store_pydantic_to_drive,
+    update_pydantic_on_drive,
+)
+
+
+def error_aggregate_file_name(batch_name: str) -> str:
+    """Returns the name of the error aggregate file stored in the batch folder."""
+    return f"{batch_name} - errors.json"
+
+
+class BatchErrorAggregate(BaseModel):
+    """
+    Running totals of the errors per type found in the papers of a batch.
+
+    The error counts of each section of each paper are kept alongside the totals, so that
+    regrading a section replaces its previous counts instead of adding to them.  The aggregate is
+    saved as JSON in the batch folder, so that the batch results are shown without downloading
+    any assessment.  The page, the grading workers and the batch runner each keep their own copy,
+    so every save first merges the copy saved by the others, keeping this copy's counts only for
+    the sections it updated.
+    """
+
+    batch_name: str = Field(..., description="Name of the batch")
+    batch_dir_id: str = Field(..., description="Google Drive folder ID of the batch")
+    file_id: Optional[str] = Field(
+        None, description="Google Drive file ID of the aggregate itself"
+    )
+    papers: dict[str, dict[str, dict[str, int]]] = Field(
+        {}, description="Error counts by paper, then section type, then error type"
+    )
+    section_totals: dict[str, dict[str, int]] = Field(
+        {}, description="Error counts of the batch by section type, then error type"
+    )
+    # Sections updated by this copy since it was last saved, as (paper, section type)
+    _updated_sections: set[tuple[str, str]] = PrivateAttr(default_factory=set)
+
+    @classmethod
+    def load_from_drive(
+        cls, drive_service: Resource, batch_dir_id: str, batch_name: str
+    ) -> "BatchErrorAggregate":
+        """Loads the error aggregate of a batch, or starts an empty one if there is none."""
+        file_id: str | None = get_gdrive_file_id(
+            drive_service,
+            batch_dir_id,
+            error_aggregate_file_name(batch_name),
+            use_index=False,
+        )
+        if file_id is not None:
+            data: Any | None = read_json_from_drive(drive_service, file_id)
+            if data is not None:
+                aggregate: BatchErrorAggregate = cls(**data)
+                aggregate.file_id = file_id
+                return aggregate
+        return cls(batch_name=batch_name, batch_dir_id=batch_dir_id)
+
+    def merge(self, saved: "BatchErrorAggregate") -> None:
+        """
+        Merges the aggregate saved by another process into this one.
+
+        The saved counts are kept except for the sections updated by this copy, and the totals
+        are computed again from the merged counts.
+        """
+        papers: dict[str, dict[str, dict[str, int]]] = {
+            key: dict(sections) for key, sections in saved.papers.items()
+        }
+        for key, section_type in self._updated_sections:
+            papers.setdefault(key, {})[section_type] = self.papers[key][section_type]
+        self.papers = papers
+        self.section_totals = {}
+        for sections in papers.values():
+            for section_type, error_distribution in sections.items():
+                totals: dict[str, int] = self.section_totals.setdefault(
+                    section_type, {}
+                )
+                for error_type, count in error_distribution.items():
+                    totals[error_type] = totals.get(error_type, 0) + count
+
+    def save_to_drive(self, drive_service: Resource) -> bool:
+        """Saves the aggregate, updating its file in place once it exists."""
+        file_name: str = error_aggregate_file_name(self.batch_name)
+        if self.file_id is None:
+            # Another process may have saved the first aggregate of the batch since it was loaded
+            self.file_id = get_gdrive_file_id(
+                drive_service, self.batch_dir_id, file_name, use_index=False
+            )
+        if self.file_id is None:
+            if not store_pydantic_to_drive(
+                drive_service, self, self.batch_dir_id, file_name
+            ):
+                return False
+            self.file_id = get_gdrive_file_id(
+                drive_service, self.batch_dir_id, file_name, use_index=False
+            )
+            self._updated_sections.clear()
+            return True
+        # Read right before writing, so that the counts saved by the other processes are kept
+        data: Any | None = read_json_from_drive(drive_service, self.file_id)
+        if data is not None:
+            self.merge(BatchErrorAggregate(**data))
+        if not update_pydantic_on_drive(drive_service, self, self.file_id):
+            return False
+        self._updated_sections.clear()
+        return True
+
+    def update(
+        self, key: str, section_type: str, error_distribution: dict[str, int]
+    ) -> None:
+        """Replaces the error counts of a section of a paper and adjusts the totals."""
+        previous: dict[str, int] = self.papers.setdefault(key, {}).get(section_type, {})
+        totals: dict[str, int] = self.section_totals.setdefault(section_type, {})
+        for error_type, count in previous.items():
+            totals[error_type] -= count
+            if totals[error_type] == 0:
+                del totals[error_type]
+        for error_type, count in error_distribution.items():
+            totals[error_type] = totals.get(error_type, 0) + count
+        self.papers[key][section_type] = dict(error_distribution)
+        self._updated_sections.add((key, section_type))
+
+    def totals(self) -> dict[str, int]:
+        """Returns the error counts of the whole batch by error type."""
+        totals: dict[str, int] = {}
+        for section_totals in self.section_totals.values():
+            for error_type, count in section_totals.items():
+                totals[error_type] = totals.get(error_type, 0) + count
+        return totals
+
+    def frame(self) -> pd.DataFrame:
+        """Returns the error counts of the batch as rows of section, error type and count."""
+        return pd.DataFrame(
+            [
+                {"section": section_type, "error_type": error_type, "count": count}
+                for section_type, totals in self.section_totals.items()
+                for error_type, count in totals.items()
+            ],
+            columns=["section", "error_type", "count"],
+        )
+
+
+def error_pie_chart(aggregate: BatchErrorAggregate) -> alt.Chart:
+    """Returns a pie chart of the errors of a batch by error type."""
+    data = pd.DataFrame(
+        list(aggregate.totals().items()), columns=["error_type", "count"]
+    )
+    return (
+        alt.Chart(data)
+        .mark_arc()
+        .encode(
+            theta=alt.Theta("count:Q"),
+            color=alt.Color("error_type:N", title="Error type"),
+            tooltip=["error_type", "count"],
+        )
+    )
+
+
+def error_section_chart(aggregate: BatchErrorAggregate) -> alt.Chart:
+    """Returns a bar chart of the errors of a batch by error type, stacked by section."""
+    return (
+        alt.Chart(aggregate.frame())
+        .mark_bar()
+        .encode(
+            x=alt.X("count:Q", title="Errors"),
+            y=alt.Y("error_type:N", title="Error type", sort="-x"),
+            color=alt.Color("section:N", title="Section"),
+            tooltip=["section", "error_type", "count"],
+        )
+    )
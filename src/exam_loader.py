@@ -0,0 +1,69 @@
+from typing import Any
+from googleapiclient.discovery import Resource
+
+from batch_manifest import SubmissionState
+from gaclasses import Essai, MockExam, Submission, Synthese, Traduction
+from gdrive import get_gdrive_markdown_text
+
+# MockExam section fields and their classes
+SECTION_CLASSES: dict[str, type[Submission]] = {
+    "synthese": Synthese,
+    "essai": Essai,
+    "traduction": Traduction,
+}
+
+
+def exam_metadata(exam: MockExam) -> dict[str, Any]:
+    """Returns a split mock exam without its Markdown contents, for the batch manifest."""
+    return exam.model_dump(
+        exclude={
+            "markdown_content": True,
+            **{field: {"markdown_content"} for field in SECTION_CLASSES},
+        }
+    )
+
+
+def can_load_mock_exam(state: SubmissionState) -> bool:
+    """Returns True if a mock exam can be rebuilt from its section files without splitting it again."""
+    return (
+        state.has_completed("split")
+        and state.exam_metadata is not None
+        and len(state.section_file_ids) == len(SECTION_CLASSES)
+    )
+
+
+def load_mock_exam(drive_service: Resource, state: SubmissionState) -> MockExam | None:
+    """
+    Rebuilds a split mock exam from the section files written to the batch folder.
+
+    The metadata recorded in the manifest at split time supplies everything but the Markdown
+    contents, which are downloaded from the section files and the converted submission.  This
+    replaces a split by the LLM in every new session.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        state (SubmissionState): The manifest record of a split submission.
+
+    Returns:
+        MockExam | None: The mock exam, or None if it cannot be rebuilt.
+    """
+    if not can_load_mock_exam(state):
+        return None
+    data: dict[str, Any] = dict(state.exam_metadata)
+    for field, section_class in SECTION_CLASSES.items():
+        section_type: str = section_class.submission_type()
+        markdown_content: str | None = get_gdrive_markdown_text(
+            drive_service, state.section_file_ids[section_type]
+        )
+        if markdown_content is None:
+            print(f"❌ Missing {section_type} section file of {state.key}.")
+            return None
+        data[field] = {**data[field], "markdown_content": markdown_content}
+    markdown_content: str | None = (
+        get_gdrive_markdown_text(drive_service, state.markdown_file_id)
+        if state.markdown_file_id is not None
+        else None
+    )
+    data["markdown_content"] = markdown_content or ""
+    print(f"Loaded mock exam {state.key} from its section files.")
+    return MockExam.model_validate(data)
@@ -0,0 +1,270 @@
+from typing import Any
+from openai import OpenAI
+from pydantic import BaseModel, Field
+
+from cache_store import CacheStore, content_hash
+from gaclasses import Essai, MockExam, Synthese, Traduction
+from prompt_usage import usage_tally
+from rate_limiter import estimate_split_tokens, scheduler, without_retries
+from section_splitter import (
+    build_mock_exam,
+    heading_section_type,
+    locate_line,
+    slice_sections,
+    split_mock_exam_locally,
+)
+
+SPLIT_MODEL: str = "gpt-4o-mini"
+SPLIT_CACHE_NAMESPACE: str = "splits"
+
+# The instructions are the same for every paper, so that they form a prefix the OpenAI prompt
+# cache can reuse; everything specific to the paper comes after them, in the user message.
+# OpenAI only caches prompts of at least prompt_usage.PROMPT_CACHE_MIN_TOKENS though: with its
+# short response format, the "boundaries" prefix stays under that threshold and is never cached,
+# so its cached ratio reads 0% until the instructions grow; the "full" schema alone exceeds it.
+SPLIT_PROMPT: str = """Analyze this student's mock exam in English for a French prépa and split it into three parts for the Synthèse, Essai, and Traduction.
+    The user message gives the original file ID, file name and date of the file, followed by the student's paper.
+    """
+BOUNDARIES_PROMPT: str = """Analyze this student's mock exam in English for a French prépa and find where its three parts, the Synthèse, Essai, and Traduction, start.
+    Do not rewrite the parts: for each one, copy its first line exactly as it is written in the paper, which is usually its heading.
+    The user message gives the original file ID, file name and date of the file, followed by the student's paper.
+    """
+SPLIT_FILE_PROMPT: str = """The original file ID is {file_id}.
+The original file name is {file_name}.
+The date of the file is {file_date}.
+
+"""
+
+
+class SplitBoundaries(BaseModel):
+    """Where the sections of a Mock Exam start, and its metadata, as found by the model."""
+
+    name: str = Field(
+        ...,
+        description="Name of the student if found or empty string.  Might be in the original file name.",
+    )
+    date: str = Field(
+        ...,
+        description="Date of submission formatted as YYYY-MM-DD or empty string if none found",
+    )
+    description: str = Field(..., description="Description of the submission")
+    synthese_start: str = Field(
+        ..., description="First line of the Synthèse section, copied exactly"
+    )
+    essai_start: str = Field(
+        ..., description="First line of the Essai section, copied exactly"
+    )
+    traduction_start: str = Field(
+        ..., description="First line of the Traduction section, copied exactly"
+    )
+
+
+# How the model splits a paper: "boundaries" only returns the first line of each section, which
+# is then sliced locally, "full" writes the text of each section back
+SPLIT_PROMPTS: dict[str, str] = {"boundaries": BOUNDARIES_PROMPT, "full": SPLIT_PROMPT}
+SPLIT_RESPONSE_FORMATS: dict[str, type[BaseModel]] = {
+    "boundaries": SplitBoundaries,
+    "full": MockExam,
+}
+SPLIT_MODES: tuple[str, ...] = tuple(SPLIT_PROMPTS)
+
+
+def make_split_messages(
+    md_text: str,
+    file_id: str,
+    file_name: str,
+    file_date: str | None,
+    mode: str = "full",
+) -> list[dict[str, str]]:
+    """
+    Builds the chat messages asking the model to split a mock exam into its sections.
+
+    The system message is the same for all the papers, and the file metadata goes with the
+    paper at the end of the prompt, so that requests share the longest possible cached prefix.
+    That prefix is only cached once it is at least prompt_usage.PROMPT_CACHE_MIN_TOKENS long.
+
+    Args:
+        md_text (str): Markdown text of the student's paper.
+        file_id (str): Google Drive file ID of the markdown file.
+        file_name (str): Name of the markdown file.
+        file_date (str | None): Creation date of the markdown file, if known.
+        mode (str): One of SPLIT_MODES.
+
+    Returns:
+        list[dict[str, str]]: The system and user messages for the split request.
+    """
+    file_prompt: str = SPLIT_FILE_PROMPT.format(
+        file_id=file_id,
+        file_name=file_name,
+        file_date=file_date or "unknown",
+    )
+    return [
+        {"role": "system", "content": SPLIT_PROMPTS[mode]},
+        {"role": "user", "content": file_prompt + md_text},
+    ]
+
+
+def split_cache_key(md_text: str, model: str = SPLIT_MODEL, mode: str = "full") -> str:
+    """
+    Returns the content address of a split result.
+
+    The key covers everything that determines the model's answer: the paper, the prompt, the model
+    and the response schema, so changing any of them naturally invalidates old entries.
+    """
+    return content_hash(
+        md_text,
+        SPLIT_PROMPTS[mode],
+        model,
+        SPLIT_RESPONSE_FORMATS[mode].model_json_schema(),
+    )
+
+
+def get_cached_split(
+    cache: CacheStore | None, key: str, file_id: str, file_name: str
+) -> MockExam | None:
+    """Returns a cached split for the paper, re-attached to the given markdown file."""
+    if cache is None:
+        return None
+    cached: bytes | None = cache.get(key)
+    if cached is None:
+        return None
+    try:
+        mock_exam: MockExam = MockExam.model_validate_json(cached)
+    except ValueError as e:
+        print(f"Ignoring invalid cached split {key}: {e}")
+        cache.delete(key)
+        return None
+    print(f"Using cached split {key} for {file_name}.")
+    # The same paper may have been converted again under another file ID or name
+    for submission in [
+        mock_exam,
+        mock_exam.synthese,
+        mock_exam.essai,
+        mock_exam.traduction,
+    ]:
+        submission.original_file = file_id
+        submission.original_file_name = file_name
+    return mock_exam
+
+
+def put_cached_split(cache: CacheStore | None, key: str, mock_exam: MockExam) -> None:
+    """Stores a split result in the cache, if there is one."""
+    if cache is not None:
+        cache.put(key, mock_exam.model_dump_json().encode("utf-8"))
+
+
+def completion_usage(completion: Any) -> int | None:
+    """Returns the total number of tokens used by a chat completion, if reported."""
+    return completion.usage.total_tokens if completion.usage is not None else None
+
+
+def mock_exam_from_boundaries(
+    md_text: str, boundaries: SplitBoundaries, file_id: str, file_name: str
+) -> MockExam | None:
+    """
+    Slices the sections of a paper at the first lines found by the model.
+
+    Returns None if a first line cannot be found in the paper, or two sections start on the same
+    line, in which case the paper must be split in full mode.
+    """
+    lines: list[str] = md_text.splitlines()
+    starts: dict[str, int | None] = {
+        Synthese.submission_type(): locate_line(lines, boundaries.synthese_start),
+        Essai.submission_type(): locate_line(lines, boundaries.essai_start),
+        Traduction.submission_type(): locate_line(lines, boundaries.traduction_start),
+    }
+    if None in starts.values() or len(set(starts.values())) < len(starts):
+        print(f"Section starts of {file_name} not found in the paper: {boundaries}")
+        return None
+    return build_mock_exam(
+        md_text,
+        slice_sections(
+            lines,
+            starts,
+            # Headings are left out of the sections, as when the model rewrites them
+            {
+                index
+                for section_type, index in starts.items()
+                if heading_section_type(lines[index]) == section_type
+            },
+        ),
+        boundaries.name,
+        boundaries.date,
+        file_id,
+        file_name,
+        boundaries.description,
+    )
+
+
+def parsed_split(
+    parsed: Any, mode: str, md_text: str, file_id: str, file_name: str
+) -> MockExam | None:
+    """Returns the mock exam of a split response of the given mode, None if it cannot be sliced."""
+    if mode == "boundaries":
+        return mock_exam_from_boundaries(md_text, parsed, file_id, file_name)
+    return parsed
+
+
+def request_split(
+    client: OpenAI,
+    md_text: str,
+    file_id: str,
+    file_name: str,
+    file_date: str | None,
+    mode: str,
+) -> MockExam | None:
+    """Asks the model to split a paper in the given mode, paced by the rate limit scheduler."""
+    response: Any = scheduler.call(
+        SPLIT_MODEL,
+        estimate_split_tokens(len(md_text.split()), rewrites_text=mode == "full"),
+        lambda: without_retries(client).beta.chat.completions.parse(
+            model=SPLIT_MODEL,
+            messages=make_split_messages(md_text, file_id, file_name, file_date, mode),
+            response_format=SPLIT_RESPONSE_FORMATS[mode],
+        ),
+        usage=completion_usage,
+    )
+    usage_tally.record(SPLIT_MODEL, response.usage)
+    return parsed_split(
+        response.choices[0].message.parsed, mode, md_text, file_id, file_name
+    )
+
+
+def split_mock_exam(
+    client: OpenAI,
+    md_text: str,
+    file_id: str,
+    file_name: str,
+    file_date: str | None,
+    cache: CacheStore | None = None,
+    mode: str = "boundaries",
+) -> MockExam:
+    """Splits a mock exam into its sections with the OpenAI structured output parse API.
+
+    If a cache is given, a paper that was already split with the same prompt, model and schema is
+    returned from the cache without calling the model.  The call is paced by the shared rate limit
+    scheduler, and retried if it is rate limited.  Papers whose section headings are clear are
+    split locally, and only the others are sent to the model.  In boundaries mode the model only
+    returns where the sections start and the sections are sliced from the paper, unless these
+    starts cannot be found in it, in which case the model splits the paper again in full mode.
+    """
+    local: MockExam | None = split_mock_exam_locally(
+        md_text, file_id, file_name, file_date
+    )
+    if local is not None:
+        return local
+    key: str = split_cache_key(md_text, mode=mode)
+    cached: MockExam | None = get_cached_split(cache, key, file_id, file_name)
+    if cached is not None:
+        return cached
+    mock_exam: MockExam | None = request_split(
+        client, md_text, file_id, file_name, file_date, mode
+    )
+    if mock_exam is None:
+        mock_exam = request_split(
+            client, md_text, file_id, file_name, file_date, "full"
+        )
+    if mock_exam is None:
+        raise ValueError(f"The model could not split {file_name}")
+    put_cached_split(cache, key, mock_exam)
+    return mock_exam
@@ -0,0 +1,243 @@
+import io
+import time
+from typing import Any
+import numpy as np
+import pandas as pd
+from googleapiclient.discovery import Resource
+from googleapiclient.http import MediaIoBaseUpload
+from openpyxl import Workbook, load_workbook
+from openpyxl.worksheet.worksheet import Worksheet
+
+from gdrive import download_gdrive_file, folder_index, get_gdrive_file_id
+from grade_table import SECTION_TYPES, TOTAL_COLUMN, GradeTable
+
+XLSX_MIME_TYPE: str = (
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+)
+GRADES_SHEET: str = "notes"
+ERRORS_SHEET: str = "erreurs"
+KEY_COLUMN: str = "Copie"
+NAME_COLUMN: str = "Nom"
+WORKBOOK_DEBOUNCE_SECONDS: float = 15.0
+
+
+def workbook_file_name(batch_name: str) -> str:
+    """Returns the name of the Excel workbook of a batch."""
+    return f"{batch_name} - notes.xlsx"
+
+
+def grade_row(table: GradeTable, key: str) -> dict[str, Any]:
+    """Returns the grades sheet row of a paper of a grade table."""
+    row = table.frame.loc[key]
+    values: dict[str, Any] = {
+        NAME_COLUMN: None if pd.isna(row["name"]) else row["name"]
+    }
+    for column in (*SECTION_TYPES, TOTAL_COLUMN):
+        # Ungraded sections are left empty rather than written as NaN
+        values[column] = None if np.isnan(row[column]) else round(float(row[column]), 2)
+    return values
+
+
+class BatchWorkbookWriter:
+    """
+    Keeps the Excel workbook of a batch up to date, one row per paper in each sheet.
+
+    The "notes" sheet holds the section grades and weighted total of each paper, and the
+    "erreurs" sheet its number of errors per error type.  Rows are upserted by paper, and columns
+    are added for new error types.  Updates are queued in memory and written in a single upload
+    once WORKBOOK_DEBOUNCE_SECONDS have passed since the first pending update (checked by
+    maybe_flush) or on flush.  The workbook stays loaded between uploads and is only downloaded
+    again if someone else changed it on Drive.  The Drive client is not thread-safe, so a writer
+    must stay on one thread.
+
+    Example:
+        with BatchWorkbookWriter(drive_service, batch_dir_id, batch_name) as writer:
+            for key in graded_papers:
+                writer.upsert_grades(key, grade_row(table, key))
+                writer.maybe_flush()
+    """
+
+    def __init__(
+        self,
+        drive_service: Resource,
+        batch_dir_id: str,
+        batch_name: str,
+        file_id: str | None = None,
+        debounce_seconds: float = WORKBOOK_DEBOUNCE_SECONDS,
+    ) -> None:
+        self.drive_service = drive_service
+        self.batch_dir_id = batch_dir_id
+        self.file_name = workbook_file_name(batch_name)
+        self.file_id = file_id
+        self.debounce_seconds = debounce_seconds
+        self._workbook: Workbook | None = None
+        self._version: str | None = None
+        self._pending: dict[str, dict[str, dict[str, Any]]] = {
+            GRADES_SHEET: {},
+            ERRORS_SHEET: {},
+        }
+        self._pending_since: float | None = None
+
+    def __enter__(self) -> "BatchWorkbookWriter":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.flush()
+
+    def upsert_grades(self, key: str, values: dict[str, Any]) -> None:
+        """Queues an update of the grades row of a paper, e.g. from grade_row."""
+        self._queue(GRADES_SHEET, key, values)
+
+    def upsert_errors(
+        self, key: str, name: str | None, error_distribution: dict[str, int]
+    ) -> None:
+        """
+        Queues the replacement of the error distribution row of a paper.
+
+        The error types missing from error_distribution are cleared, so that a regraded paper
+        does not keep the counts of errors it no longer has.
+        """
+        self._queue(
+            ERRORS_SHEET, key, {NAME_COLUMN: name, **error_distribution}, replace=True
+        )
+
+    def _queue(
+        self, sheet: str, key: str, values: dict[str, Any], replace: bool = False
+    ) -> None:
+        if replace:
+            self._pending[sheet][key] = dict(values)
+        else:
+            # Successive updates of the same paper are merged into one row write
+            self._pending[sheet].setdefault(key, {}).update(values)
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+
+    def maybe_flush(self) -> bool:
+        """Uploads the pending updates if the debounce window is over, returning True if it did."""
+        if (
+            self._pending_since is None
+            or time.monotonic() - self._pending_since < self.debounce_seconds
+        ):
+            return False
+        return self.flush()
+
+    def flush(self) -> bool:
+        """Writes the pending updates to the workbook and uploads it, returning True on success."""
+        if self._pending_since is None:
+            return True
+        try:
+            workbook: Workbook = self._load_workbook()
+            for sheet, rows in self._pending.items():
+                upsert_rows(workbook[sheet], rows, replace=sheet == ERRORS_SHEET)
+            output = io.BytesIO()
+            workbook.save(output)
+            self._upload(output)
+        except Exception as e:
+            # Keep the updates pending for the next flush, and reload the workbook then
+            print(f"❌ Error updating workbook {self.file_name}: {e}")
+            self._workbook = None
+            return False
+        print(
+            f"✅ Workbook {self.file_name} updated with {sum(len(rows) for rows in self._pending.values())} row(s)."
+        )
+        for rows in self._pending.values():
+            rows.clear()
+        self._pending_since = None
+        return True
+
+    def _load_workbook(self) -> Workbook:
+        """Returns the workbook, downloading it only if it is not loaded or changed on Drive."""
+        if self.file_id is None:
+            # Not from the folder index, which may miss a workbook created by another process
+            self.file_id = get_gdrive_file_id(
+                self.drive_service, self.batch_dir_id, self.file_name, use_index=False
+            )
+        if self.file_id is None:
+            if self._workbook is None:
+                self._workbook = new_workbook()
+            return self._workbook
+        version: str = (
+            self.drive_service.files()
+            .get(fileId=self.file_id, fields="version")
+            .execute()["version"]
+        )
+        if self._workbook is None or version != self._version:
+            data: io.BytesIO | None = download_gdrive_file(
+                self.drive_service, self.file_id
+            )
+            if data is None:
+                raise RuntimeError(f"Cannot download workbook {self.file_id}")
+            self._workbook = load_workbook(data)
+            for sheet in (GRADES_SHEET, ERRORS_SHEET):
+                if sheet not in self._workbook.sheetnames:
+                    self._workbook.create_sheet(sheet).append([KEY_COLUMN, NAME_COLUMN])
+        return self._workbook
+
+    def _upload(self, output: io.BytesIO) -> None:
+        media = MediaIoBaseUpload(output, mimetype=XLSX_MIME_TYPE)
+        if self.file_id is None:
+            file_metadata: dict[str, Any] = {
+                "name": self.file_name,
+                "parents": [self.batch_dir_id],
+            }
+            uploaded: dict[str, Any] = (
+                self.drive_service.files()
+                .create(body=file_metadata, media_body=media, fields="id, version")
+                .execute()
+            )
+            self.file_id = uploaded["id"]
+            folder_index.invalidate(self.batch_dir_id)
+        else:
+            uploaded = (
+                self.drive_service.files()
+                .update(fileId=self.file_id, media_body=media, fields="version")
+                .execute()
+            )
+        self._version = uploaded["version"]
+
+
+def new_workbook() -> Workbook:
+    """Returns an empty batch workbook with its two sheets."""
+    workbook = Workbook()
+    grades: Worksheet = workbook.active
+    grades.title = GRADES_SHEET
+    grades.append([KEY_COLUMN, NAME_COLUMN, *SECTION_TYPES, TOTAL_COLUMN])
+    workbook.create_sheet(ERRORS_SHEET).append([KEY_COLUMN, NAME_COLUMN])
+    return workbook
+
+
+def upsert_rows(
+    sheet: Worksheet, rows: dict[str, dict[str, Any]], replace: bool = False
+) -> None:
+    """
+    Updates or appends one row per key of a sheet whose first column holds the keys.
+
+    Only the given columns of a row are written, or with replace the other columns of the row
+    are cleared.  Columns missing from the header row are added at its end.
+    """
+    columns: dict[str, int] = {
+        cell.value: cell.column for cell in sheet[1] if cell.value is not None
+    }
+    row_numbers: dict[str, int] = {
+        key: row_number
+        for row_number, (key,) in enumerate(
+            sheet.iter_rows(min_row=2, max_col=1, values_only=True), start=2
+        )
+        if key is not None
+    }
+    for key, values in rows.items():
+        row_number: int | None = row_numbers.get(key)
+        if row_number is None:
+            row_number = sheet.max_row + 1
+            row_numbers[key] = row_number
+            sheet.cell(row=row_number, column=1, value=key)
+        if replace:
+            for column, index in columns.items():
+                if index != 1 and column not in values:
+                    # cell(..., value=None) would leave the old value in place
+                    sheet.cell(row=row_number, column=index).value = None
+        for column, value in values.items():
+            if column not in columns:
+                columns[column] = sheet.max_column + 1
+                sheet.cell(row=1, column=columns[column], value=column)
+            sheet.cell(row=row_number, column=columns[column], value=value)
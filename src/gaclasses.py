@@ -39,6 +39,25 @@ class Configuration(BaseModel):
         20, description="Weight of Traduction section in Mock Exam grading"
     )
 
+    grading_concurrency: int = Field(
+        4, description="Maximum number of sections graded concurrently"
+    )
+
+    conversion_workers: int = Field(
+        4, description="Maximum number of pandoc conversions running concurrently"
+    )
+
+    cache_backend: str = Field(
+        "sqlite", description="Where LLM results are cached: sqlite, gdrive or none"
+    )
+    cache_max_megabytes: int = Field(
+        50, description="Maximum size of each LLM result cache in megabytes"
+    )
+    split_mode: str = Field(
+        "boundaries",
+        description="How the model splits papers: boundaries, returning where sections start, or full, rewriting them",
+    )
+
     current_batch: Optional[str] = Field(
         "Mock Exams Feb 2025", description="Current batch of submissions"
     )
@@ -54,6 +73,8 @@ class Configuration(BaseModel):
             service,
             st.session_state.config_directory_id,
             config_file_name or st.session_state.config_file_name,
+            # The configuration page replaces the file, giving it a new ID
+            use_index=False,
         )
         if config_file_id is None:
             print("No configuration file ID found, creating new configuration.")
@@ -138,6 +159,17 @@ class Assessment(BaseModel):
     )
 
 
+class MockExamAssessment(BaseModel):
+    """Represents the structured assessments of the sections of a Mock Exam and its weighted total."""
+
+    sections: Dict[str, Assessment] = Field(
+        ..., description="Assessment of each section, keyed by section type"
+    )
+    total_score: Optional[float] = Field(
+        None, description="Weighted average of the section scores, from 0 to 20"
+    )
+
+
 class Synthese(Submission):
     """Represents the Synthèse section of a Mock Exam submission."""
 
@@ -1,4 +1,4 @@
-from typing import Any, Optional
+from typing import Any, Iterator, NamedTuple, Optional
 from googleapiclient.discovery import Resource
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
@@ -9,14 +9,61 @@ import io
 from io import BytesIO
 import json
 from pydantic import BaseModel, Field
-import pypandoc
 import os
-import tempfile
 import streamlit as st
 from streamlit.runtime.uploaded_file_manager import UploadedFile
 import smtplib
 import ssl
+import threading
+import time
+from cachetools import TTLCache
 from email.message import EmailMessage
+from gdrive_batch import BatchFuture, GDriveBatcher, file_name_query
+from pandoc_convert import DOCX_MIME_TYPE, convert_markdown_to_docx, convert_to_markdown
+
+FOLDER_MIME_TYPE: str = "application/vnd.google-apps.folder"
+FOLDER_INDEX_TTL_SECONDS: float = 300
+CHANGES_SYNC_INTERVAL_SECONDS: float = 30
+FOLDER_ENTRY_FIELDS: str = "id, name, mimeType, createdTime, parents"
+LISTING_PAGE_SIZE: int = 1000
+# Mime types Drive may record for files with a given extension, used to filter listings server-side
+EXTENSION_MIME_TYPES: dict[str, tuple[str, ...]] = {
+    "docx": (
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+        "application/octet-stream",
+    ),
+    "odt": ("application/vnd.oasis.opendocument.text", "application/octet-stream"),
+    # Markdown files uploaded from a browser or the desktop app are often recorded as octet-stream
+    "md": (
+        "text/markdown",
+        "text/x-markdown",
+        "text/plain",
+        "application/octet-stream",
+    ),
+    "json": ("application/json", "text/plain"),
+}
+
+
+class MimeTypeFilter(NamedTuple):
+    """Mime types a folder listing is restricted to, or that it leaves out if exclude."""
+
+    mime_types: frozenset[str] = frozenset()
+    exclude: bool = True
+
+    def query(self) -> str:
+        """Returns the Drive query clause of the filter, empty for the whole folder."""
+        operator, separator = ("!=", " and ") if self.exclude else ("=", " or ")
+        return separator.join(
+            f"mimeType{operator}'{mime_type}'" for mime_type in sorted(self.mime_types)
+        )
+
+    def matches(self, mime_type: str | None) -> bool:
+        return (mime_type in self.mime_types) != self.exclude
+
+
+ALL_ENTRIES = MimeTypeFilter()
+FOLDERS_ONLY = MimeTypeFilter(frozenset({FOLDER_MIME_TYPE}), exclude=False)
+FILES_ONLY = MimeTypeFilter(frozenset({FOLDER_MIME_TYPE}), exclude=True)
 
 
 # Google Drive Setup
@@ -56,39 +103,238 @@ def create_drive_service() -> Optional[Resource]:
         return None
 
 
+class GDriveFolderIndex:
+    """
+    In-process index of Google Drive folder listings, keyed by folder ID and mime type filter.
+
+    Filtered listings are fetched with their filter in the Drive query, and served from the whole
+    listing of the folder instead when it is indexed.  Listings expire after a TTL, are invalidated
+    by the writes made through this module, and can be patched incrementally from the Drive changes
+    feed with sync_changes.  The index is shared by all the sessions of the Streamlit server, which
+    all use the same service account.
+    """
+
+    def __init__(
+        self, maxsize: int = 256, ttl: float = FOLDER_INDEX_TTL_SECONDS
+    ) -> None:
+        self._folders: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._changes_token: str | None = None
+        self._last_sync: float = 0.0
+
+    def get(
+        self,
+        drive_service: Resource,
+        folder_id: str,
+        entry_filter: MimeTypeFilter = ALL_ENTRIES,
+    ) -> list[dict[str, Any]]:
+        """Returns the entries of a folder, listing it from Drive if it is not indexed."""
+        return list(self.iter(drive_service, folder_id, entry_filter))
+
+    def iter(
+        self,
+        drive_service: Resource,
+        folder_id: str,
+        entry_filter: MimeTypeFilter = ALL_ENTRIES,
+    ) -> Iterator[dict[str, Any]]:
+        """
+        Yields the entries of a folder from the index, or streams them page by page from Drive.
+
+        A streamed listing is only indexed once all its pages have been read.
+        """
+        with self._lock:
+            entries: list[dict[str, Any]] | None = self._folders.get(
+                (folder_id, entry_filter)
+            )
+            whole: list[dict[str, Any]] | None = self._folders.get(
+                (folder_id, ALL_ENTRIES)
+            )
+        if entries is None and whole is not None:
+            entries = [
+                entry for entry in whole if entry_filter.matches(entry["mimeType"])
+            ]
+        if entries is not None:
+            yield from entries
+            return
+        entries = []
+        for entry in iter_gdrive_folder(drive_service, folder_id, entry_filter.query()):
+            entries.append(entry)
+            yield entry
+        with self._lock:
+            self._folders[(folder_id, entry_filter)] = entries
+
+    def invalidate(self, folder_id: str | None) -> None:
+        """Forgets the listings of a folder after it was modified."""
+        if folder_id is None:
+            return
+        with self._lock:
+            for key in [key for key in self._folders if key[0] == folder_id]:
+                self._folders.pop(key, None)
+
+    def clear(self) -> None:
+        """Forgets all the folder listings."""
+        with self._lock:
+            self._folders.clear()
+
+    def sync_changes(self, drive_service: Resource) -> int:
+        """
+        Applies the Drive changes feed to the indexed folders.
+
+        Syncing happens at most every CHANGES_SYNC_INTERVAL_SECONDS.  The first call only records the
+        current position of the feed.
+
+        Returns:
+            int: The number of changes applied.
+        """
+        if time.monotonic() - self._last_sync < CHANGES_SYNC_INTERVAL_SECONDS:
+            return 0
+        self._last_sync = time.monotonic()
+        try:
+            if self._changes_token is None:
+                response: Any = drive_service.changes().getStartPageToken().execute()
+                self._changes_token = response["startPageToken"]
+                return 0
+            nchanges: int = 0
+            page_token: str | None = self._changes_token
+            while page_token is not None:
+                response = (
+                    drive_service.changes()
+                    .list(
+                        pageToken=page_token,
+                        pageSize=1000,
+                        fields=f"nextPageToken, newStartPageToken, changes(fileId, removed, file(trashed, {FOLDER_ENTRY_FIELDS}))",
+                    )
+                    .execute()
+                )
+                for change in response.get("changes", []):
+                    self._apply_change(change)
+                    nchanges += 1
+                page_token = response.get("nextPageToken")
+                if "newStartPageToken" in response:
+                    self._changes_token = response["newStartPageToken"]
+            return nchanges
+        except HttpError as e:
+            print(f"Error reading Drive changes, clearing folder index: {e}")
+            self._changes_token = None
+            self.clear()
+            return 0
+
+    def _apply_change(self, change: dict[str, Any]) -> None:
+        file_id: str = change["fileId"]
+        file: dict[str, Any] | None = change.get("file")
+        with self._lock:
+            for (folder_id, entry_filter), entries in list(self._folders.items()):
+                kept: list[dict[str, Any]] = [
+                    entry for entry in entries if entry["id"] != file_id
+                ]
+                if (
+                    not change.get("removed")
+                    and file is not None
+                    and not file.get("trashed")
+                    and folder_id in file.get("parents", [])
+                    and entry_filter.matches(file.get("mimeType"))
+                ):
+                    kept.append({k: v for k, v in file.items() if k != "trashed"})
+                if kept != entries:
+                    self._folders[(folder_id, entry_filter)] = kept
+
+
+def iter_gdrive_folder(
+    drive_service: Resource,
+    folder_id: str,
+    query_filter: str = "",
+    fields: str = FOLDER_ENTRY_FIELDS,
+    page_size: int = LISTING_PAGE_SIZE,
+) -> Iterator[dict[str, Any]]:
+    """
+    Lazily lists the non-trashed entries of a Google Drive folder, following pagination.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        folder_id (str): The ID of the folder to list.
+        query_filter (str): Additional Drive query clause, e.g. a mimeType condition.
+        fields (str): The file fields to retrieve for each entry.
+        page_size (int): Number of entries requested per page.
+
+    Returns:
+        Iterator[dict[str, Any]]: The entries, yielded as each page arrives.
+    """
+    query: str = f"'{folder_id}' in parents and trashed=false"
+    if query_filter:
+        query += f" and ({query_filter})"
+    page_token: str | None = None
+    while True:
+        response: Any = (
+            drive_service.files()
+            .list(
+                q=query,
+                fields=f"nextPageToken, files({fields})",
+                pageSize=page_size,
+                pageToken=page_token,
+            )
+            .execute()
+        )
+        yield from response.get("files", [])
+        page_token = response.get("nextPageToken")
+        if page_token is None:
+            return
+
+
+folder_index = GDriveFolderIndex()
+
+
+def sync_gdrive_folder_index(drive_service: Resource) -> int:
+    """Refreshes the folder index from the Drive changes feed, see GDriveFolderIndex.sync_changes."""
+    return folder_index.sync_changes(drive_service)
+
+
 def get_gdrive_file_id(
-    drive_service: Resource, folder_id: str, file_name: str
+    drive_service: Resource, folder_id: str, file_name: str, use_index: bool = True
 ) -> str | None:
     """
     Returns the file ID of a file with a given name in a specific Google Drive folder.
 
+    The folder index of this process may miss a file just created by another process, e.g. a
+    grading worker, so lookups made before creating or replacing a shared file must not use it.
+
     :param drive_service: Authenticated Google Drive API service instance.
     :param folder_id: The Google Drive folder ID where the file is located.
     :param file_name: The exact name of the file to search for.
+    :param use_index: Look the file up in the folder index rather than query Drive.
     :return: The file ID if found, None otherwise.
     """
     try:
-        # Query to find the file by name in the given folder
-        query: str = (
-            f"name = '{file_name}' and '{folder_id}' in parents and trashed = false"
-        )
-
-        # Execute the search
-        response = (
-            drive_service.files().list(q=query, fields="files(id, name)").execute()
-        )
-
-        files = response.get("files", [])
-
-        if files:
-            return files[0]["id"]  # Return the first matching file ID
-        else:
-            return None  # File not found
+        if not use_index:
+            return query_gdrive_file_id(drive_service, folder_id, file_name)
+        # Look the file up by name in the folder index
+        for entry in folder_index.get(drive_service, folder_id):
+            if entry["name"] == file_name:
+                return entry["id"]  # Return the first matching file ID
+        return None  # File not found
     except HttpError as e:
         print(f"Error searching for file: {e}")
         return None
 
 
+def query_gdrive_file_id(
+    drive_service: Resource,
+    folder_id: str,
+    file_name: str,
+    mime_type: str | None = None,
+) -> str | None:
+    """Returns the ID of the file with a given name in a folder, asking Drive rather than the index."""
+    query: str = file_name_query(folder_id, file_name)
+    if mime_type is not None:
+        query += f" and mimeType = '{mime_type}'"
+    files: list[dict[str, Any]] = (
+        drive_service.files()
+        .list(q=query, fields="files(id)", pageSize=1)
+        .execute()
+        .get("files", [])
+    )
+    return files[0]["id"] if files else None
+
+
 def check_gdrive_file_exists(drive_service: Resource, file_id: str) -> bool:
     """
     Checks if a Google Drive file exists given its file ID.
@@ -154,9 +400,7 @@ def store_pydantic_to_drive(
     """
     try:
         # Step 1: Search for an existing file with the same name in the target directory
-        query: str = (
-            f"name = '{file_name}' and '{target_dir_id}' in parents and trashed = false"
-        )
+        query: str = file_name_query(target_dir_id, file_name)
         response = service.files().list(q=query, fields="files(id)").execute()
         files: dict[str, Any] = response.get("files", [])
 
@@ -169,7 +413,7 @@ def store_pydantic_to_drive(
         # Step 3: Upload the new JSON file
         file_metadata: dict[str, Any] = {"name": file_name, "parents": [target_dir_id]}
         media = MediaIoBaseUpload(
-            io.BytesIO(json.dumps(data_instance.model_dump()).encode()),
+            io.BytesIO(data_instance.model_dump_json().encode()),
             mimetype="application/json",
         )
 
@@ -179,6 +423,7 @@ def store_pydantic_to_drive(
             .execute()
         )
 
+        folder_index.invalidate(target_dir_id)
         print(
             f"✅ '{file_name}' uploaded successfully to Drive folder {target_dir_id}: {uploaded_file}."
         )
@@ -192,6 +437,32 @@ def store_pydantic_to_drive(
         return False
 
 
+def update_pydantic_on_drive(
+    service: Resource, data_instance: BaseModel, file_id: str
+) -> bool:
+    """
+    Overwrites the content of an existing JSON file on Google Drive with a Pydantic model instance.
+
+    Unlike store_pydantic_to_drive, the file keeps its ID and no listing or deletion is needed,
+    which makes it cheap enough to call after every step of a long process.
+
+    :param service: Authenticated Google Drive API service instance.
+    :param data_instance: The Pydantic model instance to store.
+    :param file_id: The ID of the JSON file to overwrite.
+    :return: True if successful, False otherwise.
+    """
+    try:
+        media = MediaIoBaseUpload(
+            io.BytesIO(data_instance.model_dump_json().encode()),
+            mimetype="application/json",
+        )
+        service.files().update(fileId=file_id, media_body=media).execute()
+        return True
+    except HttpError as e:
+        print(f"❌ Google Drive API Error updating file {file_id}: {e}")
+        return False
+
+
 def ensure_gdrive_directory(
     drive_service: Any, root_id: str, subdirectory_name: str
 ) -> str | None:
@@ -209,19 +480,17 @@ def ensure_gdrive_directory(
     """
     try:
         # Search for the folder inside the root directory
-        query: str = (
-            f"name='{subdirectory_name}' and mimeType='application/vnd.google-apps.folder' and '{root_id}' in parents and trashed=false"
-        )
-        response = (
-            drive_service.files()
-            .list(q=query, spaces="drive", fields="files(id, name)")
-            .execute()
+        for entry in folder_index.get(drive_service, root_id, FOLDERS_ONLY):
+            if entry["name"] == subdirectory_name:
+                # Folder already exists, return its ID
+                return entry["id"]
+        # Another process may have created it since the root directory was indexed
+        folder_id: str | None = query_gdrive_file_id(
+            drive_service, root_id, subdirectory_name, FOLDER_MIME_TYPE
         )
-        folders = response.get("files", [])
-
-        if folders:
-            # Folder already exists, return its ID
-            return folders[0]["id"]
+        if folder_id is not None:
+            folder_index.invalidate(root_id)
+            return folder_id
 
         # Folder does not exist, create it
         folder_metadata: dict[str, Any] = {
@@ -232,6 +501,7 @@ def ensure_gdrive_directory(
         folder = (
             drive_service.files().create(body=folder_metadata, fields="id").execute()
         )
+        folder_index.invalidate(root_id)
         return folder["id"]
 
     except HttpError as error:
@@ -245,36 +515,98 @@ def ensure_gdrive_directory(
 # print(f"Subdirectory ID: {subdirectory_id}")
 
 
+def extensions_filter(extensions: tuple[str, ...] | None) -> MimeTypeFilter:
+    """Returns the filter restricting a listing to the mime types of the given extensions."""
+    if extensions is None:
+        return FILES_ONLY
+    mime_types: set[str] = set()
+    for extension in extensions:
+        if extension.lower() not in EXTENSION_MIME_TYPES:
+            # Unknown extension: filter by name on our side only
+            return FILES_ONLY
+        mime_types.update(EXTENSION_MIME_TYPES[extension.lower()])
+    return MimeTypeFilter(frozenset(mime_types), exclude=False)
+
+
+def iter_gdrive_files(
+    drive_service: Resource,
+    folder_id: str,
+    extensions: tuple[str, ...] | None = ("docx", "odt"),
+    use_index: bool = True,
+) -> Iterator[tuple[str, str]]:
+    """
+    Lazily lists the files of a Google Drive folder with specific extensions.
+
+    The mime types of the extensions are pushed into the Drive query, so that the other files of
+    the folder are not fetched.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        folder_id (str): The ID of the folder to list.
+        extensions (tuple[str, ...] | None): Allowed extensions, or None for all the files.
+        use_index (bool): Read the listing from the folder index, indexing it if needed.
+            Otherwise only the files' IDs and names are fetched.
+
+    Returns:
+        Iterator[tuple[str, str]]: (file name, file ID) pairs, yielded as each page arrives.
+    """
+    entry_filter: MimeTypeFilter = extensions_filter(extensions)
+    entries: Iterator[dict[str, Any]] = (
+        folder_index.iter(drive_service, folder_id, entry_filter)
+        if use_index
+        else iter_gdrive_folder(
+            drive_service, folder_id, entry_filter.query(), "id, name"
+        )
+    )
+    for file in entries:
+        # The mime types are only a hint, the extension is what counts
+        if extensions is None or file["name"].lower().endswith(extensions):
+            yield file["name"], file["id"]
+
+
 def list_gdrive_files(
     drive_service: Any,
     folder_id: str,
     extensions: tuple[str, ...] | None = ("docx", "odt"),
 ) -> dict[str, str] | None:
     """Lists files in a Google Drive folder with specific extensions.  If extensions is None, return all the files."""
-    query: str = (
-        f"'{folder_id}' in parents and mimeType!='application/vnd.google-apps.folder' and trashed=false"
-    )
     try:
-        results = (
-            drive_service.files()
-            .list(q=query, fields="files(id, name, mimeType)")
-            .execute()
-        )
-        files = results.get("files", [])
-
-        # Filter files by allowed extensions
-        filtered_files: dict[Any, Any] = {
-            file["name"]: file["id"]
-            for file in files
-            if extensions is None or file["name"].lower().endswith(extensions)
-        }
-
-        return filtered_files  # Returns {filename: file_id} dictionary
+        return dict(
+            iter_gdrive_files(drive_service, folder_id, extensions)
+        )  # Returns {filename: file_id} dictionary
     except Exception as e:
         print(f"An error occurred: {e}")
         return None  # Return empty dictionary in case of an error
 
 
+def iter_gdrive_subfolders(
+    drive_service: Resource, parent_folder_id: str, use_index: bool = True
+) -> Iterator[tuple[str, str, str]]:
+    """
+    Lazily lists the subfolders of a Google Drive folder, querying folders only.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        parent_folder_id (str): The ID of the parent folder to search within.
+        use_index (bool): Read the listing from the folder index, indexing it if needed.
+
+    Returns:
+        Iterator[tuple[str, str, str]]: (name, folder ID, creation time) triples, in listing order.
+    """
+    entries: Iterator[dict[str, Any]] = (
+        folder_index.iter(drive_service, parent_folder_id, FOLDERS_ONLY)
+        if use_index
+        else iter_gdrive_folder(
+            drive_service,
+            parent_folder_id,
+            FOLDERS_ONLY.query(),
+            "id, name, createdTime",
+        )
+    )
+    for file in entries:
+        yield file["name"], file["id"], file.get("createdTime", "")
+
+
 def list_gdrive_subfolders(
     drive_service: Resource, parent_folder_id: str
 ) -> dict[str, str]:
@@ -289,20 +621,10 @@ def list_gdrive_subfolders(
         Dict[str, str]: A dictionary where keys are subfolder names and values are their Google Drive IDs.
     """
     try:
-        query: str = (
-            f"'{parent_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and trashed=false"
-        )
-        results = (
-            drive_service.files()
-            .list(q=query, fields="files(id, name, createdTime)")
-            .execute()
-        )
-
         # Extract subfolders with creation time
-        subfolders: list[Tuple[str, str, str]] = [
-            (file["name"], file["id"], file.get("createdTime", ""))
-            for file in results.get("files", [])
-        ]
+        subfolders: list[tuple[str, str, str]] = list(
+            iter_gdrive_subfolders(drive_service, parent_folder_id)
+        )
 
         # Sort by createdTime (latest first)
         sorted_subfolders = sorted(subfolders, key=lambda x: x[2], reverse=True)
@@ -355,6 +677,38 @@ def get_gdrive_folder_path(drive_service: Resource, folder_id: str) -> str | Non
         return None
 
 
+def create_gdrive_markdown_file(
+    drive_service: Resource, file_name: str, folder_id: str, markdown_text: str
+) -> str:
+    """
+    Uploads Markdown text from memory as a new file in a Google Drive folder.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        file_name (str): The name of the new Markdown file.
+        folder_id (str): The ID of the Google Drive folder to save the file in.
+        markdown_text (str): The Markdown content of the file.
+
+    Returns:
+        str: The Google Drive file ID of the new file.
+    """
+    file_metadata = {
+        "name": file_name,
+        "mimeType": "text/markdown",
+        "parents": [folder_id],
+    }
+    media = MediaIoBaseUpload(
+        BytesIO(markdown_text.encode("utf-8")), mimetype="text/markdown"
+    )
+    uploaded_file = (
+        drive_service.files()
+        .create(body=file_metadata, media_body=media, fields="id")
+        .execute()
+    )
+    folder_index.invalidate(folder_id)
+    return uploaded_file["id"]
+
+
 def convert_gdrive_file_to_markdown(
     drive_service: Resource,
     file_id: str,
@@ -363,7 +717,7 @@ def convert_gdrive_file_to_markdown(
     header_markdown: str = "",
 ) -> str | None:
     """
-    Downloads a Google Drive file, converts it to Markdown using pypandoc, prepends a header, and uploads it back to Google Drive.
+    Downloads a Google Drive file, converts it to Markdown in memory using pandoc, prepends a header, and uploads it back to Google Drive.
 
     Args:
         drive_service: Authenticated Google Drive API service instance.
@@ -381,8 +735,6 @@ def convert_gdrive_file_to_markdown(
         file_type: str = os.path.splitext(file_name)[1].lstrip(
             "."
         )  # Get file extension
-        temp_input_path: str = f"/tmp/{base_name}"
-        temp_md_path: str = f"/tmp/{base_name}.md"
 
         # Download file content
         request = drive_service.files().get_media(fileId=file_id)
@@ -392,77 +744,61 @@ def convert_gdrive_file_to_markdown(
         while not done:
             status, done = downloader.next_chunk()
 
-        # Save the downloaded file
-        with open(temp_input_path, "wb") as f:
-            f.write(file_data.getvalue())
-
-        # Convert to Markdown using Pandoc
-        converted_markdown = pypandoc.convert_file(
-            temp_input_path, "md", format=file_type
-        )
+        # Convert to Markdown by piping the file through Pandoc
+        converted_markdown: str = convert_to_markdown(file_data.getvalue(), file_type)
 
         # Prepend the header Markdown
         full_markdown = f"{header_markdown}\n\n{converted_markdown}"
 
-        # Save Markdown content
-        with open(temp_md_path, "w", encoding="utf-8") as f:
-            f.write(full_markdown)
-
-        # Upload the converted Markdown file to Google Drive
-        file_metadata = {
-            "name": f"{base_name}.md",
-            "mimeType": "text/markdown",
-            "parents": [output_folder_id],
-        }
-        media = MediaFileUpload(temp_md_path, mimetype="text/markdown")
-        uploaded_file = (
-            drive_service.files()
-            .create(body=file_metadata, media_body=media, fields="id")
-            .execute()
+        # Upload the converted Markdown file to Google Drive from memory
+        return create_gdrive_markdown_file(
+            drive_service, f"{base_name}.md", output_folder_id, full_markdown
         )
 
-        # Cleanup temp files
-        os.remove(temp_input_path)
-        os.remove(temp_md_path)
-
-        return uploaded_file["id"]
-
     except Exception as e:
         print(f"Error converting file {file_id} to Markdown: {e}")
         return None
 
 
 def convert_gdrive_file_to_docx(
-    drive_service: Resource, file_id: str, output_folder_id: str | None = None
+    drive_service: Resource,
+    file_id: str,
+    output_folder_id: str | None = None,
+    file_name: str | None = None,
 ) -> str | None:
     """
-    Downloads a Google Drive file, converts it to DOCX using pypandoc, and uploads it back to Google Drive.
+    Downloads a Google Drive file, converts it to DOCX in memory using pandoc, and uploads it back to Google Drive.
 
     Args:
         drive_service: Authenticated Google Drive API service instance.
         file_id (str): The ID of the file in Google Drive.
         output_folder_id (str): The ID of the Google Drive folder to save the DOCX file.
                                (Defaults to the same folder as the original file.)
+        file_name (str): The name of the file, if the caller knows it.
+                         (Saves a metadata request when output_folder_id is also given.)
 
     Returns:
         str | None: The file ID of the uploaded DOCX file, or None if conversion fails.
     """
     try:
-        # Get file metadata to retrieve original name and parent folder
-        file_metadata = (
-            drive_service.files().get(fileId=file_id, fields="name, parents").execute()
-        )
-        file_name = file_metadata["name"]
-        parent_folder_id: str = (
-            file_metadata["parents"][0]
-            if output_folder_id is None
-            else output_folder_id
-        )
+        if file_name is not None and output_folder_id is not None:
+            parent_folder_id: str = output_folder_id
+        else:
+            # Get file metadata to retrieve original name and parent folder
+            file_metadata = (
+                drive_service.files()
+                .get(fileId=file_id, fields="name, parents")
+                .execute()
+            )
+            file_name = file_metadata["name"]
+            parent_folder_id = (
+                file_metadata["parents"][0]
+                if output_folder_id is None
+                else output_folder_id
+            )
 
         # Extract base name (without extension)
         base_name = os.path.splitext(file_name)[0]
-        temp_md_path: str = f"/tmp/{base_name}.md"
-        temp_docx_path: str = f"/tmp/{base_name}.docx"
 
         # Download file content as Markdown
         request = drive_service.files().get_media(fileId=file_id)
@@ -472,32 +808,23 @@ def convert_gdrive_file_to_docx(
         while not done:
             status, done = downloader.next_chunk()
 
-        # Save the content as a temporary Markdown file
-        with open(temp_md_path, "wb") as f:
-            f.write(file_data.getvalue())
-
-        # Convert Markdown to DOCX using pypandoc
-        pypandoc.convert_file(temp_md_path, "docx", outputfile=temp_docx_path)
+        # Convert Markdown to DOCX by piping it through Pandoc
+        docx_data: bytes = convert_markdown_to_docx(file_data.getvalue())
 
-        # Upload the converted DOCX back to Google Drive
+        # Upload the converted DOCX back to Google Drive from memory
         file_metadata = {
             "name": f"{base_name}.docx",
-            "mimeType": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+            "mimeType": DOCX_MIME_TYPE,
             "parents": [parent_folder_id],
         }
-        media = MediaFileUpload(
-            temp_docx_path,
-            mimetype="application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-        )
+        media = MediaIoBaseUpload(BytesIO(docx_data), mimetype=DOCX_MIME_TYPE)
         uploaded_file = (
             drive_service.files()
             .create(body=file_metadata, media_body=media, fields="id")
             .execute()
         )
 
-        # Cleanup temporary files
-        os.remove(temp_md_path)
-        os.remove(temp_docx_path)
+        folder_index.invalidate(parent_folder_id)
 
         return uploaded_file["id"]
 
@@ -550,9 +877,7 @@ def upload_markdown_to_gdrive(
     """
     try:
         # Step 1: Search for an existing file with the same name in the target directory
-        query: str = (
-            f"name = '{file_name}' and '{target_dir_id}' in parents and trashed = false"
-        )
+        query: str = file_name_query(target_dir_id, file_name)
         print(
             f"Searching for existing file '{file_name}' in Drive folder {target_dir_id}, query is {query}..."
         )
@@ -585,6 +910,7 @@ def upload_markdown_to_gdrive(
         )
 
         file_id = uploaded_file.get("id")
+        folder_index.invalidate(target_dir_id)
         print(
             f"✅ '{file_name}' uploaded successfully to Drive folder {target_dir_id}."
         )
@@ -598,6 +924,76 @@ def upload_markdown_to_gdrive(
         return None
 
 
+def upload_markdowns_to_gdrive(
+    drive_service: Resource,
+    target_dir_id: str,
+    markdown_files: dict[str, str],
+    mime_type: str = "text/markdown",
+) -> dict[str, str | None]:
+    """
+    Creates or replaces several Markdown (.md) files in a Google Drive folder.
+
+    The lookups and deletions of the existing files are sent as batch requests; only the uploads
+    themselves are sent one by one.
+
+    :param drive_service: Authenticated Google Drive API service instance.
+    :param target_dir_id: The Google Drive folder ID where the files should be stored.
+    :param markdown_files: The Markdown content to store, keyed by file name.
+    :param mime_type: The mime type of the files, to store other text files such as JSON.
+    :return: The file ID of each uploaded file, or None if there was an error, keyed by file name.
+    """
+    with GDriveBatcher(drive_service) as batcher:
+        lookups: dict[str, BatchFuture] = {
+            file_name: batcher.find(target_dir_id, file_name, "files(id)")
+            for file_name in markdown_files
+        }
+        deletions: list[BatchFuture] = []
+        failed_lookups: set[str] = set()
+        for file_name, lookup in lookups.items():
+            try:
+                for existing_file in lookup.result().get("files", [])[:1]:
+                    deletions.append(batcher.delete(existing_file["id"]))
+                    print(
+                        f"🗑️ Deleting existing file '{file_name}' (ID: {existing_file['id']})."
+                    )
+            except HttpError as e:
+                # Uploading anyway would leave a duplicate next to the existing file
+                print(f"❌ Google Drive API Error looking up '{file_name}': {e}")
+                failed_lookups.add(file_name)
+    for deletion in deletions:
+        if deletion.exception() is not None:
+            print(f"❌ Google Drive API Error: {deletion.exception()}")
+
+    file_ids: dict[str, str | None] = {}
+    for file_name, markdown_text in markdown_files.items():
+        if file_name in failed_lookups:
+            file_ids[file_name] = None
+            continue
+        try:
+            file_metadata: dict[str, Any] = {
+                "name": file_name,
+                "parents": [target_dir_id],
+                "mimeType": mime_type,
+            }
+            media = MediaIoBaseUpload(
+                io.BytesIO(markdown_text.encode()), mimetype=mime_type
+            )
+            uploaded_file = (
+                drive_service.files()
+                .create(body=file_metadata, media_body=media, fields="id")
+                .execute()
+            )
+            file_ids[file_name] = uploaded_file.get("id")
+            print(
+                f"✅ '{file_name}' uploaded successfully to Drive folder {target_dir_id}."
+            )
+        except HttpError as e:
+            print(f"❌ Google Drive API Error: {e}")
+            file_ids[file_name] = None
+    folder_index.invalidate(target_dir_id)
+    return file_ids
+
+
 def replace_gdrive_file(
     drive_service: Resource,
     local_file_path: str,
@@ -614,9 +1010,7 @@ def replace_gdrive_file(
     """
     try:
         # Step 1: Search for an existing file with the same name in the target directory
-        query: str = (
-            f"name = '{gdrive_file_name}' and '{target_dir_id}' in parents and trashed = false"
-        )
+        query: str = file_name_query(target_dir_id, gdrive_file_name)
         response = (
             drive_service.files().list(q=query, fields="files(id, name)").execute()
         )
@@ -643,6 +1037,7 @@ def replace_gdrive_file(
             .execute()
         )
 
+        folder_index.invalidate(target_dir_id)
         print(
             f"✅ '{local_file_path}' uploaded successfully to file {gdrive_file_name} in Drive folder {target_dir_id}."
         )
@@ -704,7 +1099,7 @@ def store_uploaded_file(
     file_name: str | None = None,
 ) -> str | None:
     """
-    Handles a Streamlit UploadedFile by saving it as a temporary file and uploading it to Google Drive.
+    Handles a Streamlit UploadedFile by uploading its content to Google Drive from memory.
 
     Args:
         drive_service: Authenticated Google Drive API service instance.
@@ -717,19 +1112,14 @@ def store_uploaded_file(
     if file_name is None:
         file_name = uploaded_file.name
     try:
-        # ✅ Create a temporary file
-        with tempfile.NamedTemporaryFile(
-            delete=False, suffix=f".{uploaded_file.type.split('/')[-1]}"
-        ) as temp_file:
-            temp_file.write(uploaded_file.getbuffer())
-            temp_file_path: str = temp_file.name  # ✅ Path to the temp file
-
         # ✅ Prepare file metadata for Google Drive upload
         file_metadata: dict[str, Any] = {
             "name": file_name,
             "parents": [parent_folder_id],
         }
-        media = MediaFileUpload(temp_file_path, mimetype=uploaded_file.type)
+        media = MediaIoBaseUpload(
+            BytesIO(uploaded_file.getvalue()), mimetype=uploaded_file.type
+        )
 
         # ✅ Upload the file to Google Drive
         file_data: Any = (
@@ -738,9 +1128,7 @@ def store_uploaded_file(
             .execute()
         )
         file_id: str = file_data.get("id")
-
-        # ✅ Cleanup temp file after upload
-        os.remove(temp_file_path)
+        folder_index.invalidate(parent_folder_id)
 
         return file_id
 
@@ -812,7 +1200,12 @@ def download_gdrive_file(drive_service: Resource, file_id: str) -> BytesIO | Non
 
 
 def send_email_with_gdrive_attachment(
-    drive_service: Resource, recipient_email: str, subject: str, body: str, file_id: str
+    drive_service: Resource,
+    recipient_email: str,
+    subject: str,
+    body: str,
+    file_id: str,
+    file_name: str | None = None,
 ) -> bool:
     """
     Sends an email with an attachment downloaded from Google Drive.
@@ -823,6 +1216,7 @@ def send_email_with_gdrive_attachment(
         subject (str): Email subject.
         body (str): Email body.
         file_id (str): The Google Drive file ID.
+        file_name (str): The attachment name, looked up on Google Drive if not given.
 
     Returns:
         None
@@ -841,7 +1235,8 @@ def send_email_with_gdrive_attachment(
 
     # ✅ Download file from Google Drive
     try:
-        file_name: str | None = get_gdrive_file_name(drive_service, file_id)
+        if file_name is None:
+            file_name = get_gdrive_file_name(drive_service, file_id)
         if file_name is None:
             print("❌ Error retrieving file name from Google Drive.")
             return False
@@ -0,0 +1,151 @@
+from concurrent.futures import Future
+from typing import Any, Iterable
+from googleapiclient.discovery import Resource
+from googleapiclient.errors import HttpError
+from googleapiclient.http import BatchHttpRequest, HttpRequest
+
+# Google Drive accepts at most 100 calls in one batch request
+MAX_BATCH_SIZE: int = 100
+
+
+def quote_query_value(value: str) -> str:
+    """Quotes a string for a Drive query, escaping its backslashes and single quotes."""
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+def file_name_query(folder_id: str, file_name: str) -> str:
+    """Returns the Drive query of the non-trashed files with a given name in a folder."""
+    return f"name = {quote_query_value(file_name)} and '{folder_id}' in parents and trashed = false"
+
+
+class BatchFuture(Future):
+    """A future for a batched Drive request, flushing its batcher when its result is needed."""
+
+    def __init__(self, batcher: "GDriveBatcher") -> None:
+        super().__init__()
+        self._batcher = batcher
+
+    def result(self, timeout: float | None = None) -> Any:
+        if not self.done():
+            self._batcher.flush()
+        return super().result(timeout)
+
+    def exception(self, timeout: float | None = None) -> BaseException | None:
+        if not self.done():
+            self._batcher.flush()
+        return super().exception(timeout)
+
+
+class GDriveBatcher:
+    """
+    Coalesces small Google Drive requests into HTTP batch requests.
+
+    Requests are queued by add (or the get/list/delete helpers) and sent, up to MAX_BATCH_SIZE at a
+    time, when flush is called, when the batcher is used as a context manager and exits, or when
+    the result of one of the returned futures is requested.  Media uploads and downloads cannot be
+    batched.  The Drive client is not thread-safe, so a batcher must stay on one thread.
+
+    Example:
+        with GDriveBatcher(drive_service) as batcher:
+            names = {file_id: batcher.get(file_id, "name") for file_id in file_ids}
+        print({file_id: future.result()["name"] for file_id, future in names.items()})
+    """
+
+    def __init__(
+        self, drive_service: Resource, max_batch_size: int = MAX_BATCH_SIZE
+    ) -> None:
+        self.drive_service = drive_service
+        self.max_batch_size = min(max_batch_size, MAX_BATCH_SIZE)
+        self._pending: list[tuple[HttpRequest, BatchFuture]] = []
+
+    def __enter__(self) -> "GDriveBatcher":
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.flush()
+
+    def add(self, request: HttpRequest) -> BatchFuture:
+        """Queues a Drive request and returns a future for its response."""
+        future = BatchFuture(self)
+        self._pending.append((request, future))
+        return future
+
+    def get(self, file_id: str, fields: str) -> BatchFuture:
+        """Queues a files().get metadata request."""
+        return self.add(self.drive_service.files().get(fileId=file_id, fields=fields))
+
+    def list(self, query: str, fields: str = "files(id, name)") -> BatchFuture:
+        """Queues a files().list request (first page only, for small lookups)."""
+        return self.add(self.drive_service.files().list(q=query, fields=fields))
+
+    def find(
+        self, folder_id: str, file_name: str, fields: str = "files(id, name)"
+    ) -> BatchFuture:
+        """Queues the lookup of the files with a given name in a folder, see file_name_query."""
+        return self.list(file_name_query(folder_id, file_name), fields)
+
+    def delete(self, file_id: str) -> BatchFuture:
+        """Queues a files().delete request."""
+        return self.add(self.drive_service.files().delete(fileId=file_id))
+
+    def flush(self) -> None:
+        """Sends all the queued requests, in batches of at most max_batch_size calls."""
+        while self._pending:
+            chunk: list[tuple[HttpRequest, BatchFuture]] = self._pending[
+                : self.max_batch_size
+            ]
+            self._pending = self._pending[self.max_batch_size :]
+            futures: dict[str, BatchFuture] = {}
+
+            def callback(
+                request_id: str, response: Any, exception: HttpError | None
+            ) -> None:
+                if exception is not None:
+                    futures[request_id].set_exception(exception)
+                else:
+                    futures[request_id].set_result(response)
+
+            batch: BatchHttpRequest = self.drive_service.new_batch_http_request(
+                callback=callback
+            )
+            for index, (request, future) in enumerate(chunk):
+                request_id: str = str(index)
+                futures[request_id] = future
+                batch.add(request, request_id=request_id)
+            print(f"Sending a batch of {len(chunk)} Drive requests...")
+            try:
+                batch.execute()
+            except Exception as e:
+                print(f"❌ Error sending Drive batch: {e}")
+                for future in futures.values():
+                    if not future.done():
+                        future.set_exception(e)
+
+
+def get_gdrive_files_metadata(
+    drive_service: Resource, file_ids: Iterable[str], fields: str
+) -> dict[str, dict[str, Any] | None]:
+    """
+    Retrieves the metadata of many Google Drive files with batched requests.
+
+    Args:
+        drive_service: Authenticated Google Drive API service instance.
+        file_ids (Iterable[str]): The IDs of the files.
+        fields (str): The metadata fields to retrieve, e.g. "name, createdTime".
+
+    Returns:
+        dict[str, dict[str, Any] | None]: The metadata of each file, or None if it could not be retrieved.
+    """
+    with GDriveBatcher(drive_service) as batcher:
+        futures: dict[str, BatchFuture] = {
+            file_id: batcher.get(file_id, fields) for file_id in file_ids
+        }
+    metadata: dict[str, dict[str, Any] | None] = {}
+    for file_id, future in futures.items():
+        error: BaseException | None = future.exception()
+        if error is not None:
+            print(f"❌ Error retrieving metadata of file {file_id}: {error}")
+            metadata[file_id] = None
+        else:
+            metadata[file_id] = future.result()
+    return metadata
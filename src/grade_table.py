@@ -0,0 +1,151 @@
+from typing import Iterable
+import numpy as np
+import pandas as pd
+
+from gaclasses import Configuration, Essai, Synthese, Traduction
+
+SECTION_TYPES: tuple[str, ...] = (
+    Synthese.submission_type(),
+    Essai.submission_type(),
+    Traduction.submission_type(),
+)
+TOTAL_COLUMN: str = "Total"
+MAX_SCORE: int = 20
+
+
+def section_weights(config: Configuration) -> dict[str, float]:
+    """Returns the weight of each section of a mock exam, as set on the configuration page."""
+    return {
+        Synthese.submission_type(): config.synthese_weight,
+        Essai.submission_type(): config.essai_weight,
+        Traduction.submission_type(): config.traduction_weight,
+    }
+
+
+class GradeTable:
+    """
+    Table of the section grades and weighted totals of the papers of one or more batches.
+
+    The grades are kept in a DataFrame indexed by paper (the Markdown file name of the
+    submission), with one column per section and the weighted total, so that totals, rankings
+    and distributions are computed column-wise over whole archives at once.  Recording a grade
+    only recomputes the total of its paper.  Papers with ungraded sections get the weighted
+    average of their graded sections.
+
+    Example:
+        table = GradeTable(section_weights(config))
+        table.record("Dupont - exam.md", "Essai", 14, name="Jean Dupont", batch="Mock exam 3")
+        print(table.frame, table.ranks())
+    """
+
+    def __init__(self, weights: dict[str, float]) -> None:
+        self.weights = weights
+        self._weights: np.ndarray = np.array(
+            [weights[section] for section in SECTION_TYPES], dtype=float
+        )
+        self.frame: pd.DataFrame = pd.DataFrame(
+            {
+                "name": pd.Series(dtype="string"),
+                "batch": pd.Series(dtype="string"),
+                **{
+                    column: pd.Series(dtype="float64")
+                    for column in (*SECTION_TYPES, TOTAL_COLUMN)
+                },
+            }
+        )
+
+    @classmethod
+    def from_frame(cls, weights: dict[str, float], frame: pd.DataFrame) -> "GradeTable":
+        """Builds a table from the section grades of a DataFrame, e.g. several archived batches."""
+        table = cls(weights)
+        table.frame = pd.concat(
+            [table.frame, frame[table.frame.columns.drop(TOTAL_COLUMN)]]
+        )
+        table.frame[TOTAL_COLUMN] = table.weighted_totals(table.frame)
+        return table
+
+    def set_weights(self, weights: dict[str, float]) -> None:
+        """Changes the section weights and recomputes all the totals."""
+        self.weights = weights
+        self._weights = np.array(
+            [weights[section] for section in SECTION_TYPES], dtype=float
+        )
+        self.frame[TOTAL_COLUMN] = self.weighted_totals(self.frame)
+
+    def weighted_totals(self, frame: pd.DataFrame) -> pd.Series:
+        """Computes the weighted totals of the rows of a frame, ignoring the ungraded sections."""
+        scores: np.ndarray = frame[list(SECTION_TYPES)].to_numpy(dtype=float)
+        graded: np.ndarray = ~np.isnan(scores)
+        weight_sums: np.ndarray = graded @ self._weights
+        weighted_sums: np.ndarray = np.where(graded, scores, 0.0) @ self._weights
+        with np.errstate(invalid="ignore", divide="ignore"):
+            totals: np.ndarray = np.where(
+                weight_sums > 0, weighted_sums / weight_sums, np.nan
+            )
+        return pd.Series(totals, index=frame.index, dtype="float64")
+
+    def record(
+        self,
+        key: str,
+        section_type: str,
+        score: float | None,
+        name: str | None = None,
+        batch: str | None = None,
+    ) -> float:
+        """
+        Records the grade of one section of a paper and recomputes the paper's total.
+
+        Args:
+            key (str): The paper, i.e. the Markdown file name of the submission.
+            section_type (str): One of SECTION_TYPES.
+            score (float | None): The grade out of MAX_SCORE, or None to clear it.
+            name (str | None): The student's name, kept if None.
+            batch (str | None): The name of the paper's batch, kept if None.
+
+        Returns:
+            float: The new weighted total of the paper, NaN if no section is graded.
+        """
+        if section_type not in SECTION_TYPES:
+            raise ValueError(f"Unknown section type {section_type}")
+        # Setting a single cell with loc adds a missing paper without changing the column types
+        self.frame.loc[key, section_type] = np.nan if score is None else float(score)
+        if name is not None:
+            self.frame.at[key, "name"] = name
+        if batch is not None:
+            self.frame.at[key, "batch"] = batch
+        total: float = float(self.weighted_totals(self.frame.loc[[key]]).iloc[0])
+        self.frame.at[key, TOTAL_COLUMN] = total
+        return total
+
+    def remove(self, keys: Iterable[str]) -> None:
+        """Removes papers from the table."""
+        self.frame = self.frame.drop(index=list(keys), errors="ignore")
+
+    def ranks(self, by_batch: bool = False) -> pd.Series:
+        """Returns the rank of each paper by weighted total, 1 for the best, within its batch if by_batch."""
+        totals: pd.Series = self.frame[TOTAL_COLUMN]
+        if by_batch:
+            totals = totals.groupby(self.frame["batch"], dropna=False)
+        return totals.rank(ascending=False, method="min").astype("Int64")
+
+    def statistics(self, by_batch: bool = False) -> pd.DataFrame:
+        """Returns the count, mean, standard deviation, extremes and quartiles of each section and of the total."""
+        columns: list[str] = [*SECTION_TYPES, TOTAL_COLUMN]
+        if by_batch:
+            return self.frame.groupby("batch", dropna=False)[columns].describe()
+        return self.frame[columns].describe()
+
+    def distribution(self, bin_width: int = 2) -> pd.DataFrame:
+        """Returns the number of papers per grade range, for each section and the total."""
+        edges: np.ndarray = np.arange(0, MAX_SCORE + bin_width, bin_width)
+        counts: dict[str, np.ndarray] = {}
+        for column in (*SECTION_TYPES, TOTAL_COLUMN):
+            scores: np.ndarray = self.frame[column].to_numpy(dtype=float)
+            counts[column] = np.histogram(scores[~np.isnan(scores)], bins=edges)[0]
+        return pd.DataFrame(
+            counts,
+            index=pd.Index(
+                [f"{low:g}-{high:g}" for low, high in zip(edges[:-1], edges[1:])],
+                name="grade",
+            ),
+        )
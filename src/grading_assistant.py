@@ -38,23 +38,26 @@ def init() -> None:
     init_config()
 
 
-st.set_page_config(page_title="Grading Assistant", page_icon="📚", layout="wide")
+if __name__ == "__main__":
+    st.set_page_config(page_title="Grading Assistant", page_icon="📚", layout="wide")
 
-init()
+    init()
 
-welcome_page: StreamlitPage = st.Page(
-    "welcome_page.py", title="Welcome", icon=":material/home:"
-)
+    welcome_page: StreamlitPage = st.Page(
+        "welcome_page.py", title="Welcome", icon=":material/home:"
+    )
 
-config_page: StreamlitPage = st.Page(
-    "configuration_page.py", title="Configuration Settings", icon=":material/settings:"
-)
-grading_page: StreamlitPage = st.Page(
-    "mock_exam_grading_page.py", title="Mock Exam Grading", icon="📝"
-)
+    config_page: StreamlitPage = st.Page(
+        "configuration_page.py",
+        title="Configuration Settings",
+        icon=":material/settings:",
+    )
+    grading_page: StreamlitPage = st.Page(
+        "mock_exam_grading_page.py", title="Mock Exam Grading", icon="📝"
+    )
 
-pg: StreamlitPage = st.navigation([welcome_page, grading_page, config_page])
+    pg: StreamlitPage = st.navigation([welcome_page, grading_page, config_page])
 
-st.header("Professor Ghanem's Grading Assistant", divider=True)
+    st.header("Professor Ghanem's Grading Assistant", divider=True)
 
-pg.run()
+    pg.run()
@@ -0,0 +1,502 @@
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Callable, Iterator
+import httpx
+from openai import APITimeoutError, OpenAI
+from openai.types.beta.threads.run import Run
+from pydantic import BaseModel, Field
+
+from assessment_cache import (
+    assessment_cache_key,
+    get_assistant,
+    get_assistant_fingerprint,
+    get_cached_assessment,
+    put_cached_assessment,
+)
+from assessment_extractor import extract_assessment
+from gaclasses import Assessment, Configuration, MockExam, Submission
+from prompt_usage import usage_tally
+from rate_limiter import estimate_grading_tokens, scheduler, without_retries
+
+DEFAULT_GRADING_CONCURRENCY: int = 4
+RUN_DEADLINE_SECONDS: float = 300.0
+# Longest wait for the next event of a streamed run before giving it up as stalled
+STREAM_READ_TIMEOUT_SECONDS: float = 60.0
+GRADE_PROMPT: str = "Grade this text per instructions: {text}"
+TERMINAL_RUN_STATUSES: frozenset[str] = frozenset(
+    {"completed", "failed", "expired", "cancelled", "incomplete", "requires_action"}
+)
+STREAM_REFRESH_SECONDS: float = 0.25
+
+# Called with the assessment written so far while a section is streamed
+TextCallback = Callable[[str], None]
+# Called with the exam key, section type and assessment written so far, from worker threads
+SectionTextCallback = Callable[[str, str, str], None]
+
+
+class SectionGrade(BaseModel):
+    """Result of grading one section of a mock exam on a worker thread."""
+
+    exam_key: str = Field(
+        ..., description="Key of the mock exam the section belongs to"
+    )
+    section: Submission = Field(..., description="The section that was graded")
+    assessment: str = Field(
+        ..., description="Assessment text returned by the assistant"
+    )
+    error: str | None = Field(
+        None, description="Error message if grading failed, None otherwise"
+    )
+    cached: bool = Field(
+        False, description="Whether the assessment was reused from the assessment cache"
+    )
+    batch_graded: bool = Field(
+        False,
+        description="Whether the assessment was written by an OpenAI Batch API job, without the assistant's tools",
+    )
+    parsed: Assessment | None = Field(
+        None,
+        description="Score and error counts of the assessment, None if unavailable",
+    )
+
+
+class AssistantRunError(Exception):
+    """Raised when an assistant run ends in a state other than completed."""
+
+    def __init__(self, run: Run, message: str) -> None:
+        super().__init__(message)
+        self.run = run
+
+
+def wait_for_run(
+    client: OpenAI,
+    run: Run,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+    initial_interval: float = 0.5,
+    max_interval: float = 5.0,
+) -> Run:
+    """
+    Waits for an assistant run to reach a terminal state, refreshing its status with backoff.
+
+    The polling interval starts at initial_interval and doubles up to max_interval, or follows the
+    interval suggested by the API when it sends one.  A run still active at the deadline, or one
+    that requires an action we cannot perform, is cancelled.
+
+    Args:
+        client: OpenAI client used to refresh the run.
+        run: The run returned by runs.create.
+        deadline_seconds (float): Maximum time to wait for the run.
+        initial_interval (float): First polling interval in seconds.
+        max_interval (float): Largest polling interval in seconds.
+
+    Returns:
+        Run: The completed run.
+
+    Raises:
+        AssistantRunError: If the run fails, expires, is cancelled, requires an action or misses the deadline.
+    """
+    deadline: float = time.monotonic() + deadline_seconds
+    interval: float = initial_interval
+    while run.status not in TERMINAL_RUN_STATUSES:
+        remaining: float = deadline - time.monotonic()
+        if remaining <= 0:
+            cancel_run(client, run)
+            raise AssistantRunError(
+                run, f"Run {run.id} did not complete within {deadline_seconds}s"
+            )
+        print(f"Waiting for run {run.id} to complete, status is {run.status}...")
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, max_interval)
+        response = client.beta.threads.runs.with_raw_response.retrieve(
+            thread_id=run.thread_id, run_id=run.id
+        )
+        poll_interval_ms: str | None = response.headers.get("openai-poll-after-ms")
+        if poll_interval_ms is not None:
+            interval = min(int(poll_interval_ms) / 1000, max_interval)
+        run = response.parse()
+
+    if run.status == "completed":
+        return run
+    if run.status == "requires_action":
+        cancel_run(client, run)
+        raise AssistantRunError(
+            run, f"Run {run.id} requires an action, which grading does not support"
+        )
+    raise AssistantRunError(run, run_error_message(run))
+
+
+def run_error_message(run: Run) -> str:
+    """Describes why a run ended in a state other than completed."""
+    error_detail: str = (
+        run.last_error.message
+        if run.last_error is not None
+        else (run.incomplete_details.reason if run.incomplete_details else "")
+    )
+    return f"Run {run.id} ended as {run.status}: {error_detail}"
+
+
+def cancel_run(client: OpenAI, run: Run) -> None:
+    """Cancels a run, ignoring errors since it may have ended in the meantime."""
+    try:
+        client.beta.threads.runs.cancel(thread_id=run.thread_id, run_id=run.id)
+        print(f"Run {run.id} cancelled.")
+    except Exception as e:
+        print(f"Error cancelling run {run.id}: {e}")
+
+
+def call_assistant(
+    client: OpenAI,
+    assistant_id: str,
+    msg: str,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+    word_count: int | None = None,
+    on_text: TextCallback | None = None,
+) -> str:
+    """
+    Grades a text with an OpenAI assistant on a fresh thread, within the assistant's rate limits.
+
+    This function does not touch the Streamlit session, so it is safe to call from worker threads.
+    The run is paced by the shared rate limit scheduler within the limits of the assistant's
+    model, and retried if it is rate limited.  With on_text, the run is streamed and on_text is
+    called with the answer written so far as it grows, starting over if the run is retried.
+
+    Args:
+        client: OpenAI client used for the Assistants API calls.
+        assistant_id (str): The ID of the grading assistant.
+        msg (str): The markdown text to grade.
+        deadline_seconds (float): Maximum time to wait for the grading run.
+        word_count (int | None): Word count of the text, used to estimate its tokens.
+        on_text: Called from the calling thread with the partial answer, to stream the run.
+
+    Returns:
+        str: The text of the assistant's answer.
+
+    Raises:
+        AssistantRunError: If the grading run does not complete.
+    """
+    tokens: int = estimate_grading_tokens(word_count or len(msg.split()))
+    answer, run = scheduler.call(
+        get_assistant(client, assistant_id).model,
+        tokens,
+        lambda: (
+            run_assistant(client, assistant_id, msg, deadline_seconds)
+            if on_text is None
+            else stream_assistant(client, assistant_id, msg, on_text, deadline_seconds)
+        ),
+        usage=lambda result: run_usage(result[1]),
+    )
+    usage_tally.record(assistant_id, run.usage)
+    return answer
+
+
+def grading_thread(msg: str) -> dict[str, Any]:
+    """Returns the thread holding the grading request of a text, for threads.create_and_run."""
+    return {"messages": [{"role": "user", "content": GRADE_PROMPT.format(text=msg)}]}
+
+
+def run_assistant(
+    client: OpenAI,
+    assistant_id: str,
+    msg: str,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+) -> tuple[str, Run]:
+    """
+    Grades a text with an assistant on a fresh thread, returning its answer and completed run.
+
+    The thread, its message and the run are created by a single request, and the thread is
+    deleted in the background afterwards.
+    """
+    print(f"Calling assistant {assistant_id} with message: {len(msg)} chars.")
+    run: Run = without_retries(client).beta.threads.create_and_run(
+        assistant_id=assistant_id, thread=grading_thread(msg)
+    )
+    print(f"Run created: {run.id} on thread {run.thread_id}")
+    try:
+        run = wait_for_run(client, run, deadline_seconds)
+        msgs = client.beta.threads.messages.list(thread_id=run.thread_id, run_id=run.id)
+        for m in msgs:
+            print(f"{m.role}: {len(m.content[0].text.value)} chars")
+        return msgs.data[0].content[0].text.value, run
+    finally:
+        thread_cleaner.schedule(client, run.thread_id)
+
+
+def stream_assistant(
+    client: OpenAI,
+    assistant_id: str,
+    msg: str,
+    on_text: TextCallback,
+    deadline_seconds: float = RUN_DEADLINE_SECONDS,
+) -> tuple[str, Run]:
+    """
+    Grades a text with an assistant on a fresh thread, streaming its answer to on_text as it is written.
+
+    The deadline is checked on every event of the run, and reading the next event times out after
+    STREAM_READ_TIMEOUT_SECONDS, so that a stream that stalls without sending events is given up
+    like a run polled past its deadline.
+    """
+    print(f"Streaming assistant {assistant_id} with message: {len(msg)} chars.")
+    deadline: float = time.monotonic() + deadline_seconds
+    text: str = ""
+    with without_retries(client).with_options(
+        timeout=min(STREAM_READ_TIMEOUT_SECONDS, deadline_seconds)
+    ).beta.threads.create_and_run_stream(
+        assistant_id=assistant_id, thread=grading_thread(msg)
+    ) as stream:
+        try:
+            try:
+                for event in stream:
+                    if event.event == "thread.message.delta":
+                        for content in event.data.delta.content or []:
+                            if (
+                                content.type == "text"
+                                and content.text
+                                and content.text.value
+                            ):
+                                text += content.text.value
+                        on_text(text)
+                    if time.monotonic() > deadline and stream.current_run is not None:
+                        cancel_run(client, stream.current_run)
+                        raise AssistantRunError(
+                            stream.current_run,
+                            f"Run {stream.current_run.id} did not complete within {deadline_seconds}s",
+                        )
+            # Timeouts reading the events are raised by httpx, not wrapped by the SDK
+            except (APITimeoutError, httpx.TimeoutException) as e:
+                if stream.current_run is None:
+                    raise
+                cancel_run(client, stream.current_run)
+                raise AssistantRunError(
+                    stream.current_run,
+                    f"Run {stream.current_run.id} sent no event for {STREAM_READ_TIMEOUT_SECONDS}s",
+                ) from e
+            run: Run = stream.get_final_run()
+            if run.status != "completed":
+                raise AssistantRunError(run, run_error_message(run))
+            # The final message also holds the annotations added to the streamed text
+            return stream.get_final_messages()[-1].content[0].text.value, run
+        finally:
+            if stream.current_run is not None:
+                thread_cleaner.schedule(client, stream.current_run.thread_id)
+
+
+class ThreadCleaner:
+    """
+    Deletes the threads of finished grading runs on a background thread.
+
+    Deleting a thread does not affect its assessment, so it is taken off the grading path:
+    schedule returns at once, and a single daemon thread deletes the scheduled threads one by
+    one.  drain waits for the pending deletions, e.g. before a script exits.
+    """
+
+    def __init__(self) -> None:
+        self._pending: queue.Queue[tuple[OpenAI, str]] = queue.Queue()
+        self._worker: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    def schedule(self, client: OpenAI, thread_id: str) -> None:
+        """Queues the deletion of a thread."""
+        self._pending.put((client, thread_id))
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(
+                    target=self._run, name="thread-cleaner", daemon=True
+                )
+                self._worker.start()
+
+    def _run(self) -> None:
+        while True:
+            client, thread_id = self._pending.get()
+            try:
+                client.beta.threads.delete(thread_id)
+                print(f"Thread {thread_id} deleted.")
+            except Exception as e:
+                print(f"Error deleting thread {thread_id}: {e}")
+            finally:
+                self._pending.task_done()
+
+    def drain(self, timeout: float = 30.0) -> None:
+        """Waits up to timeout seconds for the scheduled deletions to be done."""
+        deadline: float = time.monotonic() + timeout
+        while self._pending.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+
+# Shared by all the sessions of the Streamlit server process and their worker threads
+thread_cleaner = ThreadCleaner()
+atexit.register(thread_cleaner.drain)
+
+
+def run_usage(run: Run) -> int | None:
+    """Returns the total number of tokens used by a completed run, if reported."""
+    return run.usage.total_tokens if run.usage is not None else None
+
+
+def grade_text(
+    client: OpenAI,
+    assistant_id: str,
+    msg: str,
+    force_regrade: bool = False,
+    word_count: int | None = None,
+    on_text: TextCallback | None = None,
+) -> tuple[str, bool]:
+    """
+    Grades a text with an assistant, reusing a recent assessment of the same text if there is one.
+
+    Args:
+        client: OpenAI client used for the Assistants API calls.
+        assistant_id (str): The ID of the grading assistant.
+        msg (str): The markdown text to grade.
+        force_regrade (bool): Ignore any cached assessment and grade the text again.
+        word_count (int | None): Word count of the text, used to estimate its tokens.
+        on_text: Called with the partial assessment, to stream the grading run.
+
+    Returns:
+        tuple[str, bool]: The assessment and whether it came from the cache.
+    """
+    key: str = assessment_cache_key(
+        assistant_id, get_assistant_fingerprint(client, assistant_id), msg
+    )
+    if not force_regrade:
+        cached: str | None = get_cached_assessment(key)
+        if cached is not None:
+            print(f"Using cached assessment {key} from assistant {assistant_id}.")
+            return cached, True
+    assessment: str = call_assistant(
+        client, assistant_id, msg, word_count=word_count, on_text=on_text
+    )
+    put_cached_assessment(key, assessment)
+    return assessment, False
+
+
+def grade_section_task(
+    client: OpenAI,
+    config: Configuration,
+    exam_key: str,
+    section: Submission,
+    force_regrade: bool = False,
+    on_text: SectionTextCallback | None = None,
+    batch_assessment: str | None = None,
+) -> SectionGrade:
+    """
+    Grades a single section, capturing any error in the returned SectionGrade.
+
+    A section already graded by an OpenAI Batch API job is given its batch_assessment, which is
+    only parsed.
+    """
+    try:
+        if batch_assessment is not None:
+            assessment, cached = batch_assessment, False
+        else:
+            assessment, cached = grade_text(
+                client,
+                section.get_assistant_id(config),
+                section.markdown_content,
+                force_regrade,
+                section.word_count,
+                (
+                    None
+                    if on_text is None
+                    else lambda text: on_text(exam_key, section.submission_type(), text)
+                ),
+            )
+        return SectionGrade(
+            exam_key=exam_key,
+            section=section,
+            assessment=assessment,
+            cached=cached,
+            batch_graded=batch_assessment is not None,
+            parsed=parse_section_assessment(client, exam_key, section, assessment),
+        )
+    except Exception as e:
+        print(f"Error grading section {section.submission_type()} of {exam_key}: {e}")
+        return SectionGrade(
+            exam_key=exam_key,
+            section=section,
+            assessment="Error grading section",
+            error=str(e),
+        )
+
+
+def parse_section_assessment(
+    client: OpenAI, exam_key: str, section: Submission, assessment: str
+) -> Assessment | None:
+    """Extracts the score and error counts of a section assessment, returning None on failure."""
+    try:
+        return extract_assessment(client, assessment)
+    except Exception as e:
+        # The assessment text is still usable without its structured data
+        print(
+            f"Error extracting the assessment of {section.submission_type()} of {exam_key}: {e}"
+        )
+        return None
+
+
+def exam_sections(exam: MockExam) -> list[Submission]:
+    """Returns the gradable sections of a mock exam in assessment order."""
+    return [exam.synthese, exam.essai, exam.traduction]
+
+
+def grade_sections(
+    client: OpenAI,
+    config: Configuration,
+    exams: dict[str, MockExam],
+    max_workers: int = DEFAULT_GRADING_CONCURRENCY,
+    force_regrade: bool = False,
+    on_text: SectionTextCallback | None = None,
+    on_wait: Callable[[], None] | None = None,
+    batch_assessments: dict[tuple[str, str], str] | None = None,
+) -> Iterator[SectionGrade]:
+    """
+    Grades all the sections of several mock exams over a bounded worker pool.
+
+    The sections are graded concurrently and yielded as soon as each one is done, so the
+    caller (usually the Streamlit script thread) can report progress and upload results.
+    With on_text, the grading runs are streamed, and on_text is called from the worker threads
+    with the assessments written so far; on_wait is then called from the calling thread every
+    STREAM_REFRESH_SECONDS while waiting, e.g. to show them.
+
+    Args:
+        client: OpenAI client shared by the worker threads.
+        config: Configuration holding the assistant IDs.
+        exams: Mock exams to grade, keyed by their markdown file name.
+        max_workers (int): Maximum number of sections graded at the same time.
+        force_regrade (bool): Grade every section again even if it has a cached assessment.
+        on_text: Called with the exam key, section type and partial assessment of a section.
+        on_wait: Called on the calling thread while waiting for the sections.
+        batch_assessments: Assessments already written by an OpenAI Batch API job, by exam key
+            and section type; these sections are not graded again.
+
+    Returns:
+        Iterator[SectionGrade]: The graded sections, in completion order.
+    """
+    with ThreadPoolExecutor(
+        max_workers=max(1, max_workers), thread_name_prefix="grader"
+    ) as executor:
+        pending: set[Future[SectionGrade]] = {
+            executor.submit(
+                grade_section_task,
+                client,
+                config,
+                exam_key,
+                section,
+                force_regrade,
+                on_text,
+                (batch_assessments or {}).get((exam_key, section.submission_type())),
+            )
+            for exam_key, exam in exams.items()
+            for section in exam_sections(exam)
+        }
+        while pending:
+            done, pending = wait(
+                pending,
+                timeout=None if on_wait is None else STREAM_REFRESH_SECONDS,
+                return_when=FIRST_COMPLETED,
+            )
+            if on_wait is not None:
+                on_wait()
+            for future in done:
+                yield future.result()
@@ -0,0 +1,127 @@
+"""
+Runs the grading jobs queued by the grading page, outside of the Streamlit server.
+
+Start one or more workers next to the app, from the directory the app is started from so that
+they read the same .streamlit/secrets.toml:
+
+    python src/grading_worker.py --concurrency 8
+"""
+
+import argparse
+import os
+import socket
+import time
+import streamlit as st
+from googleapiclient.discovery import Resource
+
+from batch_manifest import BatchManifest
+from batch_runner import (
+    deliver_assessments,
+    grade_exams,
+    register_markdown_files,
+    split_submissions,
+)
+from gaclasses import Configuration, MockExam
+from grading_assistant import init
+from job_queue import JOB_POLL_SECONDS, Job, JobQueue
+from mock_exam_grading_page import ensure_batch_directory
+
+
+def run_job(queue: JobQueue, job: Job) -> None:
+    """Splits, grades, converts and emails the mock exams of a job, reporting progress to the queue."""
+
+    def on_progress(message: str) -> None:
+        print(f"Job {job.id}: {message}")
+        queue.report_progress(job.id, message)
+
+    drive_service: Resource = st.session_state.drive_service
+    config: Configuration = st.session_state.config
+    batch_dir_id: str | None = ensure_batch_directory(drive_service, job.batch_name)
+    if batch_dir_id is None:
+        raise RuntimeError(f"Batch directory {job.batch_name} not found")
+    # Reload the manifest for every job, the page and other workers may have updated it
+    manifest: BatchManifest = BatchManifest.load_from_drive(
+        drive_service, batch_dir_id, job.batch_name
+    )
+    register_markdown_files(drive_service, batch_dir_id, manifest, dry_run=False)
+    if job.force_regrade:
+        # Regrading restarts the exams from their split
+        for key in job.exam_keys:
+            if manifest.state(key).has_completed("graded"):
+                manifest.record(None, key, "split")
+    exams: dict[str, MockExam] = split_submissions(
+        drive_service, batch_dir_id, manifest, job.exam_keys, on_progress
+    )
+    grade_exams(
+        drive_service,
+        batch_dir_id,
+        manifest,
+        exams,
+        config,
+        job.force_regrade,
+        on_progress,
+    )
+    deliver_assessments(drive_service, batch_dir_id, manifest, exams, on_progress)
+    failed: list[str] = [
+        key
+        for key in job.exam_keys
+        if key in manifest.submissions and manifest.submissions[key].error is not None
+    ]
+    if failed:
+        raise RuntimeError(
+            "; ".join(f"{key}: {manifest.submissions[key].error}" for key in failed)
+        )
+
+
+def run_jobs(queue: JobQueue, worker: str, args: argparse.Namespace) -> None:
+    """Claims and runs the queued jobs one at a time, until the queue is empty if args.once."""
+    while True:
+        # Lets the page tell that a worker is there to run the jobs it queues
+        queue.worker_heartbeat(worker)
+        job: Job | None = queue.claim(worker)
+        if job is None:
+            if args.once:
+                return
+            time.sleep(JOB_POLL_SECONDS)
+            continue
+        print(f"Running job {job.id} for {job.exam_keys} in batch {job.batch_name}...")
+        try:
+            # Pick up the settings changed on the configuration page since the last job
+            st.session_state.config = Configuration.load_from_drive(None)
+            if args.concurrency is not None:
+                st.session_state.config.grading_concurrency = args.concurrency
+            run_job(queue, job)
+            queue.finish(job.id)
+            print(f"✅ Job {job.id} done.")
+        except Exception as e:
+            print(f"❌ Job {job.id} failed: {e}")
+            queue.finish(job.id, str(e))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Run the grading jobs queued by the grading page."
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        help="Number of sections graded at the same time, defaults to the configuration's.",
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="Exit when the queue is empty instead of waiting for new jobs.",
+    )
+    args: argparse.Namespace = parser.parse_args()
+    init()
+    worker: str = f"{socket.gethostname()}-{os.getpid()}"
+    queue = JobQueue()
+    print(f"Grading worker {worker} waiting for jobs in {queue.path}...")
+    try:
+        run_jobs(queue, worker, args)
+    finally:
+        queue.worker_stopped(worker)
+
+
+if __name__ == "__main__":
+    main()
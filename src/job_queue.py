@@ -0,0 +1,188 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Any
+from pydantic import BaseModel, Field
+
+from cache_store import DEFAULT_CACHE_DIRECTORY
+
+JOB_STATUSES: tuple[str, ...] = ("queued", "running", "done", "failed", "cancelled")
+# Running jobs whose worker did not report progress for this long are handed to another worker
+STALE_JOB_SECONDS: float = 900
+JOB_POLL_SECONDS: float = 2.0
+# Workers that did not poll the queue for this long are considered stopped
+WORKER_TIMEOUT_SECONDS: float = 60
+
+
+class Job(BaseModel):
+    """A grading job submitted by the grading page and run by a grading worker process."""
+
+    id: int = Field(..., description="Job ID")
+    batch_name: str = Field(..., description="Name of the batch of the mock exams")
+    exam_keys: list[str] = Field(
+        ..., description="Markdown file names of the mock exams to grade"
+    )
+    force_regrade: bool = Field(
+        False, description="Grade again even the sections with a cached assessment"
+    )
+    status: str = Field("queued", description="One of JOB_STATUSES")
+    progress: str = Field("", description="Last progress message of the worker")
+    error: str | None = Field(None, description="Error message if the job failed")
+    worker: str | None = Field(None, description="Name of the worker running the job")
+    created: float = Field(..., description="Submission time, as a UNIX timestamp")
+    heartbeat: float | None = Field(
+        None, description="Time of the last progress report, as a UNIX timestamp"
+    )
+    finished: float | None = Field(
+        None, description="Completion time, as a UNIX timestamp"
+    )
+
+    def is_active(self) -> bool:
+        return self.status in ("queued", "running")
+
+
+class JobQueue:
+    """
+    Grading job queue stored in a local SQLite database.
+
+    The Streamlit server and the grading workers are separate processes sharing the database
+    file: the page submits jobs and polls their status, and the workers claim queued jobs one at
+    a time.  Jobs therefore survive Streamlit reruns, and several sessions can queue work at once.
+    """
+
+    def __init__(self, path: str | None = None) -> None:
+        if path is None:
+            os.makedirs(DEFAULT_CACHE_DIRECTORY, exist_ok=True)
+            path = os.path.join(DEFAULT_CACHE_DIRECTORY, "jobs.sqlite")
+        self.path = path
+        self._lock = threading.Lock()
+        # Transactions are opened explicitly, so that claiming a job locks out the other workers
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, timeout=30, isolation_level=None
+        )
+        self._connection.row_factory = sqlite3.Row
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT, batch_name TEXT NOT NULL,"
+                " exam_keys TEXT NOT NULL, force_regrade INTEGER NOT NULL,"
+                " status TEXT NOT NULL, progress TEXT NOT NULL, error TEXT, worker TEXT,"
+                " created REAL NOT NULL, heartbeat REAL, finished REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS workers (name TEXT PRIMARY KEY, heartbeat REAL NOT NULL)"
+            )
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Job:
+        data: dict[str, Any] = dict(row)
+        data["exam_keys"] = json.loads(data["exam_keys"])
+        data["force_regrade"] = bool(data["force_regrade"])
+        return Job(**data)
+
+    def _execute(self, sql: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        with self._lock:
+            return self._connection.execute(sql, parameters)
+
+    def submit(
+        self, batch_name: str, exam_keys: list[str], force_regrade: bool = False
+    ) -> int:
+        """Queues a grading job and returns its ID."""
+        cursor: sqlite3.Cursor = self._execute(
+            "INSERT INTO jobs (batch_name, exam_keys, force_regrade, status, progress, created)"
+            " VALUES (?, ?, ?, 'queued', '', ?)",
+            (batch_name, json.dumps(exam_keys), int(force_regrade), time.time()),
+        )
+        print(f"Queued grading job {cursor.lastrowid} for {exam_keys}.")
+        return cursor.lastrowid
+
+    def get(self, job_id: int) -> Job | None:
+        row: sqlite3.Row | None = self._execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return None if row is None else self._job(row)
+
+    def recent(self, batch_name: str | None = None, limit: int = 20) -> list[Job]:
+        """Returns the most recent jobs, optionally only those of a batch."""
+        if batch_name is None:
+            rows = self._execute(
+                "SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        else:
+            rows = self._execute(
+                "SELECT * FROM jobs WHERE batch_name = ? ORDER BY id DESC LIMIT ?",
+                (batch_name, limit),
+            ).fetchall()
+        return [self._job(row) for row in rows]
+
+    def claim(self, worker: str) -> Job | None:
+        """Marks the oldest queued or stale job as running by worker and returns it."""
+        now: float = time.time()
+        with self._lock:
+            # BEGIN IMMEDIATE takes the write lock, so two workers cannot claim the same job
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                row: sqlite3.Row | None = self._connection.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued'"
+                    " OR (status = 'running' AND heartbeat < ?) ORDER BY id LIMIT 1",
+                    (now - STALE_JOB_SECONDS,),
+                ).fetchone()
+                if row is not None:
+                    self._connection.execute(
+                        "UPDATE jobs SET status = 'running', worker = ?, heartbeat = ?,"
+                        " progress = 'Started' WHERE id = ?",
+                        (worker, now, row["id"]),
+                    )
+                self._connection.execute("COMMIT")
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+        return None if row is None else self.get(row["id"])
+
+    def worker_heartbeat(self, worker: str) -> None:
+        """Records that a worker is polling the queue, whether or not it is running a job."""
+        self._execute(
+            "INSERT INTO workers (name, heartbeat) VALUES (?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET heartbeat = excluded.heartbeat",
+            (worker, time.time()),
+        )
+
+    def worker_stopped(self, worker: str) -> None:
+        self._execute("DELETE FROM workers WHERE name = ?", (worker,))
+
+    def live_workers(self) -> list[str]:
+        """Returns the workers that polled the queue recently, or are running a job that is not stale."""
+        now: float = time.time()
+        # Workers do not poll the queue while they run a job
+        rows = self._execute(
+            "SELECT name FROM workers WHERE heartbeat >= ?"
+            " UNION SELECT worker FROM jobs WHERE status = 'running' AND heartbeat >= ?",
+            (now - WORKER_TIMEOUT_SECONDS, now - STALE_JOB_SECONDS),
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def report_progress(self, job_id: int, progress: str) -> None:
+        """Records a progress message of a running job, which also serves as its heartbeat."""
+        self._execute(
+            "UPDATE jobs SET progress = ?, heartbeat = ? WHERE id = ?",
+            (progress, time.time(), job_id),
+        )
+
+    def finish(self, job_id: int, error: str | None = None) -> None:
+        """Marks a running job as done, or as failed if an error is given."""
+        self._execute(
+            "UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ?",
+            ("done" if error is None else "failed", error, time.time(), job_id),
+        )
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancels a job that no worker has claimed yet, returning True if it was cancelled."""
+        cursor: sqlite3.Cursor = self._execute(
+            "UPDATE jobs SET status = 'cancelled', finished = ?"
+            " WHERE id = ? AND status = 'queued'",
+            (time.time(), job_id),
+        )
+        return cursor.rowcount > 0
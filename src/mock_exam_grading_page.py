@@ -1,38 +1,54 @@
 from os import error
-import time
 import pprint
-from threading import Thread
+import threading
 import docx
 from openai import OpenAI
-from openai.types.beta.threads.run import Run
 from referencing import Resource
 import streamlit as st
 from pprint import pprint
 from typing import Any
 
-from gaclasses import Assessment, MockExam, Submission
+from gaclasses import (
+    Assessment,
+    Configuration,
+    MockExam,
+    MockExamAssessment,
+    Submission,
+)
+from batch_manifest import BatchManifest, SubmissionState
+from cache_store import get_cache_store
+from conversion_service import convert_gdrive_files_to_markdown
+from exam_splitter import SPLIT_CACHE_NAMESPACE, split_mock_exam
+from grading_engine import SectionGrade, grade_sections
+from error_aggregate import BatchErrorAggregate, error_pie_chart, error_section_chart
+from excel_writer import BatchWorkbookWriter, grade_row
+from exam_loader import can_load_mock_exam, exam_metadata, load_mock_exam
+from grade_table import SECTION_TYPES, TOTAL_COLUMN, GradeTable, section_weights
+from job_queue import JOB_POLL_SECONDS, Job, JobQueue
+from prompt_usage import PromptUsage, usage_report, usage_tally
 from gdrive import (
-    convert_gdrive_file_to_markdown,
     convert_gdrive_file_to_docx,
     ensure_gdrive_directory,
     get_gdrive_file_creation_date,
     get_gdrive_file_name,
     get_gdrive_markdown_text,
+    iter_gdrive_files,
     list_gdrive_files,
     upload_markdown_to_gdrive,
+    upload_markdowns_to_gdrive,
     send_email_with_gdrive_attachment,
+    sync_gdrive_folder_index,
 )
 import gdrive
-
-SPLIT_PROMPT: str = """Analyze this student's mock exam in English for a French prépa and split it into three parts for the Synthèse, Essai, and Traduction.
-    The original file ID is {file_id}.
-    The original file name is {file_name}.
-    The date of the file is {file_date}.
-    """
+from gdrive_batch import get_gdrive_files_metadata
 
 
 def generate_mock_exam(
-    drive_service: Any, batch_dir_id: str, md_file_id: str, md_file: str
+    drive_service: Any,
+    batch_dir_id: str,
+    md_file_id: str,
+    md_file: str,
+    md_file_date: str | None = None,
 ) -> MockExam | None:
     client: OpenAI = st.session_state.openai_client
     md_text: str | None = get_gdrive_markdown_text(
@@ -41,33 +57,33 @@ def generate_mock_exam(
     if md_text is None:
         return None
     try:
-        md_file_date: str = get_gdrive_file_creation_date(drive_service, md_file_id)
-        final_prompt: str = SPLIT_PROMPT.format(
-            file_id=md_file_id,
-            file_name=md_file,
-            file_date=md_file_date or "unknown",
-        )
-        response: Any = client.beta.chat.completions.parse(
-            model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": final_prompt},
-                {"role": "user", "content": md_text},
-            ],
-            response_format=MockExam,
+        if md_file_date is None:
+            md_file_date = get_gdrive_file_creation_date(drive_service, md_file_id)
+        result: MockExam = split_mock_exam(
+            client,
+            md_text,
+            md_file_id,
+            md_file,
+            md_file_date,
+            cache=get_cache_store(SPLIT_CACHE_NAMESPACE),
+            mode=st.session_state.config.split_mode,
         )
     except Exception as e:
         st.error(f"Error generating mock exam: {e}")
         return None
-    result: MockExam = response.choices[0].message.parsed
     return result
 
 
 def email_mock_exam_assessment(
-    drive_service: Resource, mock_exam: MockExam, docx_file_id: str
-) -> None:
+    drive_service: Resource,
+    mock_exam: MockExam,
+    docx_file_id: str,
+    docx_file_name: str | None = None,
+) -> bool:
     """Email the final docx assessment to the professor for validation"""
     prof_email: str = st.secrets["config"]["professor_email"]
-    docx_file_name: str | None = get_gdrive_file_name(drive_service, docx_file_id)
+    if docx_file_name is None:
+        docx_file_name = get_gdrive_file_name(drive_service, docx_file_id)
     print(f"Emailing mock exam result in {docx_file_name} to {prof_email}...")
     email_subject: str = (
         f"Mock Exam grading results for {mock_exam.name} on {mock_exam.date}"
@@ -84,11 +100,13 @@ def email_mock_exam_assessment(
         email_subject,
         email_body,
         docx_file_id,
+        docx_file_name,
     )
     if sent_ok:
         st.success(f"Mock exam for {mock_exam.name} sent to {prof_email}!")
     else:
         st.error(f"Error sending mock exam to {prof_email}!")
+    return sent_ok
 
 
 def write_mock_exam_sections(
@@ -96,17 +114,26 @@ def write_mock_exam_sections(
     batch_dir_id: str,
     md_file_name: str,
     mock_exam: MockExam,
-) -> None:
+) -> dict[str, str] | None:
+    """Writes the sections of a mock exam to the batch folder, returning their file IDs by section type."""
     st.info(f"Writing mock exam sections for {md_file_name}...")
     error: bool = False
-    for section in [mock_exam.synthese, mock_exam.essai, mock_exam.traduction]:
-        section: Submission
+    sections: list[Submission] = [
+        mock_exam.synthese,
+        mock_exam.essai,
+        mock_exam.traduction,
+    ]
+    section_file_ids: dict[str, str | None] = upload_markdowns_to_gdrive(
+        drive_service,
+        batch_dir_id,
+        {
+            f"{md_file_name} - {section.submission_type()}.md": section.markdown_content
+            for section in sections
+        },
+    )
+    for section in sections:
         section_file_name: str = f"{md_file_name} - {section.submission_type()}.md"
-        section_text: str = section.markdown_content
-        section_file_id: str | None = upload_markdown_to_gdrive(
-            drive_service, section_file_name, batch_dir_id, section_text
-        )
-        if section_file_id is None:
+        if section_file_ids[section_file_name] is None:
             st.error(f"Error writing mock exam section {section.submission_type()}!")
             error = True
         else:
@@ -115,9 +142,41 @@ def write_mock_exam_sections(
             )
     if error:
         st.error(f"Error writing mock exam sections for {md_file_name}!")
-    else:
-        st.success(f"Mock exam sections written successfully for {md_file_name}!")
-    return
+        return None
+    st.success(f"Mock exam sections written successfully for {md_file_name}!")
+    return {
+        section.submission_type(): section_file_ids[
+            f"{md_file_name} - {section.submission_type()}.md"
+        ]
+        for section in sections
+    }
+
+
+def get_mock_exam(
+    drive_service: Resource,
+    batch_dir_id: str,
+    manifest: BatchManifest,
+    key: str,
+) -> MockExam | None:
+    """
+    Returns the mock exam of a submission, loading it on demand and keeping it in the session.
+
+    Mock exams split in an earlier session are rebuilt from their section files in the batch
+    folder, the others are split, which the split cache serves for the submissions split before.
+    """
+    exam: MockExam | None = st.session_state.mock_exams.get(key)
+    if exam is not None:
+        return exam
+    state: SubmissionState = manifest.state(key)
+    if can_load_mock_exam(state):
+        exam = load_mock_exam(drive_service, state)
+    if exam is None and state.markdown_file_id is not None:
+        exam = generate_mock_exam(
+            drive_service, batch_dir_id, state.markdown_file_id, key
+        )
+    if exam is not None:
+        st.session_state.mock_exams[key] = exam
+    return exam
 
 
 def ensure_batch_directory(drive_service: Resource[Any], batch_name: str) -> str | None:
@@ -127,6 +186,32 @@ def ensure_batch_directory(drive_service: Resource[Any], batch_name: str) -> str
     return batch_folder_id
 
 
+def get_batch_manifest(
+    drive_service: Resource, batch_dir_id: str, batch_name: str
+) -> BatchManifest:
+    """Returns the manifest of the current batch, loading it from Google Drive when the batch changes."""
+    manifest: BatchManifest | None = st.session_state.get("batch_manifest")
+    if manifest is None or manifest.batch_dir_id != batch_dir_id:
+        manifest = BatchManifest.load_from_drive(
+            drive_service, batch_dir_id, batch_name
+        )
+        st.session_state.batch_manifest = manifest
+    return manifest
+
+
+def get_error_aggregate(
+    drive_service: Resource, batch_dir_id: str, batch_name: str
+) -> BatchErrorAggregate:
+    """Returns the error totals of the current batch, loading them from Google Drive when the batch changes."""
+    aggregate: BatchErrorAggregate | None = st.session_state.get("error_aggregate")
+    if aggregate is None or aggregate.batch_dir_id != batch_dir_id:
+        aggregate = BatchErrorAggregate.load_from_drive(
+            drive_service, batch_dir_id, batch_name
+        )
+        st.session_state.error_aggregate = aggregate
+    return aggregate
+
+
 def filter_md_files(md_files: dict[str, str]) -> dict[str, str]:
     """Filters out files whose base names end with ' - synthese', ' - essai', or ' - traduction'."""
     excluded_suffixes: tuple[str, str, str] = (
@@ -148,39 +233,6 @@ def filter_md_files(md_files: dict[str, str]) -> dict[str, str]:
     return filtered_files
 
 
-def call_assistant(assistant_id: str, msg: str) -> str:
-    print(f"Calling assistant {assistant_id} with message: {len(msg)} chars.")
-    client: OpenAI = st.session_state.openai_client
-    try:
-        thread: Thread = client.beta.threads.create()
-        print(f"Thread created: {thread.id}")
-        msg = client.beta.threads.messages.create(
-            thread_id=thread.id,
-            role="user",
-            content=f"Grade this text per instructions: {msg}",
-        )
-        print(f"Message created: {msg.id}")
-        run: Run = client.beta.threads.runs.create_and_poll(
-            thread_id=thread.id,
-            assistant_id=assistant_id,
-            #           instructions="Grade this text per instructions",
-        )
-        print(f"Run created: {run.id}")
-        while run.status != "completed":
-            print(f"Waiting for run {run.id} to complete, status is {run.status}...")
-            time.sleep(1)
-
-        msgs = client.beta.threads.messages.list(thread_id=thread.id)
-        print(f"Run {run.id} completed, deleting thread {thread.id}...")
-        client.beta.threads.delete(thread.id)
-        for m in msgs:
-            print(f"{m.role}: {len(m.content[0].text.value)} chars")
-        return msgs.data[0].content[0].text.value
-    except Exception as e:
-        st.error(f"Error grading section: {e}")
-        return "Error grading section"
-
-
 def get_assessment(exam: MockExam) -> Assessment:
     st.info(f"Getting assessment for mock exam {exam.description}...")
 
@@ -188,14 +240,23 @@ def get_assessment(exam: MockExam) -> Assessment:
 def mock_exam_grading_page() -> None:
     drive_service: Resource = st.session_state.drive_service
     batch_name: str = st.session_state.config.current_batch
+    # Pick up files added by the Zapier zap or other sessions since the folders were indexed
+    sync_gdrive_folder_index(drive_service)
     st.header("Mock Exam Grading")
     with st.form(
         "convert_to_md", border=True, clear_on_submit=False, enter_to_submit=False
     ):
         st.subheader("Step 1: Convert student submissions to markdown")
-        submissions: dict[str, str] = list_gdrive_files(
+        # The Attachments folder grows all year long: show progress while its pages load
+        loading = st.empty()
+        submissions: dict[str, str] = {}
+        for submission_name, submission_id in iter_gdrive_files(
             drive_service, st.session_state.attachments_folder_id
-        )
+        ):
+            submissions[submission_name] = submission_id
+            if len(submissions) % 100 == 0:
+                loading.caption(f"Loaded {len(submissions)} submissions...")
+        loading.empty()
         print(f"Submissions: {submissions}")
         selected_submissions: list[str] = st.multiselect(
             "Select submissions", list(submissions.keys())
@@ -208,15 +269,34 @@ def mock_exam_grading_page() -> None:
             target_dir_id: str | None = ensure_batch_directory(
                 drive_service, batch_name
             )
+            manifest: BatchManifest = get_batch_manifest(
+                drive_service, target_dir_id, batch_name
+            )
             st.info(
                 f"Converting files {selected_submissions} into Google drive directory {batch_name}..."
             )
-            for submission in selected_submissions:
-                st.info(f"Converting file {submission}...")
-                convert_gdrive_file_to_markdown(
-                    drive_service, submissions[submission], submission, target_dir_id
-                )
-                st.success(f"File {submission} converted successfully!")
+            for result in convert_gdrive_files_to_markdown(
+                drive_service,
+                {
+                    submission: submissions[submission]
+                    for submission in selected_submissions
+                },
+                target_dir_id,
+                max_workers=st.session_state.config.conversion_workers,
+            ):
+                if result.error is None:
+                    manifest.record(
+                        drive_service,
+                        f"{result.file_name.rsplit('.', 1)[0]}.md",
+                        "converted",
+                        source_file_id=result.file_id,
+                        markdown_file_id=result.markdown_file_id,
+                    )
+                    st.success(f"File {result.file_name} converted successfully!")
+                else:
+                    st.error(
+                        f"Error converting file {result.file_name}: {result.error}"
+                    )
             st.success("Files converted successfully!")
     else:
         st.info("No files converted yet.")
@@ -248,13 +328,28 @@ def mock_exam_grading_page() -> None:
         if len(selected_md_files) == 0:
             st.error("No markdown files selected!")
             return
+        manifest = get_batch_manifest(drive_service, batch_dir_id, batch_name)
+        usage_before: dict[str, PromptUsage] = usage_tally.snapshot()
         with st.status("Splitting markdown files..."):
             st.info("Splitting markdown files...")
             nerrors: int = 0
+            # Fetch all the creation dates in one batch request rather than one call per file
+            md_files_metadata: dict[str, dict[str, Any] | None] = (
+                get_gdrive_files_metadata(
+                    drive_service,
+                    [md_files[md_file] for md_file in selected_md_files],
+                    "createdTime",
+                )
+            )
             for md_file in selected_md_files:
                 md_file_id: str = md_files[md_file]
+                md_file_metadata: dict[str, Any] | None = md_files_metadata[md_file_id]
                 mock_exam: MockExam | None = generate_mock_exam(
-                    drive_service, batch_dir_id, md_file_id, md_file
+                    drive_service,
+                    batch_dir_id,
+                    md_file_id,
+                    md_file,
+                    md_file_metadata.get("createdTime") if md_file_metadata else None,
                 )
                 if mock_exam is None:
                     st.error(f"Error generating mock exam for file {md_file}")
@@ -264,23 +359,49 @@ def mock_exam_grading_page() -> None:
                     print(f"Mock exam for {md_file}:")
                     pprint(mock_exam.dict())
                     st.session_state.mock_exams[md_file] = mock_exam
-                    write_mock_exam_sections(
+                    section_file_ids: dict[str, str] | None = write_mock_exam_sections(
                         drive_service, batch_dir_id, md_file, mock_exam
                     )
+                    if section_file_ids is None:
+                        nerrors += 1
+                        continue
+                    manifest.record(
+                        drive_service,
+                        md_file,
+                        "split",
+                        markdown_file_id=md_file_id,
+                        section_file_ids=section_file_ids,
+                        exam_metadata=exam_metadata(mock_exam),
+                    )
                     st.success(f"Mock exam sections written for {md_file}!")
             if nerrors == 0:
                 st.success("Markdown files split successfully!")
             else:
                 st.error(f"Encountered {nerrors} errors splitting markdown files!")
+        st.caption(f"Prompt caching: {usage_report(usage_tally.since(usage_before))}")
 
     with st.container(border=True):
         print("Entering grading area...")
         st.subheader("Step 3: Grade Mock Exam Sections")
+        manifest = get_batch_manifest(drive_service, batch_dir_id, batch_name)
+        # Mock exams split in earlier sessions are listed from the manifest, and only loaded once selected
+        split_exams: list[str] = list(st.session_state.mock_exams.keys()) + [
+            key
+            for key, state in manifest.submissions.items()
+            if key not in st.session_state.mock_exams and can_load_mock_exam(state)
+        ]
         st.session_state.selected_exams = st.multiselect(
-            "Select mock exam", list(st.session_state.mock_exams.keys())
+            "Select mock exam", split_exams
         )
-        for mock_exam_key in st.session_state.selected_exams:
+        for mock_exam_key in list(st.session_state.selected_exams):
             print(f"Selected exam: {mock_exam_key}")
+            if (
+                get_mock_exam(drive_service, batch_dir_id, manifest, mock_exam_key)
+                is None
+            ):
+                st.error(f"Error loading mock exam {mock_exam_key}!")
+                st.session_state.selected_exams.remove(mock_exam_key)
+                continue
             st.subheader(f"Mock exam for {mock_exam_key}")
             st.json(
                 st.session_state.mock_exams[mock_exam_key].dict(),
@@ -292,61 +413,534 @@ def mock_exam_grading_page() -> None:
             clear_on_submit=False,
             enter_to_submit=False,
         ):
+            force_regrade: bool = st.checkbox(
+                "Force regrade",
+                help="Grade again even the sections with a recent cached assessment.",
+            )
+            in_background: bool = st.checkbox(
+                "Grade in the background",
+                value=False,
+                help="Queue the grading for the grading worker, so that it goes on whatever happens to this page.  The worker is started separately with python src/grading_worker.py.",
+            )
+            stream: bool = st.checkbox(
+                "Stream assessments",
+                value=True,
+                help="Show the assessments while they are written, when not grading in the background.",
+            )
             grade_button: bool = st.form_submit_button("Grade Mock Exam")
     if grade_button:
         print("Grading button pushed...")
         if len(st.session_state.selected_exams) == 0:
             st.error("No mock exams selected!")
             return
-        print("Grading mock exams...")
-        for selected_exam in st.session_state.selected_exams:
-            print(f"Grading mock exam {selected_exam}...")
-            exam: MockExam = st.session_state.mock_exams[selected_exam]
-            full_assessment: str = (
-                f"# Assessment of mock exam for {exam.name} on {exam.date}\n\n"
+        if in_background:
+            job_id: int = get_job_queue().submit(
+                batch_name, list(st.session_state.selected_exams), force_regrade
+            )
+            st.success(f"Grading job {job_id} queued.")
+            if not get_job_queue().live_workers():
+                st.warning(NO_WORKER_WARNING)
+        else:
+            print("Grading mock exams...")
+            grade_mock_exams(
+                drive_service,
+                batch_dir_id,
+                {
+                    selected_exam: st.session_state.mock_exams[selected_exam]
+                    for selected_exam in st.session_state.selected_exams
+                },
+                get_batch_manifest(drive_service, batch_dir_id, batch_name),
+                force_regrade,
+                stream,
+            )
+    show_grading_jobs(batch_name)
+    show_batch_results(drive_service, batch_dir_id, batch_name)
+
+    with st.form(
+        "Resume Batch",
+        border=True,
+        clear_on_submit=False,
+        enter_to_submit=False,
+    ):
+        st.subheader("Resume batch")
+        manifest = get_batch_manifest(drive_service, batch_dir_id, batch_name)
+        st.caption(
+            "Submissions at each completed stage: "
+            + ", ".join(
+                f"{stage}: {count}" for stage, count in manifest.summary().items()
             )
-            with st.status(f"Grading mock exam..."):
-                full_assessment += (
-                    "## Synthèse\n\n" + grade_section(exam.synthese) + "\n\n"
+        )
+        resume_button: bool = st.form_submit_button(
+            "Resume batch",
+            help="Run the missing stages of every submission converted in this batch.",
+        )
+    if resume_button:
+        resume_batch(drive_service, batch_dir_id, manifest)
+
+
+NO_WORKER_WARNING: str = (
+    "No grading worker is running, queued jobs wait until one is started next to the app"
+    " with: python src/grading_worker.py"
+)
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    """Returns the grading job queue shared by all the sessions of the Streamlit server."""
+    return JobQueue()
+
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def show_grading_jobs(batch_name: str) -> None:
+    """Shows the grading jobs of the batch, refreshed on its own without rerunning the page."""
+    jobs: list[Job] = get_job_queue().recent(batch_name)
+    if not jobs:
+        return
+    with st.container(border=True):
+        st.subheader("Grading jobs")
+        if any(job.status == "queued" for job in jobs) and not (
+            get_job_queue().live_workers()
+        ):
+            st.warning(NO_WORKER_WARNING)
+        for job in jobs:
+            label: str = (
+                f"Job {job.id} ({len(job.exam_keys)} mock exam(s)): {job.status}"
+            )
+            if job.status == "running":
+                st.info(f"{label} - {job.progress}")
+            elif job.status == "queued":
+                st.info(label)
+            elif job.status == "done":
+                st.success(label)
+            elif job.status == "failed":
+                st.error(f"{label} - {job.error}")
+            else:
+                st.caption(label)
+            seen_jobs: set[int] = st.session_state.setdefault("finished_jobs", set())
+            if not job.is_active() and job.id not in seen_jobs:
+                seen_jobs.add(job.id)
+                # The worker updated the manifest and error totals on Google Drive: reload them on the next run
+                st.session_state.pop("batch_manifest", None)
+                st.session_state.pop("error_aggregate", None)
+
+
+def show_batch_results(
+    drive_service: Resource, batch_dir_id: str, batch_name: str
+) -> None:
+    """Shows the error totals of the batch and the grades of this session from their aggregates."""
+    with st.expander("Batch results"):
+        aggregate: BatchErrorAggregate = get_error_aggregate(
+            drive_service, batch_dir_id, batch_name
+        )
+        if not aggregate.section_totals:
+            st.info("No graded paper in this batch yet.")
+        else:
+            st.caption(f"Errors found in {len(aggregate.papers)} paper(s)")
+            pie_column, bar_column = st.columns(2)
+            pie_column.altair_chart(
+                error_pie_chart(aggregate), use_container_width=True
+            )
+            bar_column.altair_chart(
+                error_section_chart(aggregate), use_container_width=True
+            )
+        table: GradeTable = get_grade_table()
+        if not table.frame.empty:
+            st.caption("Grades of the papers graded in this session")
+            st.dataframe(table.frame.assign(rank=table.ranks()))
+            st.bar_chart(table.distribution())
+
+
+def grade_mock_exams(
+    drive_service: Resource,
+    batch_dir_id: str,
+    exams: dict[str, MockExam],
+    manifest: BatchManifest,
+    force_regrade: bool = False,
+    stream: bool = False,
+) -> None:
+    """
+    Grades the sections of the selected mock exams concurrently, then assembles each exam's assessment.
+
+    With stream, the assessments are shown while they are written, and replaced by the saved
+    assessment once their section is graded.
+    """
+    config: Configuration = st.session_state.config
+    assessments: dict[str, dict[str, str]] = {exam_key: {} for exam_key in exams}
+    parsed: dict[str, dict[str, Assessment]] = {exam_key: {} for exam_key in exams}
+    failed_exams: set[str] = set()
+    nsections: int = 3 * len(exams)
+    ndone: int = 0
+    workbook = BatchWorkbookWriter(drive_service, batch_dir_id, manifest.batch_name)
+    aggregate: BatchErrorAggregate = get_error_aggregate(
+        drive_service, batch_dir_id, manifest.batch_name
+    )
+    streamed = StreamedAssessments() if stream else None
+    usage_before: dict[str, PromptUsage] = usage_tally.snapshot()
+    with st.status(
+        f"Grading {len(exams)} mock exam(s), {config.grading_concurrency} sections at a time...",
+        expanded=stream,
+    ) as status:
+        for section_grade in grade_sections(
+            st.session_state.openai_client,
+            config,
+            exams,
+            max_workers=config.grading_concurrency,
+            force_regrade=force_regrade,
+            on_text=None if streamed is None else streamed.update,
+            on_wait=None if streamed is None else streamed.show,
+        ):
+            ndone += 1
+            if streamed is not None:
+                streamed.remove(
+                    section_grade.exam_key, section_grade.section.submission_type()
                 )
-                full_assessment += "## Essai\n\n" + grade_section(exam.essai) + "\n\n"
-                full_assessment += "## Traduction\n\n" + grade_section(exam.traduction)
-            assessment_file_name: str = (
-                f"{exam.original_file_name.rsplit('.', 1)[0]} - assessment.md"
+            if section_grade.error is not None:
+                failed_exams.add(section_grade.exam_key)
+                manifest.record_error(
+                    None,
+                    section_grade.exam_key,
+                    f"{section_grade.section.submission_type()}: {section_grade.error}",
+                )
+            assessments[section_grade.exam_key][
+                section_grade.section.submission_type()
+            ] = grade_section(section_grade)
+            collect_section_assessment(
+                workbook,
+                aggregate,
+                manifest.batch_name,
+                exams[section_grade.exam_key],
+                section_grade,
+                parsed,
             )
-            print(f"Uploading assessment to Google Drive as {assessment_file_name}...")
-            st.info(f"Uploading assessment to Google Drive...")
-            assessment_file_id: str | None = upload_markdown_to_gdrive(
-                st.session_state.drive_service,
-                assessment_file_name,
-                batch_dir_id,
-                full_assessment,
+            status.update(
+                label=f"Graded {ndone}/{nsections} sections ({section_grade.section.submission_type()} for {section_grade.exam_key})..."
             )
-            if assessment_file_id is None:
-                st.error(f"Error uploading assessment to Google Drive!")
-                return
-            print(f"Assessment uploaded to Google Drive as {assessment_file_id}!")
-            st.info(f"Converting assessment to docx...")
-            print(f"Converting assessment to docx...")
-            docx_assessment_file_id: str | None = convert_gdrive_file_to_docx(
-                st.session_state.drive_service,
-                assessment_file_id,
-                batch_dir_id,
+        status.update(label=f"Graded {ndone}/{nsections} sections.", state="complete")
+    st.caption(f"Prompt caching: {usage_report(usage_tally.since(usage_before))}")
+    workbook.flush()
+    aggregate.save_to_drive(drive_service)
+    upload_exam_assessments(drive_service, batch_dir_id, exams)
+
+    assessment_file_names: dict[str, str] = {
+        exam_key: mock_exam_assessment_file_name(exam)
+        for exam_key, exam in exams.items()
+    }
+    print(f"Uploading assessments to Google Drive as {assessment_file_names}...")
+    st.info(f"Uploading assessments to Google Drive...")
+    assessment_file_ids: dict[str, str | None] = upload_markdowns_to_gdrive(
+        drive_service,
+        batch_dir_id,
+        {
+            assessment_file_names[exam_key]: make_full_assessment(
+                exam, assessments[exam_key]
             )
-            if docx_assessment_file_id is None:
-                st.error(f"Error converting assessment to docx!")
-                return
-            email_mock_exam_assessment(drive_service, exam, docx_assessment_file_id)
-            print(f"Assessment converted to docx as {docx_assessment_file_id}!")
-            st.success(f"Assessment for {exam.name} saved to {assessment_file_name}!")
+            for exam_key, exam in exams.items()
+        },
+    )
+    graded: dict[str, MockExam] = {}
+    for exam_key, exam in exams.items():
+        assessment_file_id: str | None = assessment_file_ids[
+            assessment_file_names[exam_key]
+        ]
+        # Exams with a failed section stay at the split stage, to be graded again on resume
+        if exam_key in failed_exams:
+            continue
+        if assessment_file_id is None:
+            st.error(f"Error uploading assessment of {exam_key} to Google Drive!")
+            manifest.record_error(None, exam_key, "Error uploading assessment")
+            continue
+        manifest.record(None, exam_key, "graded", assessment_file_id=assessment_file_id)
+        graded[exam_key] = exam
+    manifest.save_to_drive(drive_service)
+    if failed_exams:
+        st.error(
+            f"Sections of {', '.join(sorted(failed_exams))} could not be graded, grade them again to send their assessments."
+        )
+    for exam_key, exam in graded.items():
+        print(f"Finalizing assessment of mock exam {exam_key}...")
+        save_mock_exam_assessment(
+            drive_service,
+            batch_dir_id,
+            exam,
+            assessment_file_names[exam_key],
+            assessment_file_ids[assessment_file_names[exam_key]],
+            manifest,
+            exam_key,
+        )
 
 
-def grade_section(section: Submission) -> str:
-    st.divider()
-    st.info(f"Grading section {section.submission_type()}...")
-    assessment: str = call_assistant(
-        section.get_assistant_id(st.session_state.config), section.markdown_content
+class StreamedAssessments:
+    """
+    Shows the assessments of the sections being graded while the assistants write them.
+
+    The grading threads report the text written so far with update, and the script thread
+    shows it with show, since Streamlit elements can only be written from the script thread.
+    """
+
+    def __init__(self) -> None:
+        self._texts: dict[tuple[str, str], str] = {}
+        self._shown: dict[tuple[str, str], str] = {}
+        self._placeholders: dict[tuple[str, str], Any] = {}
+        self._lock = threading.Lock()
+
+    def update(self, exam_key: str, section_type: str, text: str) -> None:
+        """Records the partial assessment of a section, from a grading thread."""
+        with self._lock:
+            self._texts[(exam_key, section_type)] = text
+
+    def show(self) -> None:
+        """Shows the partial assessments that changed since the last call."""
+        with self._lock:
+            texts: dict[tuple[str, str], str] = dict(self._texts)
+        for (exam_key, section_type), text in texts.items():
+            if self._shown.get((exam_key, section_type)) == text:
+                continue
+            if (exam_key, section_type) not in self._placeholders:
+                self._placeholders[(exam_key, section_type)] = st.empty()
+            self._placeholders[(exam_key, section_type)].markdown(
+                f"**{section_type} of {exam_key}** (grading...)\n\n{text}"
+            )
+            self._shown[(exam_key, section_type)] = text
+
+    def remove(self, exam_key: str, section_type: str) -> None:
+        """Removes the partial assessment of a graded section."""
+        with self._lock:
+            self._texts.pop((exam_key, section_type), None)
+        self._shown.pop((exam_key, section_type), None)
+        placeholder: Any | None = self._placeholders.pop((exam_key, section_type), None)
+        if placeholder is not None:
+            placeholder.empty()
+
+
+def get_grade_table() -> GradeTable:
+    """Returns the grades of the papers graded in this session, weighted with the current configuration."""
+    weights: dict[str, float] = section_weights(st.session_state.config)
+    if "grade_table" not in st.session_state:
+        st.session_state.grade_table = GradeTable(weights)
+    elif st.session_state.grade_table.weights != weights:
+        st.session_state.grade_table.set_weights(weights)
+    return st.session_state.grade_table
+
+
+def collect_section_assessment(
+    workbook: BatchWorkbookWriter,
+    aggregate: BatchErrorAggregate,
+    batch_name: str,
+    exam: MockExam,
+    section_grade: SectionGrade,
+    parsed: dict[str, dict[str, Assessment]],
+) -> None:
+    """
+    Collects the structured assessment of a graded section.
+
+    Its error counts are added to the batch error totals right away.  Once all the sections of an exam are in, its scores are recorded in the grade table, its
+    structured assessment is kept in the session, and its rows are queued for the batch workbook.
+    """
+    if section_grade.parsed is None:
+        return
+    exam_key: str = section_grade.exam_key
+    parsed[exam_key][section_grade.section.submission_type()] = section_grade.parsed
+    aggregate.update(
+        exam_key,
+        section_grade.section.submission_type(),
+        section_grade.parsed.error_distribution,
+    )
+    if len(parsed[exam_key]) < len(SECTION_TYPES):
+        return
+    table: GradeTable = get_grade_table()
+    for section_type, assessment in parsed[exam_key].items():
+        table.record(
+            exam_key, section_type, assessment.final_score, exam.name, batch_name
+        )
+    st.session_state.setdefault("assessments", {})[exam_key] = MockExamAssessment(
+        sections=parsed[exam_key],
+        total_score=table.frame.at[exam_key, TOTAL_COLUMN],
     )
+    error_counts: dict[str, int] = {}
+    for assessment in parsed[exam_key].values():
+        for error_type, count in assessment.error_distribution.items():
+            error_counts[error_type] = error_counts.get(error_type, 0) + count
+    workbook.upsert_grades(exam_key, grade_row(table, exam_key))
+    workbook.upsert_errors(exam_key, exam.name, error_counts)
+    workbook.maybe_flush()
+
+
+def mock_exam_assessment_json_name(exam: MockExam) -> str:
+    """Returns the name of the JSON file holding the structured assessment of a mock exam."""
+    return f"{exam.original_file_name.rsplit('.', 1)[0]} - assessment.json"
+
+
+def upload_exam_assessments(
+    drive_service: Resource, batch_dir_id: str, exams: dict[str, MockExam]
+) -> None:
+    """Stores the structured assessments of the graded mock exams as JSON in the batch folder."""
+    exam_assessments: dict[str, MockExamAssessment] = st.session_state.get(
+        "assessments", {}
+    )
+    upload_markdowns_to_gdrive(
+        drive_service,
+        batch_dir_id,
+        {
+            mock_exam_assessment_json_name(exam): exam_assessments[
+                exam_key
+            ].model_dump_json(indent=2)
+            for exam_key, exam in exams.items()
+            if exam_key in exam_assessments
+        },
+        mime_type="application/json",
+    )
+
+
+def mock_exam_assessment_file_name(exam: MockExam) -> str:
+    """Returns the name of the markdown file holding the full assessment of a mock exam."""
+    return f"{exam.original_file_name.rsplit('.', 1)[0]} - assessment.md"
+
+
+def make_full_assessment(exam: MockExam, section_assessments: dict[str, str]) -> str:
+    """Assembles the section assessments of a mock exam into its full assessment."""
+    full_assessment: str = (
+        f"# Assessment of mock exam for {exam.name} on {exam.date}\n\n"
+    )
+    full_assessment += "## Synthèse\n\n" + section_assessments["Synthèse"] + "\n\n"
+    full_assessment += "## Essai\n\n" + section_assessments["Essai"] + "\n\n"
+    full_assessment += "## Traduction\n\n" + section_assessments["Traduction"]
+    return full_assessment
+
+
+def save_mock_exam_assessment(
+    drive_service: Resource,
+    batch_dir_id: str,
+    exam: MockExam,
+    assessment_file_name: str,
+    assessment_file_id: str | None,
+    manifest: BatchManifest,
+    exam_key: str,
+) -> None:
+    """Converts the uploaded full assessment of a mock exam to docx and emails it to the professor."""
+    if assessment_file_id is None:
+        st.error(f"Error uploading assessment to Google Drive!")
+        return
+    if manifest.state(exam_key).has_completed("docx"):
+        # Resuming after the conversion: only the email is missing
+        send_mock_exam_assessment(
+            drive_service, exam, assessment_file_name, manifest, exam_key
+        )
+        return
+    print(f"Assessment uploaded to Google Drive as {assessment_file_id}!")
+    st.info(f"Converting assessment to docx...")
+    print(f"Converting assessment to docx...")
+    docx_assessment_file_id: str | None = convert_gdrive_file_to_docx(
+        drive_service,
+        assessment_file_id,
+        batch_dir_id,
+        assessment_file_name,
+    )
+    if docx_assessment_file_id is None:
+        st.error(f"Error converting assessment to docx!")
+        manifest.record_error(
+            drive_service, exam_key, "Error converting assessment to docx"
+        )
+        return
+    manifest.record(
+        drive_service, exam_key, "docx", docx_file_id=docx_assessment_file_id
+    )
+    print(f"Assessment converted to docx as {docx_assessment_file_id}!")
+    send_mock_exam_assessment(
+        drive_service, exam, assessment_file_name, manifest, exam_key
+    )
+    st.success(f"Assessment for {exam.name} saved to {assessment_file_name}!")
+
+
+def send_mock_exam_assessment(
+    drive_service: Resource,
+    exam: MockExam,
+    assessment_file_name: str,
+    manifest: BatchManifest,
+    exam_key: str,
+) -> None:
+    """Emails the docx assessment of a mock exam recorded in the manifest and checkpoints it."""
+    if email_mock_exam_assessment(
+        drive_service,
+        exam,
+        manifest.state(exam_key).docx_file_id,
+        f"{assessment_file_name.rsplit('.', 1)[0]}.docx",
+    ):
+        manifest.record(drive_service, exam_key, "emailed")
+    else:
+        manifest.record_error(drive_service, exam_key, "Error emailing assessment")
+
+
+def resume_batch(
+    drive_service: Resource, batch_dir_id: str, manifest: BatchManifest
+) -> None:
+    """
+    Runs the missing stages of the submissions of a batch, starting from their last completed stage.
+
+    Mock exams that are no longer in the session are rebuilt from their section files, or split
+    again.  Submissions that were never converted are left to step 1.
+    """
+    exams: dict[str, MockExam] = {}
+    with st.status(f"Resuming batch {manifest.batch_name}...") as status:
+        for key, state in manifest.submissions.items():
+            if state.stage is None or state.next_stage() is None:
+                continue
+            exam: MockExam | None = get_mock_exam(
+                drive_service, batch_dir_id, manifest, key
+            )
+            if exam is None:
+                manifest.record_error(drive_service, key, "Error splitting")
+                continue
+            if not state.has_completed("split"):
+                section_file_ids: dict[str, str] | None = write_mock_exam_sections(
+                    drive_service, batch_dir_id, key, exam
+                )
+                if section_file_ids is None:
+                    continue
+                manifest.record(
+                    drive_service,
+                    key,
+                    "split",
+                    section_file_ids=section_file_ids,
+                    exam_metadata=exam_metadata(exam),
+                )
+            exams[key] = exam
+        to_grade: dict[str, MockExam] = {
+            key: exam
+            for key, exam in exams.items()
+            if not manifest.state(key).has_completed("graded")
+        }
+        status.update(
+            label=f"Resuming batch {manifest.batch_name}: {len(to_grade)} mock exam(s) to grade."
+        )
+    if to_grade:
+        grade_mock_exams(drive_service, batch_dir_id, to_grade, manifest)
+    for key, exam in exams.items():
+        state: SubmissionState = manifest.state(key)
+        if key in to_grade or not state.has_completed("graded"):
+            continue
+        print(f"Finalizing assessment of mock exam {key}...")
+        save_mock_exam_assessment(
+            drive_service,
+            batch_dir_id,
+            exam,
+            mock_exam_assessment_file_name(exam),
+            state.assessment_file_id,
+            manifest,
+            key,
+        )
+    st.success(f"Batch {manifest.batch_name} resumed: {manifest.summary()}")
+
+
+def grade_section(section_grade: SectionGrade) -> str:
+    """Saves and displays a section graded by the grading engine."""
+    section: Submission = section_grade.section
+    st.divider()
+    if section_grade.error is not None:
+        st.error(f"Error grading section: {section_grade.error}")
+        return section_grade.assessment
+    assessment: str = section_grade.assessment
+    if section_grade.cached:
+        st.info(f"Reusing the cached assessment of {section.submission_type()}.")
     original_base_name: str = section.original_file_name.rsplit(".", 1)[0]
     file_name: str = (
         f"{original_base_name} - {section.submission_type()} - assessment.md"
@@ -365,4 +959,6 @@ def grade_section(section: Submission) -> str:
     return assessment
 
 
-mock_exam_grading_page()
+# Streamlit runs page files as __page__, the batch runner imports this module
+if __name__ in ("__main__", "__page__"):
+    mock_exam_grading_page()
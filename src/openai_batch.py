@@ -0,0 +1,222 @@
+import io
+import json
+import time
+from typing import Any, Callable, Iterable
+from openai import OpenAI
+from openai.types.batch import Batch
+from openai.types.beta.assistant import Assistant
+from pydantic import BaseModel
+
+from async_pipeline import SplitInput
+from exam_splitter import (
+    SPLIT_MODEL,
+    SPLIT_RESPONSE_FORMATS,
+    make_split_messages,
+    parsed_split,
+)
+from gaclasses import MockExam, Submission
+from grading_engine import GRADE_PROMPT
+
+BATCH_ENDPOINT: str = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW: str = "24h"
+BATCH_POLL_SECONDS: float = 60.0
+TERMINAL_BATCH_STATUSES: frozenset[str] = frozenset(
+    {"completed", "failed", "expired", "cancelled"}
+)
+
+
+def strict_json_schema(schema: Any, defs: dict[str, Any] | None = None) -> Any:
+    """
+    Returns a JSON schema made strict for structured outputs, which need every object to list all
+    its properties as required and to forbid additional ones.  A $ref with sibling keywords, which
+    structured outputs reject, is replaced by the definition it points to.
+    """
+    if isinstance(schema, list):
+        return [strict_json_schema(item, defs) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    if defs is None:
+        defs = schema.get("$defs", {})
+    if "$ref" in schema and len(schema) > 1:
+        schema = {
+            **defs[schema["$ref"].removeprefix("#/$defs/")],
+            **{name: value for name, value in schema.items() if name != "$ref"},
+        }
+    strict: dict[str, Any] = {
+        name: strict_json_schema(value, defs) for name, value in schema.items()
+    }
+    if strict.get("type") == "object" and "properties" in strict:
+        strict["required"] = list(strict["properties"])
+        strict["additionalProperties"] = False
+    return strict
+
+
+def json_schema_response_format(model: type[BaseModel]) -> dict[str, Any]:
+    """Returns the structured output response_format of a pydantic model, as parse() sends it."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": model.__name__,
+            "schema": strict_json_schema(model.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+
+def split_custom_id(key: str) -> str:
+    return f"split:{key}"
+
+
+def grade_custom_id(key: str, section_type: str) -> str:
+    # Section types have no colon, keys may, so the key goes last
+    return f"grade:{section_type}:{key}"
+
+
+def parse_grade_custom_id(custom_id: str) -> tuple[str, str]:
+    """Returns the exam key and section type of a grading request."""
+    _, section_type, key = custom_id.split(":", 2)
+    return key, section_type
+
+
+def split_request(split_input: SplitInput, mode: str = "boundaries") -> dict[str, Any]:
+    """Returns the Batch API request splitting a paper, the same as exam_splitter.request_split sends."""
+    return {
+        "custom_id": split_custom_id(split_input.key),
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": SPLIT_MODEL,
+            "messages": make_split_messages(
+                split_input.md_text,
+                split_input.file_id,
+                split_input.file_name,
+                split_input.file_date,
+                mode,
+            ),
+            "response_format": json_schema_response_format(
+                SPLIT_RESPONSE_FORMATS[mode]
+            ),
+        },
+    }
+
+
+def grade_request(
+    key: str, section: Submission, assistant: Assistant
+) -> dict[str, Any]:
+    """
+    Returns the Batch API request grading a section with the model and instructions of an assistant.
+
+    The Batch API does not run assistants, so the section is graded by a chat completion with the
+    assistant's settings instead.  Tools such as file search are not available there.
+    """
+    body: dict[str, Any] = {
+        "model": assistant.model,
+        "messages": [
+            {"role": "system", "content": assistant.instructions or ""},
+            {
+                "role": "user",
+                "content": GRADE_PROMPT.format(text=section.markdown_content),
+            },
+        ],
+    }
+    if assistant.temperature is not None:
+        body["temperature"] = assistant.temperature
+    if assistant.top_p is not None:
+        body["top_p"] = assistant.top_p
+    return {
+        "custom_id": grade_custom_id(key, section.submission_type()),
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": body,
+    }
+
+
+def submit_batch(
+    client: OpenAI, requests: Iterable[dict[str, Any]], description: str
+) -> Batch:
+    """Uploads the requests as a JSONL file and creates a Batch API job for them."""
+    jsonl: bytes = "".join(
+        json.dumps(request, ensure_ascii=False) + "\n" for request in requests
+    ).encode("utf-8")
+    input_file = client.files.create(
+        file=("requests.jsonl", io.BytesIO(jsonl)), purpose="batch"
+    )
+    batch: Batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"description": description},
+    )
+    print(f"Batch {batch.id} submitted: {description}.")
+    return batch
+
+
+def wait_for_batch(
+    client: OpenAI,
+    batch_id: str,
+    poll_seconds: float = BATCH_POLL_SECONDS,
+    on_progress: Callable[[str], None] = print,
+) -> Batch:
+    """Polls a Batch API job until it ends, which may take up to its 24 hour completion window."""
+    while True:
+        batch: Batch = client.batches.retrieve(batch_id)
+        counts: str = (
+            f"{batch.request_counts.completed + batch.request_counts.failed}/{batch.request_counts.total}"
+            if batch.request_counts is not None
+            else "?"
+        )
+        on_progress(f"Batch {batch_id} {batch.status}: {counts} requests done.")
+        if batch.status in TERMINAL_BATCH_STATUSES:
+            return batch
+        time.sleep(poll_seconds)
+
+
+def batch_results(client: OpenAI, batch: Batch) -> dict[str, dict[str, Any] | str]:
+    """
+    Returns the results of an ended Batch API job by custom ID.
+
+    Each result is the chat completion of a successful request, or the error message of a failed
+    one.  Requests missing from the output, e.g. when the job expired, are left out.
+    """
+    results: dict[str, dict[str, Any] | str] = {}
+    if batch.error_file_id is not None:
+        for line in client.files.content(batch.error_file_id).text.splitlines():
+            if line.strip():
+                error_line: dict[str, Any] = json.loads(line)
+                error: Any = error_line.get("error") or error_line["response"]["body"]
+                results[error_line["custom_id"]] = json.dumps(error)
+    if batch.output_file_id is not None:
+        for line in client.files.content(batch.output_file_id).text.splitlines():
+            if not line.strip():
+                continue
+            output: dict[str, Any] = json.loads(line)
+            response: dict[str, Any] = output["response"]
+            if response["status_code"] == 200:
+                results[output["custom_id"]] = response["body"]
+            else:
+                results[output["custom_id"]] = json.dumps(response["body"])
+    return results
+
+
+def completion_text(completion: dict[str, Any]) -> str:
+    """Returns the answer of a chat completion returned by the Batch API."""
+    return completion["choices"][0]["message"]["content"]
+
+
+def parse_split_result(
+    completion: dict[str, Any], split_input: SplitInput, mode: str = "boundaries"
+) -> MockExam:
+    """Returns the mock exam of a split request returned by the Batch API."""
+    message: dict[str, Any] = completion["choices"][0]["message"]
+    if message.get("refusal"):
+        raise ValueError(f"The model refused to split the paper: {message['refusal']}")
+    mock_exam: MockExam | None = parsed_split(
+        SPLIT_RESPONSE_FORMATS[mode].model_validate_json(message["content"]),
+        mode,
+        split_input.md_text,
+        split_input.file_id,
+        split_input.file_name,
+    )
+    if mock_exam is None:
+        raise ValueError("The section starts were not found in the paper")
+    return mock_exam
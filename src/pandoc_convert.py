@@ -0,0 +1,46 @@
+import subprocess
+import pypandoc
+
+DOCX_MIME_TYPE: str = (
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+)
+
+
+def convert_bytes(data: bytes, from_format: str, to_format: str) -> bytes:
+    """
+    Converts a document in memory by piping it through pandoc's stdin and stdout.
+
+    Pandoc reads binary formats such as docx and odt from stdin, and writes them to stdout with
+    "-o -", so no temporary file is needed and concurrent conversions cannot collide.
+
+    Args:
+        data (bytes): The document to convert.
+        from_format (str): Pandoc input format, e.g. "docx", "odt" or "markdown".
+        to_format (str): Pandoc output format, e.g. "markdown" or "docx".
+
+    Returns:
+        bytes: The converted document.
+
+    Raises:
+        RuntimeError: If pandoc fails.
+    """
+    result: subprocess.CompletedProcess = subprocess.run(
+        [pypandoc.get_pandoc_path(), "-f", from_format, "-t", to_format, "-o", "-"],
+        input=data,
+        capture_output=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(
+            f"Pandoc failed converting {from_format} to {to_format}: {result.stderr.decode('utf-8', 'replace')}"
+        )
+    return result.stdout
+
+
+def convert_to_markdown(data: bytes, file_type: str) -> str:
+    """Converts a docx or odt document to Markdown text."""
+    return convert_bytes(data, file_type, "markdown").decode("utf-8")
+
+
+def convert_markdown_to_docx(markdown_data: bytes) -> bytes:
+    """Converts Markdown text to a docx document."""
+    return convert_bytes(markdown_data, "markdown", "docx")
@@ -0,0 +1,108 @@
+import threading
+from typing import Any
+from pydantic import BaseModel, Field
+
+# OpenAI only caches prompts of at least this many tokens, in 128 token steps above it
+PROMPT_CACHE_MIN_TOKENS: int = 1024
+
+
+class PromptUsage(BaseModel):
+    """Prompt and completion tokens used by a series of OpenAI requests."""
+
+    requests: int = Field(0, description="Number of requests")
+    prompt_tokens: int = Field(0, description="Prompt tokens, cached or not")
+    cached_tokens: int = Field(
+        0, description="Prompt tokens served from the OpenAI prompt cache"
+    )
+    completion_tokens: int = Field(0, description="Completion tokens")
+
+    def cached_ratio(self) -> float:
+        """
+        Returns the share of the prompt tokens served from the prompt cache.
+
+        It stays at zero for requests whose shared prefix is shorter than PROMPT_CACHE_MIN_TOKENS.
+        """
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def minus(self, other: "PromptUsage") -> "PromptUsage":
+        return PromptUsage(
+            requests=self.requests - other.requests,
+            prompt_tokens=self.prompt_tokens - other.prompt_tokens,
+            cached_tokens=self.cached_tokens - other.cached_tokens,
+            completion_tokens=self.completion_tokens - other.completion_tokens,
+        )
+
+
+def cached_tokens(usage: Any) -> int:
+    """
+    Returns the cached prompt tokens of the usage of a chat completion or assistant run.
+
+    Chat completions report them in prompt_tokens_details, runs in prompt_token_details, which
+    the run usage model of the SDK does not declare and keeps as an extra field.
+    """
+    details: Any = getattr(usage, "prompt_tokens_details", None)
+    if details is None and usage.model_extra:
+        details = usage.model_extra.get("prompt_token_details")
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens") or 0
+    return details.cached_tokens or 0
+
+
+class PromptUsageTally:
+    """
+    Running totals of the tokens used by the splitting and grading requests, by model or assistant.
+
+    The totals are shared by all the threads of the process, so the usage of one batch is the
+    difference between a snapshot taken before it and the totals after it.  Batches graded at
+    the same time in one process are counted together.
+
+    Example:
+        before = usage_tally.snapshot()
+        grade_sections(...)
+        print(usage_report(usage_tally.since(before)))
+    """
+
+    def __init__(self) -> None:
+        self._totals: dict[str, PromptUsage] = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, usage: Any) -> None:
+        """Adds the usage reported by a chat completion or assistant run, if any."""
+        if usage is None:
+            return
+        with self._lock:
+            totals: PromptUsage = self._totals.setdefault(key, PromptUsage())
+            totals.requests += 1
+            totals.prompt_tokens += usage.prompt_tokens or 0
+            totals.cached_tokens += cached_tokens(usage)
+            totals.completion_tokens += usage.completion_tokens or 0
+
+    def snapshot(self) -> dict[str, PromptUsage]:
+        with self._lock:
+            return {key: usage.model_copy() for key, usage in self._totals.items()}
+
+    def since(self, snapshot: dict[str, PromptUsage]) -> dict[str, PromptUsage]:
+        """Returns the usage recorded since a snapshot, leaving out the unused keys."""
+        usages: dict[str, PromptUsage] = {}
+        for key, usage in self.snapshot().items():
+            difference: PromptUsage = usage.minus(snapshot.get(key, PromptUsage()))
+            if difference.requests > 0:
+                usages[key] = difference
+        return usages
+
+
+def usage_report(usages: dict[str, PromptUsage]) -> str:
+    """Returns a one line summary of the prompt tokens and cached ratio of each model or assistant."""
+    if not usages:
+        return "No OpenAI requests."
+    return "; ".join(
+        f"{key}: {usage.requests} request(s), {usage.prompt_tokens} prompt tokens, "
+        f"{usage.cached_ratio():.0%} cached"
+        for key, usage in usages.items()
+    )
+
+
+# Shared by all the sessions of the Streamlit server process and their worker threads
+usage_tally = PromptUsageTally()
@@ -0,0 +1,330 @@
+import asyncio
+import random
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Mapping, TypeVar
+import openai
+
+T = TypeVar("T")
+C = TypeVar("C", openai.OpenAI, openai.AsyncOpenAI)
+
+# Conservative defaults, replaced by the limits OpenAI reports in its rate limit headers
+DEFAULT_TOKENS_PER_MINUTE: int = 450_000
+DEFAULT_REQUESTS_PER_MINUTE: int = 5_000
+# French prose averages about 1.4 tokens per word
+TOKENS_PER_WORD: float = 1.4
+# Assistant instructions and file search results, and the assessment written back
+GRADING_OVERHEAD_TOKENS: int = 8_000
+GRADING_OUTPUT_TOKENS: int = 2_000
+# Split prompt and schema; the split writes the whole paper back
+SPLIT_OVERHEAD_TOKENS: int = 1_500
+# Extraction prompt and schema, and the score and error counts written back
+EXTRACT_OVERHEAD_TOKENS: int = 800
+MAX_ATTEMPTS: int = 6
+BACKOFF_BASE_SECONDS: float = 1.0
+BACKOFF_MAX_SECONDS: float = 60.0
+RATE_LIMIT_ERROR_CODE: str = "rate_limit_exceeded"
+# "6m0s", "1.5s", "20ms" in x-ratelimit-reset-* headers
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+# "Please try again in 1.234s." in rate limit error messages
+TRY_AGAIN_PATTERN = re.compile(r"try again in (\d+(?:\.\d+)?(?:ms|s|m))", re.IGNORECASE)
+
+
+def estimate_grading_tokens(word_count: int) -> int:
+    """Estimates the tokens used to grade a section of word_count words."""
+    return (
+        int(word_count * TOKENS_PER_WORD)
+        + GRADING_OVERHEAD_TOKENS
+        + GRADING_OUTPUT_TOKENS
+    )
+
+
+def estimate_split_tokens(word_count: int, rewrites_text: bool = True) -> int:
+    """Estimates the tokens used to split a paper of word_count words, written back if rewrites_text."""
+    return (
+        int((1 + rewrites_text) * word_count * TOKENS_PER_WORD) + SPLIT_OVERHEAD_TOKENS
+    )
+
+
+def estimate_extract_tokens(word_count: int) -> int:
+    """Estimates the tokens used to extract the score and errors of an assessment of word_count words."""
+    return int(word_count * TOKENS_PER_WORD) + EXTRACT_OVERHEAD_TOKENS
+
+
+def parse_duration(duration: str) -> float | None:
+    """Converts a duration such as "6m0s", "1.5s" or "20ms" to seconds."""
+    parts: list[tuple[str, str]] = DURATION_PART.findall(duration)
+    if not parts:
+        return None
+    units: dict[str, float] = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+    return sum(float(value) * units[unit] for value, unit in parts)
+
+
+class TokenBucket:
+    """
+    A token bucket refilled continuously up to a per-minute capacity.
+
+    Reservations may take the bucket below zero: the caller is then told how long to wait for the
+    refill, so that concurrent callers queue up instead of all retrying at once.
+    """
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = float(per_minute)
+        self.available = float(per_minute)
+        self._updated: float = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.available = min(
+            self.capacity,
+            self.available + (now - self._updated) * self.capacity / 60,
+        )
+        self._updated = now
+
+    def reserve(self, amount: float, now: float) -> float:
+        """Takes amount from the bucket and returns the seconds to wait before using it."""
+        self._refill(now)
+        self.available -= amount
+        return max(0.0, -self.available * 60 / self.capacity)
+
+    def refund(self, amount: float, now: float) -> None:
+        self._refill(now)
+        self.available = min(self.capacity, self.available + amount)
+
+    def observe(self, limit: float | None, remaining: float | None, now: float) -> None:
+        """Aligns the bucket with the limit and remaining amount reported by the API."""
+        self._refill(now)
+        if limit is not None and limit > 0:
+            self.capacity = limit
+        if remaining is not None:
+            self.available = min(self.available, remaining)
+
+
+class RateLimitScheduler:
+    """
+    Paces OpenAI calls to stay within the rate limits, and retries the rate-limited ones.
+
+    Each model has a token bucket and a request bucket, since OpenAI rate limits are per model:
+    the assistants running on one model share its limits.  A call first reserves its estimated
+    tokens and waits for them if needed, then runs; 429 errors, rate-limited assistant runs and
+    transient server errors are retried with jittered exponential backoff, or after the delay
+    given by the API.  The scheduler is the only one to retry them: the calls it runs are sent by
+    a client without the SDK's own retries.  The buckets follow the limits reported in the rate
+    limit headers of the errors, and are corrected with the actual usage of each call.  The
+    scheduler is thread-safe and shared by the grading threads and the asynchronous pipeline.
+    """
+
+    def __init__(
+        self,
+        tokens_per_minute: int = DEFAULT_TOKENS_PER_MINUTE,
+        requests_per_minute: int = DEFAULT_REQUESTS_PER_MINUTE,
+        max_attempts: int = MAX_ATTEMPTS,
+    ) -> None:
+        self.tokens_per_minute = tokens_per_minute
+        self.requests_per_minute = requests_per_minute
+        self.max_attempts = max_attempts
+        self._buckets: dict[str, tuple[TokenBucket, TokenBucket]] = {}
+        # Time until which a key was told by the API to stop sending requests
+        self._blocked_until: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def _key_buckets(self, key: str) -> tuple[TokenBucket, TokenBucket]:
+        if key not in self._buckets:
+            self._buckets[key] = (
+                TokenBucket(self.tokens_per_minute),
+                TokenBucket(self.requests_per_minute),
+            )
+        return self._buckets[key]
+
+    def reserve(self, key: str, tokens: int) -> float:
+        """Reserves the tokens and one request for a call, returning the seconds to wait before it."""
+        now: float = time.monotonic()
+        with self._lock:
+            token_bucket, request_bucket = self._key_buckets(key)
+            delay: float = max(
+                token_bucket.reserve(tokens, now), request_bucket.reserve(1, now)
+            )
+            return max(delay, self._blocked_until.get(key, 0.0) - now)
+
+    def reconcile(self, key: str, estimated: int, actual: int | None) -> None:
+        """Corrects the token bucket of a key with the actual usage of a call."""
+        if actual is None:
+            return
+        now: float = time.monotonic()
+        with self._lock:
+            token_bucket, _ = self._key_buckets(key)
+            if actual < estimated:
+                token_bucket.refund(estimated - actual, now)
+            else:
+                token_bucket.reserve(actual - estimated, now)
+
+    def observe_headers(self, key: str, headers: Mapping[str, str]) -> None:
+        """Updates the buckets of a key from the x-ratelimit-* headers of a response."""
+
+        def number(name: str) -> float | None:
+            value: str | None = headers.get(name)
+            try:
+                return float(value) if value is not None else None
+            except ValueError:
+                return None
+
+        now: float = time.monotonic()
+        with self._lock:
+            token_bucket, request_bucket = self._key_buckets(key)
+            token_bucket.observe(
+                number("x-ratelimit-limit-tokens"),
+                number("x-ratelimit-remaining-tokens"),
+                now,
+            )
+            request_bucket.observe(
+                number("x-ratelimit-limit-requests"),
+                number("x-ratelimit-remaining-requests"),
+                now,
+            )
+
+    def retry_delay(self, key: str, error: Exception, attempt: int) -> float | None:
+        """Returns the seconds to wait before retrying a failed call, or None if it should not be retried."""
+        backoff: float = random.uniform(
+            0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2**attempt)
+        )
+        if isinstance(error, openai.RateLimitError):
+            # Quota errors are also 429s, but waiting does not help with them
+            if getattr(error, "code", None) == "insufficient_quota":
+                return None
+            headers: Mapping[str, str] = error.response.headers
+            self.observe_headers(key, headers)
+            delay: float | None = server_delay(headers, str(error))
+        elif isinstance(
+            error,
+            (openai.APIConnectionError, openai.InternalServerError),
+        ):
+            return backoff
+        elif run_rate_limited(error):
+            delay = message_delay(getattr(error, "run").last_error.message)
+        else:
+            return None
+        if delay is None:
+            return backoff
+        # Spread the retries of the threads told to wait the same time
+        delay += random.uniform(0, BACKOFF_BASE_SECONDS)
+        with self._lock:
+            self._blocked_until[key] = max(
+                self._blocked_until.get(key, 0.0), time.monotonic() + delay
+            )
+        return delay
+
+    def call(
+        self,
+        key: str,
+        tokens: int,
+        fn: Callable[[], T],
+        usage: Callable[[T], int | None] | None = None,
+    ) -> T:
+        """
+        Runs fn once the rate limits allow it, retrying it when it is rate limited.
+
+        Args:
+            key (str): The model whose limits apply.
+            tokens (int): The estimated number of tokens of the call.
+            fn: The call to run.
+            usage: Returns the actual number of tokens used from the result of fn, if known.
+
+        Returns:
+            The result of fn.
+        """
+        attempt: int = 0
+        while True:
+            delay: float = self.reserve(key, tokens)
+            if delay > 0:
+                print(f"Waiting {delay:.1f}s for the rate limits of {key}...")
+                time.sleep(delay)
+            try:
+                result: T = fn()
+            except Exception as e:
+                retry: float | None = self.retry_delay(key, e, attempt)
+                attempt += 1
+                if retry is None or attempt >= self.max_attempts:
+                    raise
+                self.reconcile(key, tokens, 0)
+                print(f"Rate limited on {key}, retrying in {retry:.1f}s: {e}")
+                time.sleep(retry)
+                continue
+            if usage is not None:
+                self.reconcile(key, tokens, usage(result))
+            return result
+
+    async def call_async(
+        self,
+        key: str,
+        tokens: int,
+        fn: Callable[[], Awaitable[T]],
+        usage: Callable[[T], int | None] | None = None,
+    ) -> T:
+        """Asynchronous counterpart of call."""
+        attempt: int = 0
+        while True:
+            delay: float = self.reserve(key, tokens)
+            if delay > 0:
+                print(f"Waiting {delay:.1f}s for the rate limits of {key}...")
+                await asyncio.sleep(delay)
+            try:
+                result: T = await fn()
+            except Exception as e:
+                retry: float | None = self.retry_delay(key, e, attempt)
+                attempt += 1
+                if retry is None or attempt >= self.max_attempts:
+                    raise
+                self.reconcile(key, tokens, 0)
+                print(f"Rate limited on {key}, retrying in {retry:.1f}s: {e}")
+                await asyncio.sleep(retry)
+                continue
+            if usage is not None:
+                self.reconcile(key, tokens, usage(result))
+            return result
+
+
+def without_retries(client: C) -> C:
+    """
+    Returns a client that does not retry failed requests itself, for the calls run by the scheduler.
+
+    The scheduler retries these calls once the rate limits allow it, so the retries of the SDK
+    would only add requests on top of its own.
+    """
+    return client.with_options(max_retries=0)
+
+
+def server_delay(headers: Mapping[str, str], message: str) -> float | None:
+    """Returns the delay requested by a rate limit response, from its headers or message."""
+    retry_after_ms: str | None = headers.get("retry-after-ms")
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after: str | None = headers.get("retry-after")
+    if retry_after is not None:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    for header in ("x-ratelimit-reset-tokens", "x-ratelimit-reset-requests"):
+        if headers.get(header):
+            return parse_duration(headers[header])
+    return message_delay(message)
+
+
+def message_delay(message: str | None) -> float | None:
+    """Returns the delay suggested by a rate limit error message, e.g. "Please try again in 1.5s"."""
+    match: re.Match | None = TRY_AGAIN_PATTERN.search(message or "")
+    return parse_duration(match.group(1)) if match else None
+
+
+def run_rate_limited(error: Exception) -> bool:
+    """Returns True if an error is an assistant run that failed on a rate limit."""
+    run: Any = getattr(error, "run", None)
+    last_error: Any = getattr(run, "last_error", None)
+    return last_error is not None and last_error.code == RATE_LIMIT_ERROR_CODE
+
+
+# Shared by all the sessions of the Streamlit server process and their worker threads
+scheduler = RateLimitScheduler()
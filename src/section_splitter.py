@@ -0,0 +1,231 @@
+import re
+import unicodedata
+
+from gaclasses import Essai, MockExam, Submission, Synthese, Traduction
+
+# Words of a section heading, compared without accents or case
+SECTION_KEYWORDS: dict[str, tuple[str, ...]] = {
+    Synthese.submission_type(): ("synthese", "synthesis"),
+    Essai.submission_type(): ("essai", "essay", "expression"),
+    Traduction.submission_type(): ("traduction", "translation", "version"),
+}
+# Longest line taken for a heading, e.g. "Partie 1 : synthèse de documents"
+MAX_HEADING_WORDS: int = 6
+MIN_SECTION_WORDS: int = 20
+MAX_PREAMBLE_WORDS: int = 150
+# Below this confidence the paper is split by the model instead
+MIN_LOCAL_SPLIT_CONFIDENCE: float = 0.6
+MARKDOWN_HEADING = re.compile(r"^\s{0,3}#{1,6}\s")
+# Bold or underlined on its own line, as pandoc writes Word headings styled by hand
+EMPHASIZED_LINE = re.compile(r"^\s*(\*\*|__).+(\*\*|__)\s*[:.]?\s*$")
+NAME_LINE = re.compile(
+    r"^(?:nom(?: et prenom)?|prenom et nom|name|student|etudiant|eleve)\s*:\s*(.+)$"
+)
+
+
+def normalize_line(line: str) -> str:
+    """Returns a line without Markdown markup, accents, case or punctuation, for keyword matching."""
+    text: str = unicodedata.normalize("NFKD", line)
+    text = "".join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r"[#*_>`|\\]", " ", text)
+    text = re.sub(r"[^\w:]+", " ", text)
+    return " ".join(text.split())
+
+
+def heading_section_type(line: str) -> str | None:
+    """Returns the section type whose heading a line looks like, or None."""
+    words: list[str] = normalize_line(line).replace(":", " ").split()
+    if not words or len(words) > MAX_HEADING_WORDS:
+        return None
+    found: list[str] = [
+        section_type
+        for section_type, keywords in SECTION_KEYWORDS.items()
+        if any(keyword in words for keyword in keywords)
+    ]
+    # "Synthèse et traduction" is not the heading of one section
+    return found[0] if len(found) == 1 else None
+
+
+def is_formatted_heading(line: str) -> bool:
+    return bool(MARKDOWN_HEADING.match(line) or EMPHASIZED_LINE.match(line))
+
+
+def detect_section_headings(md_text: str) -> tuple[dict[str, int] | None, float]:
+    """
+    Finds the heading line of each section of a mock exam.
+
+    Short lines naming a section, in French or English and with or without accents, are
+    candidate headings.  Markdown headings and bold lines are preferred over plain lines.  The
+    confidence drops when a section has several candidate headings, when the headings are plain
+    text, or when a lot of text comes before the first section, and is zero when a section is
+    missing or nearly empty.
+
+    Args:
+        md_text (str): Markdown text of the student's paper, as converted by pandoc.
+
+    Returns:
+        tuple[dict[str, int] | None, float]: The line index of each section heading by section
+        type, or None if a section is missing, and the confidence of the split from 0 to 1.
+    """
+    lines: list[str] = md_text.splitlines()
+    candidates: dict[str, list[int]] = {
+        section_type: [] for section_type in SECTION_KEYWORDS
+    }
+    for index, line in enumerate(lines):
+        section_type: str | None = heading_section_type(line)
+        if section_type is not None:
+            candidates[section_type].append(index)
+    confidence: float = 1.0
+    headings: dict[str, int] = {}
+    for section_type, indexes in candidates.items():
+        if not indexes:
+            return None, 0.0
+        formatted: list[int] = [i for i in indexes if is_formatted_heading(lines[i])]
+        if len(formatted) == 1:
+            headings[section_type] = formatted[0]
+            if len(indexes) > 1:
+                confidence *= 0.9
+        else:
+            # Several equally likely headings, or only plain lines
+            headings[section_type] = (formatted or indexes)[0]
+            confidence *= 0.5 if len(formatted or indexes) > 1 else 0.8
+    sections: dict[str, str] = slice_sections(lines, headings)
+    if any(len(text.split()) < MIN_SECTION_WORDS for text in sections.values()):
+        return None, 0.0
+    preamble: str = "\n".join(lines[: min(headings.values())])
+    if len(preamble.split()) > MAX_PREAMBLE_WORDS:
+        confidence *= 0.8
+    return headings, confidence
+
+
+def slice_sections(
+    lines: list[str], starts: dict[str, int], headings: set[int] | None = None
+) -> dict[str, str]:
+    """
+    Returns the text of each section, from its first line to the first line of the next section.
+
+    Args:
+        lines (list[str]): Lines of the paper.
+        starts (dict[str, int]): Line index of the first line of each section, by section type.
+        headings (set[int] | None): The first lines that are headings and are left out of their
+            section, all of them if None.
+
+    Returns:
+        dict[str, str]: The Markdown text of each section, by section type.
+    """
+    ordered: list[tuple[int, str]] = sorted(
+        (index, section_type) for section_type, index in starts.items()
+    )
+    ends: list[int] = [index for index, _ in ordered[1:]] + [len(lines)]
+    return {
+        section_type: "\n".join(
+            lines[start + (headings is None or start in headings) : end]
+        ).strip()
+        for (start, section_type), end in zip(ordered, ends)
+    }
+
+
+def locate_line(lines: list[str], anchor: str) -> int | None:
+    """
+    Returns the index of the line of a paper quoted by the model, or None if it is not found.
+
+    The line is looked up exactly, then without Markdown markup, accents or case, then as the
+    beginning of a line, since the model may shorten long lines.  A quote matching several lines
+    is ambiguous and not found.
+    """
+    anchor = anchor.strip()
+    if not anchor:
+        return None
+    normalized: str = normalize_line(anchor)
+    for matches in (
+        lambda line: line.strip() == anchor,
+        lambda line: normalize_line(line) == normalized,
+        lambda line: bool(normalized) and normalize_line(line).startswith(normalized),
+    ):
+        indexes: list[int] = [i for i, line in enumerate(lines) if matches(line)]
+        if len(indexes) == 1:
+            return indexes[0]
+        if len(indexes) > 1:
+            return None
+    return None
+
+
+def student_name(lines: list[str]) -> str:
+    """Returns the student's name given on a "Nom :" or "Name:" line, or an empty string."""
+    for line in lines:
+        match: re.Match | None = NAME_LINE.match(normalize_line(line))
+        if match is not None:
+            # Keep the accents and case of the original line
+            return line.split(":", 1)[1].strip(" *_") if ":" in line else ""
+    return ""
+
+
+def build_mock_exam(
+    md_text: str,
+    sections: dict[str, str],
+    name: str,
+    date: str,
+    file_id: str,
+    file_name: str,
+    description: str,
+) -> MockExam:
+    """Builds a MockExam from the text of its sections, counting their words."""
+    common: dict[str, str] = {
+        "name": name,
+        "date": date,
+        "original_file": file_id,
+        "original_file_name": file_name,
+    }
+
+    def section(cls: type[Submission], section_type: str) -> Submission:
+        text: str = sections[section_type]
+        return cls(
+            **common,
+            description=f"{section_type} section of the mock exam",
+            markdown_content=text,
+            word_count=len(text.split()),
+        )
+
+    return MockExam(
+        **common,
+        description=description,
+        markdown_content=md_text,
+        word_count=len(md_text.split()),
+        synthese=section(Synthese, Synthese.submission_type()),
+        essai=section(Essai, Essai.submission_type()),
+        traduction=section(Traduction, Traduction.submission_type()),
+    )
+
+
+def split_mock_exam_locally(
+    md_text: str, file_id: str, file_name: str, file_date: str | None
+) -> MockExam | None:
+    """
+    Splits a mock exam on its section headings, without calling the model.
+
+    Args:
+        md_text (str): Markdown text of the student's paper.
+        file_id (str): Google Drive file ID of the markdown file.
+        file_name (str): Name of the markdown file.
+        file_date (str | None): Creation date of the markdown file, if known.
+
+    Returns:
+        MockExam | None: The split mock exam, or None if the headings are not clear enough and
+        the paper should be split by the model.
+    """
+    headings, confidence = detect_section_headings(md_text)
+    if headings is None or confidence < MIN_LOCAL_SPLIT_CONFIDENCE:
+        print(f"Headings of {file_name} unclear (confidence {confidence:.2f}).")
+        return None
+    print(f"Split {file_name} on its headings (confidence {confidence:.2f}).")
+    lines: list[str] = md_text.splitlines()
+    return build_mock_exam(
+        md_text,
+        slice_sections(lines, headings),
+        student_name(lines[: min(headings.values())]),
+        # Drive creation times start with the YYYY-MM-DD date
+        (file_date or "")[:10],
+        file_id,
+        file_name,
+        "Mock exam split on its section headings",
+    )